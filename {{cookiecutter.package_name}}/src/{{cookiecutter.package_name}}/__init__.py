@@ -1,6 +1,17 @@
-"""Advanced Machine Learning Miniproject"""
-import {{cookiecutter.package_name}}.model as model
+"""Advanced Machine Learning Miniproject
+
+Submodules are imported on first access, so ``import {{cookiecutter.package_name}}`` and the CLI
+do not load torch until a stage needs it.
+"""
+import importlib
 
 __all__ = ["model"]
 
 __version__ = "1.0.0"
+
+
+def __getattr__(name: str):
+    """Imports the submodules listed in __all__ on first access."""
+    if name in __all__:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,18 +1,56 @@
-"""{{cookiecutter.package_name}} CLI"""
+"""{{cookiecutter.package_name}} CLI
+
+Every stage is a sub-command, and sub-commands can be chained, e.g.
+``{{cookiecutter.package_name}} preprocess train generate``. A sub-command imports the modules of its
+stage when it runs, so ``--help`` or preprocessing never load torch.
+
+The architecture of the model is read from the environment and .env, with
+the prefix MS_, e.g. MS_LAYERS=8 or MS_CHECKPOINTING=true, see
+model.settings.ModelSettings. ``{{cookiecutter.package_name}} estimate`` predicts the memory of
+training it.
+
+Sub-commands return the stages they declare, and the stages run as a
+stages.StageGraph, which skips the ones that are up to date. Under srun or
+torchrun every task runs the command, so only train, which runs in all of
+them, may be given there.
+"""
+import glob
 import os
 import random
-import transformers
+from contextlib import nullcontext
+from functools import partial
 
 import click
-import {{cookiecutter.package_name}}
 from {{cookiecutter.package_name}} import __version__ as VERSION
-from {{cookiecutter.package_name}}.preprocess import (
-    DataStreamer,
-    split,
-)
+from {{cookiecutter.package_name}}.stages import Stage, StageGraph
+
+
+def make_folder(path: str) -> None:
+    """Creates a folder if it does not exist."""
+    if not os.path.exists(path):
+        print(f"Creating directory {path} because it does not exists")
+        os.makedirs(path, exist_ok=True)
+
+
+SPLITS = ("train", "val", "test")
 
 
-@click.command()
+def seed_torch(seed: int) -> None:
+    """Seeds numpy and torch for the stages that use them."""
+    import numpy as np
+    import torch
+
+    np.random.seed(seed % 2**32)
+    torch.manual_seed(seed)
+
+
+def stage(obj: dict, name: str, cprofile: bool = True):
+    """Times and profiles a stage with --profile."""
+    profiler = obj["profiler"]
+    return profiler.stage(name, cprofile) if profiler is not None else nullcontext()
+
+
+@click.group(chain=True, invoke_without_command=True)
 @click.option("--version", is_flag=True, help="Shows the version of {{cookiecutter.package_name}}")
 @click.option("--seed", type=int, help="Set a seed")
 @click.option(
@@ -33,121 +71,802 @@ from {{cookiecutter.package_name}}.preprocess import (
     default="out/",
     help="Optional outfolder where output is saved to. Defaults to out/.",
 )
-@click.option("--download", is_flag=True, help="Downloads the dataset")
-@click.option("--preprocess", is_flag=True, help="Prepares the dataset")
 @click.option(
-    "--preprocess-pack",
-    type=click.Choice(["standard"], case_sensitive=False),
-    default="standard",
-    help="Preprocesses the dataset with the specified pack. Defaults to 'standard'.",
+    "--workers",
+    type=int,
+    help="Number of worker processes used for synthesizing, preprocessing, counting "
+    "the vocabulary and rendering generated MIDI files. 0 works in the main process. "
+    "Defaults to the number of CPUs available to the job, one less when generating.",
 )
-@click.option("--train", is_flag=True, help="Train a model.")
 @click.option(
-    "--hours",
+    "--dry-run",
+    is_flag=True,
+    help="Prints which stages would run and why, without running them.",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Runs the selected stages even if they are up to date.",
+)
+@click.option(
+    "--jobs",
     type=int,
-    default=0,
-    help="Number of hours to train for. Sum of hours and minutes is total "
-    "duration. Default is 1 minutes.",
+    help="Maximum number of independent stages running at the same time. "
+    "Defaults to all, or 1 with --profile.",
 )
 @click.option(
-    "--minutes",
+    "--profile",
+    is_flag=True,
+    help="Profiles the selected stages and writes Chrome traces, pstats files and "
+    "summary.txt to the profile folder of the outfolder.",
+)
+@click.option(
+    "--profile-skip",
     type=int,
-    default=1,
-    help="Number of minutes to train for. Sum of hours and minutes is "
-    "total duration. Default is 1 minutes.",
+    default=10,
+    help="Number of training steps before the profiled window. Defaults to 10.",
 )
 @click.option(
-    "--logfile",
-    type=click.Path(),
-    default="log.txt",
-    help="Logfile to save to. Defaults to log.txt",
+    "--profile-steps",
+    type=int,
+    default=5,
+    help="Number of training steps profiled with torch.profiler. Defaults to 5.",
 )
-@click.option("--generate", is_flag=True, help="Generate Music")
 @click.option(
-    "--max-gen",
+    "--profile-every",
     type=int,
-    default=1000,
-    help="Maximum number of samples to generate from test set. " "Defaults to 1000.",
+    default=100,
+    help="Profiles every n-th file when preprocessing. Defaults to 100.",
 )
+@click.pass_context
 def cli(
+    ctx,
     version,
     seed,
     data,
     model,
     out,
-    download,
-    preprocess,
-    preprocess_pack,
-    train,
-    hours,
-    minutes,
-    logfile,
-    generate,
-    max_gen,
+    workers,
+    dry_run,
+    force,
+    jobs,
+    profile,
+    profile_skip,
+    profile_steps,
+    profile_every,
 ):
-    """The main way to engage with {{cookiecutter.package_name}} is with this cli"""
+    """The main way to engage with {{cookiecutter.package_name}} is with this cli.
+
+    Stages are sub-commands, e.g.
+    "{{cookiecutter.package_name}} --seed 1 preprocess --shards train --minutes 30 generate".
+    Stages whose outputs are up to date are skipped, see --dry-run and --force.
+    """
 
+    given_seed = seed or None
     if not seed:
         seed = random.randint(0, 2**32 - 1)
 
     print(f"Running with seed {seed}")
-    transformers.set_seed(seed)
+    random.seed(seed)
 
     if version:
         click.echo(f"{VERSION}")
 
-    if download or preprocess:
-        if not os.path.exists(data):
-            print(f"Creating directory {data} because it does not exists")
-            os.mkdir(data)
+    profiler = None
+    if profile and not dry_run:
+        from {{cookiecutter.package_name}}.profiling import Profiler
+
+        profiler = Profiler(
+            os.path.join(out, "profile"),
+            skip=profile_skip,
+            steps=profile_steps,
+            every=profile_every,
+        )
+
+    ctx.obj = {
+        "seed": seed,
+        "given_seed": given_seed,
+        "data": data,
+        "model": model,
+        "out": out,
+        "workers": workers,
+        "dry_run": dry_run,
+        "force": force,
+        # cProfile profiles one stage at a time.
+        "jobs": 1 if profiler is not None else jobs,
+        "profiler": profiler,
+    }
 
-    if download:
+
+@cli.result_callback()
+@click.pass_obj
+def finish(obj, results, **kwargs):
+    """Runs the stages of the sub-commands and prints the profiles."""
+    from {{cookiecutter.package_name}}.launch import detect
+
+    stages = [stage for result in results for stage in result]
+    if not stages:
+        return
+    context = detect()
+    single = [stage.name for stage in stages if not stage.distributed]
+    if context.is_distributed and single:
+        # Every task would run them at once and write the same files.
+        raise click.UsageError(
+            f"{', '.join(single)} cannot run in each of the {context.world_size} tasks "
+            "of a distributed launch. Run them in a single task first, then launch "
+            "only train with srun or torchrun."
+        )
+    if obj["force"]:
+        stages = [stage._replace(force=True) for stage in stages]
+    graph = StageGraph(
+        stages,
+        os.path.join(obj["data"], "stages.json"),
+        jobs=obj["jobs"],
+        workers=obj["workers"] or 1,
+        main=context.is_main,
+    )
+    if obj["dry_run"]:
+        print(graph.describe())
+        return
+    graph.run()
+
+    profiler = obj["profiler"]
+    if profiler is not None:
+        print(profiler.summary())
+        print(f"Saved profiles to {profiler.folder}")
+
+
+@cli.command()
+@click.pass_obj
+def download(obj):
+    """Downloads the dataset"""
+    data = obj["data"]
+
+    def run():
+        """Would download the dataset into the rawdata folder."""
+        make_folder(data)
         raise Exception(
             f"""Download not implemented. Get the data yourself and place it in {os.path.join(data, "rawdata")}"""
         )
 
-    if preprocess:
+    return [Stage("download", run, outputs=(os.path.join(data, "rawdata"),))]
 
-        datastreamer = DataStreamer(data)
 
-        if preprocess_pack == "standard":
-            transforms = []  # Insert list of transforms to apply
-        else:
-            transforms = []
+@cli.command()
+@click.option(
+    "--files",
+    type=int,
+    default=1000,
+    help="Number of synthetic files. Defaults to 1000.",
+)
+@click.option(
+    "--fanout",
+    type=int,
+    default=16,
+    help="Number of subfolders per folder of the synthetic dataset. Defaults to 16.",
+)
+@click.option(
+    "--depth",
+    type=int,
+    default=2,
+    help="Number of folder levels of the synthetic dataset. Defaults to 2.",
+)
+@click.option(
+    "--notes",
+    type=int,
+    default=500,
+    help="Median number of notes per synthetic file. Defaults to 500.",
+)
+@click.option(
+    "--sigma",
+    type=float,
+    default=1.0,
+    help="Spread of the log-normal number of notes per synthetic file. "
+    "0 gives every file the same size. Defaults to 1.0.",
+)
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(["csv", "midi"], case_sensitive=False),
+    default="midi",
+    help="Format of the synthetic files. Defaults to 'midi'.",
+)
+@click.pass_obj
+def synthesize(obj, files, fanout, depth, notes, sigma, file_format):
+    """Generates a synthetic raw dataset in the rawdata folder of the datafolder
+    from --seed. Existing files are kept, unless they were written with another seed."""
+    data = obj["data"]
+    params = dict(
+        files=files,
+        fanout=fanout,
+        depth=depth,
+        notes=notes,
+        sigma=sigma,
+        format=file_format.lower(),
+        seed=obj["given_seed"],
+    )
+
+    def run():
+        """Writes the synthetic files."""
+        from {{cookiecutter.package_name}}.preprocess import available_cpus
+        from {{cookiecutter.package_name}}.preprocess import synthesize as synthesize_files
+        from {{cookiecutter.package_name}}.preprocess import synthetic_seed
+
+        make_folder(data)
+        print(f"Synthesizing {files} files in {os.path.join(data, 'rawdata')}")
+        workers, seed = obj["workers"], obj["given_seed"]
+        if seed is None:
+            # Without --seed an existing dataset is continued with its own seed.
+            seed = synthetic_seed(data)
+            seed = obj["seed"] if seed is None else seed
+        with stage(obj, "synthesize", cprofile=False):
+            written = synthesize_files(
+                data,
+                workers=available_cpus() if workers is None else workers,
+                **dict(params, seed=seed),
+            )
+        print(f"Wrote {written} files, kept {files - written} existing files")
+
+    return [
+        Stage(
+            "synthesize",
+            run,
+            outputs=(os.path.join(data, "rawdata"),),
+            params=params,
+        )
+    ]
+
+
+@cli.command()
+@click.option(
+    "--pack",
+    default="standard",
+    help="Preprocesses the dataset with the specified pack. Defaults to 'standard'.",
+)
+@click.option(
+    "--readahead",
+    type=int,
+    default=16,
+    help="Number of raw files loaded ahead on background threads while "
+    "preprocessing. Defaults to 16.",
+)
+@click.option(
+    "--rebuild",
+    is_flag=True,
+    help="Transforms every file again instead of only new and changed files.",
+)
+@click.option(
+    "--shards",
+    is_flag=True,
+    help="Packs the preprocessed token sequences into memory mapped shards in "
+    "the shards folder of the datafolder. The split of every sequence is stored "
+    "in the shards instead of split lists, keyed on the path of its raw file.",
+)
+@click.option(
+    "--split-method",
+    type=click.Choice(["hash", "position"], case_sensitive=False),
+    default="hash",
+    help="Assign files to train/val/test by a stable hash of their path or by "
+    "their position in the file list. Defaults to 'hash'.",
+)
+@click.option(
+    "--split-group",
+    type=str,
+    help="Regex on the relative path of a cleaned file. Files with the same match "
+    "are kept in the same split. Only used with --split-method hash.",
+)
+@click.option(
+    "--shard",
+    help="Only preprocesses partition i/n of the raw files, e.g. 3/16, or the "
+    "partition of the SLURM array task with 'slurm'. Combine the partitions with merge.",
+)
+@click.pass_obj
+def preprocess(obj, pack, readahead, rebuild, shards, split_method, split_group, shard):
+    """Prepares the dataset and splits it into train, val and test"""
+    from {{cookiecutter.package_name}}.preprocess import Partition, get_pack
+
+    data, workers, profiler = obj["data"], obj["workers"], obj["profiler"]
+    try:
+        transforms = get_pack(pack)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint="--pack")
+    partition = None
+    if shard is not None:
+        try:
+            partition = Partition.parse(shard)
+        except ValueError as error:
+            raise click.BadParameter(str(error), param_hint="--shard")
+        if split_method.lower() != "hash":
+            raise click.BadParameter(
+                "partitions are split by hash", param_hint="--split-method"
+            )
+        print(f"Preprocessing partition {partition.index} of {partition.count}")
+    if shards and split_method.lower() != "hash":
+        raise click.BadParameter(
+            "shards are split by hash", param_hint="--split-method"
+        )
+    clean = os.path.join(data, "cleandata")
+    target = os.path.join(data, "shards") if shards else clean
+    if partition is not None and shards:
+        target = os.path.join(partition.folder(data), "shards")
+
+    def run_preprocess():
+        """Transforms the raw data."""
+        from {{cookiecutter.package_name}}.preprocess import (
+            DataStreamer,
+            ShardWriter,
+            available_cpus,
+            split_of,
+        )
+
+        make_folder(data)
+        datastreamer = DataStreamer(data)
 
         print(
             f"""Streaming data. From {os.path.join(data, "rawdata")} to {os.path.join(data, "cleandata")}"""  # noqa
         )
-        datastreamer.preprocess(transforms)
-
-        split(data_path=data)
-
-    if train:
-        directory = os.path.dirname(model)
-        if not os.path.exists(directory):
-            print(f"Creating directory {directory} because it does not exists")
-            os.mkdir(directory)
-        if not os.path.exists(os.path.join(directory, "snapshots")):
-            print(
-                f"Creating directory {os.path.join(directory, 'snapshots')} because it does not exists"
+        with stage(obj, "preprocess"):
+            if shards:
+                print(f"Packing shards into {target}")
+                assign = partial(split_of, group=split_group)
+                with ShardWriter(target, assign=assign) as sink:
+                    datastreamer.preprocess(
+                        transforms,
+                        workers=available_cpus() if workers is None else workers,
+                        sink=sink,
+                        readahead=readahead,
+                        profiler=profiler,
+                        partition=partition,
+                    )
+            else:
+                datastreamer.preprocess(
+                    transforms,
+                    workers=available_cpus() if workers is None else workers,
+                    incremental=not rebuild,
+                    readahead=readahead,
+                    profiler=profiler,
+                    partition=partition,
+                )
+
+    def run_split():
+        """Writes the split lists."""
+        from {{cookiecutter.package_name}}.preprocess import split
+
+        split(
+            data_path=data, method=split_method, group=split_group, partition=partition
+        )
+
+    if partition is not None:
+
+        def run_partition():
+            """Preprocesses and splits the partition."""
+            run_preprocess()
+            if not shards:
+                run_split()
+
+        # Array tasks rely on the manifest of their partition to skip up to date files.
+        # Fingerprinting the whole rawdata folder in every task would cost more.
+        return [
+            Stage(
+                f"preprocess {partition.name}",
+                run_partition,
+                outputs=(partition.folder(data),),
+                force=True,
             )
-            os.mkdir(os.path.join(directory, "snapshots"))
+        ]
+
+    # The transforms are fingerprinted with their source, so editing one reruns the stage.
+    params = {"transforms": transforms, "shards": shards}
+    if shards:
+        # The shards store the split of every sequence, there are no lists to write.
+        params["group"] = split_group
+    stages = [
+        Stage(
+            "preprocess",
+            run_preprocess,
+            inputs=(os.path.join(data, "rawdata"),),
+            outputs=(target,),
+            params=params,
+            force=rebuild,
+        )
+    ]
+    if shards:
+        return stages
+    return stages + [
+        Stage(
+            "split",
+            run_split,
+            inputs=(clean,),
+            outputs=tuple(os.path.join(data, f"{name}.txt") for name in SPLITS),
+            params={"method": split_method.lower(), "group": split_group},
+        ),
+    ]
+
+
+@cli.command()
+@click.pass_obj
+def merge(obj):
+    """Combines the partitions preprocessed with preprocess --shard"""
+    data = obj["data"]
+    parts = os.path.join(data, "parts")
+    if glob.glob(os.path.join(glob.escape(parts), "*", "shards", "index.npy")):
+        outputs = [os.path.join(data, "shards")]
+    else:
+        outputs = [os.path.join(data, f"{name}.txt") for name in SPLITS]
+        outputs.append(os.path.join(data, "manifest.json"))
+
+    def run():
+        """Merges the manifests, split lists and shards of the partitions."""
+        from {{cookiecutter.package_name}}.preprocess import merge_partitions
+
+        with stage(obj, "merge", cprofile=False):
+            print(f"Merged {merge_partitions(data)} partitions from {parts}")
+
+    return [
+        Stage(
+            "merge",
+            run,
+            inputs=(parts,),
+            outputs=tuple(outputs),
+        )
+    ]
+
+
+@cli.command()
+@click.option(
+    "--hours",
+    type=int,
+    default=0,
+    help="Number of hours to train for. Sum of hours and minutes is total "
+    "duration. Default is 1 minutes.",
+)
+@click.option(
+    "--minutes",
+    type=int,
+    default=1,
+    help="Number of minutes to train for. Sum of hours and minutes is "
+    "total duration. Default is 1 minutes.",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=32,
+    help="Number of sequences per batch. Defaults to 32.",
+)
+@click.option(
+    "--vocab-size",
+    type=int,
+    default=512,
+    help="Maximum number of tokens of the model. The most frequent tokens of the train "
+    "split are kept, the others share an unknown token. Defaults to 512.",
+)
+@click.option(
+    "--min-freq",
+    type=int,
+    default=1,
+    help="Tokens occurring less often in the train split are mapped to the unknown "
+    "token. Defaults to 1.",
+)
+@click.option(
+    "--precision",
+    type=click.Choice(["fp32", "bf16", "fp16"], case_sensitive=False),
+    default="fp32",
+    help="Training precision. bf16 and fp16 use autocast, fp16 with loss scaling. "
+    "Defaults to 'fp32'.",
+)
+@click.option(
+    "--accumulate",
+    type=int,
+    default=1,
+    help="Number of batches whose gradients are accumulated per optimizer step. "
+    "Defaults to 1.",
+)
+@click.option(
+    "--resume/--no-resume",
+    default=True,
+    help="Resume training from the newest checkpoint next to the model. Defaults to resume.",
+)
+@click.option(
+    "--checkpoint-minutes",
+    type=float,
+    default=30,
+    help="Minutes between checkpoints within an epoch. A checkpoint is also "
+    "saved after every epoch. Defaults to 30.",
+)
+@click.option(
+    "--keep-last",
+    type=int,
+    default=3,
+    help="Number of newest checkpoints kept. Defaults to 3.",
+)
+@click.option(
+    "--keep-best",
+    type=int,
+    default=1,
+    help="Number of checkpoints with the lowest validation loss kept. Defaults to 1.",
+)
+@click.option(
+    "--max-steps",
+    type=int,
+    help="Stops training after this many optimizer steps. Defaults to no limit.",
+)
+@click.option(
+    "--max-tokens",
+    type=int,
+    help="Stops training after this many trained tokens. Defaults to no limit.",
+)
+@click.option(
+    "--time-margin",
+    type=float,
+    default=0,
+    help="Seconds kept free before the end of --hours and --minutes, on top of the "
+    "predicted time of the next step and the final checkpoint. Defaults to 0.",
+)
+@click.option(
+    "--requeue",
+    is_flag=True,
+    help="Requeues the SLURM job when training is stopped by SIGTERM or SIGUSR1.",
+)
+@click.option(
+    "--logfile",
+    type=click.Path(),
+    default="log.txt",
+    help="Logfile to save training metrics to. CSV, or JSONL if it ends with .jsonl. "
+    "Defaults to log.txt",
+)
+@click.option(
+    "--log-every",
+    type=int,
+    default=10,
+    help="Number of optimizer steps between step records in the logfile. "
+    "0 logs epochs only. Defaults to 10.",
+)
+@click.option(
+    "--log-per-rank",
+    is_flag=True,
+    help="Every process of a distributed run writes its own logfile, "
+    "e.g. log.rank1.txt. By default only rank 0 logs.",
+)
+@click.pass_obj
+def train(
+    obj,
+    hours,
+    minutes,
+    batch_size,
+    vocab_size,
+    min_freq,
+    precision,
+    accumulate,
+    resume,
+    checkpoint_minutes,
+    keep_last,
+    keep_best,
+    max_steps,
+    max_tokens,
+    time_margin,
+    requeue,
+    logfile,
+    log_every,
+    log_per_rank,
+):
+    """Train a model. Trains data parallel when started with srun or torchrun."""
+    from {{cookiecutter.package_name}}.model.settings import ModelSettings
+
+    data, model, workers = obj["data"], obj["model"], obj["workers"]
+    params = dict(
+        settings=ModelSettings(),
+        hours=hours,
+        minutes=minutes,
+        batch_size=batch_size,
+        vocab_size=vocab_size,
+        min_freq=min_freq,
+        precision=precision,
+        accumulate=accumulate,
+        max_steps=max_steps,
+        max_tokens=max_tokens,
+    )
+
+    def run():
+        """Trains the model. Returns False if training stopped before its budget was used up."""
+        from {{cookiecutter.package_name}}.model.train import train as train_model
+        from {{cookiecutter.package_name}}.preprocess import available_cpus
+
+        seed_torch(obj["seed"])
+        # All processes of a distributed job get here at the same time.
+        make_folder(os.path.join(os.path.dirname(model), "snapshots"))
 
         print("Training model...")
-        {{cookiecutter.package_name}}.model.train(
-            data_path=data,
-            model_path=model,
-            hours=hours,
-            minutes=minutes,
-            logfile=logfile,
+        # cProfile would slow down every step, torch.profiler only profiles a window.
+        with stage(obj, "train", cprofile=False):
+            return train_model(
+                data_path=data,
+                model_path=model,
+                logfile=logfile,
+                resume=resume,
+                checkpoint_minutes=checkpoint_minutes,
+                keep_last=keep_last,
+                keep_best=keep_best,
+                margin=time_margin,
+                requeue=requeue,
+                log_every=log_every,
+                log_per_rank=log_per_rank,
+                vocab_workers=available_cpus() if workers is None else workers,
+                profiler=obj["profiler"],
+                **params,
+            )
+
+    return [
+        Stage(
+            "train",
+            run,
+            inputs=(
+                os.path.join(data, "train.txt"),
+                os.path.join(data, "val.txt"),
+                os.path.join(data, "shards"),
+            ),
+            outputs=(model,),
+            params=params,
+            distributed=True,
         )
+    ]
+
 
-    if generate:
+@cli.command()
+@click.option(
+    "--max-gen",
+    type=int,
+    default=1000,
+    help="Maximum number of samples to generate from test set. " "Defaults to 1000.",
+)
+@click.option(
+    "--slots",
+    type=int,
+    default=32,
+    help="Number of samples decoded together. Finished samples are replaced by "
+    "the next prompt right away. Defaults to 32.",
+)
+@click.option(
+    "--tokens",
+    type=int,
+    default=256,
+    help="Number of tokens generated per sample. Defaults to 256.",
+)
+@click.option(
+    "--prompt-tokens",
+    type=int,
+    default=64,
+    help="Number of tokens of a test sequence used as prompt. Defaults to 64.",
+)
+@click.option(
+    "--queue",
+    type=int,
+    default=64,
+    help="Maximum number of generated samples waiting to be rendered to MIDI. "
+    "Defaults to 64.",
+)
+@click.option(
+    "--quantize",
+    is_flag=True,
+    help="Generates with int8 quantized linear layers on CPUs. The quantized model is "
+    "cached next to the model and only used if its validation perplexity is within "
+    "--quantize-tolerance of the fp32 model.",
+)
+@click.option(
+    "--quantize-tolerance",
+    type=float,
+    default=0.02,
+    help="Allowed relative increase of the validation perplexity by --quantize. "
+    "Defaults to 0.02.",
+)
+@click.option(
+    "--compile",
+    "compile_model",
+    is_flag=True,
+    help="Compiles the feed forward layers with torch.compile for generation.",
+)
+@click.option(
+    "--threads",
+    type=int,
+    help="Number of threads torch uses for generation. Defaults to the number of "
+    "CPUs available to the job.",
+)
+@click.option(
+    "--temperature",
+    type=float,
+    default=1.0,
+    help="Sampling temperature. 0 picks the most likely token. Defaults to 1.0.",
+)
+@click.option(
+    "--top-k",
+    type=int,
+    help="Only samples from the k most likely tokens. Defaults to all tokens.",
+)
+@click.pass_obj
+def generate(
+    obj,
+    max_gen,
+    slots,
+    tokens,
+    prompt_tokens,
+    queue,
+    quantize,
+    quantize_tolerance,
+    compile_model,
+    threads,
+    temperature,
+    top_k,
+):
+    """Generate Music"""
+    data, model, out, workers = obj["data"], obj["model"], obj["out"], obj["workers"]
+    params = dict(
+        max_gen=max_gen,
+        max_new_tokens=tokens,
+        prompt_tokens=prompt_tokens,
+        temperature=temperature,
+        top_k=top_k,
+        quantize=quantize,
+        tolerance=quantize_tolerance,
+    )
+
+    def run():
+        """Generates the samples."""
         if not os.path.exists(model):
             raise Exception(f"Model is not trained yet. No model found at {model}")
-        if not os.path.exists(out):
-            print(f"Creating directory {out} because it does not exists")
-            os.mkdir(out)
-        {{cookiecutter.package_name}}.model.generate(
-            data_path=data, model_path=model, output_path=out, max_gen=max_gen
+        from {{cookiecutter.package_name}}.model.generate import generate as generate_samples
+        from {{cookiecutter.package_name}}.preprocess import available_cpus
+
+        seed_torch(obj["seed"])
+        make_folder(out)
+        with stage(obj, "generate"):
+            generate_samples(
+                data_path=data,
+                model_path=model,
+                output_path=out,
+                slots=slots,
+                # One CPU keeps decoding. --workers 0 renders in the decoding process.
+                workers=max(1, available_cpus() - 1) if workers is None else workers,
+                queue_size=queue,
+                compile=compile_model,
+                threads=threads,
+                **params,
+            )
+
+    return [
+        Stage(
+            "generate",
+            run,
+            inputs=(model, os.path.join(data, "test.txt")),
+            outputs=(out,),
+            params=params,
         )
+    ]
+
+
+@cli.command()
+@click.option(
+    "--batch-size",
+    type=int,
+    default=32,
+    help="Number of sequences per batch and device. Defaults to 32.",
+)
+@click.option(
+    "--vocab-size",
+    type=int,
+    default=512,
+    help="Number of tokens of the model. Defaults to 512.",
+)
+@click.option(
+    "--precision",
+    type=click.Choice(["fp32", "bf16", "fp16"], case_sensitive=False),
+    default="fp32",
+    help="Training precision. Defaults to 'fp32'.",
+)
+def estimate(batch_size, vocab_size, precision):
+    """Estimate the peak memory of training the model configured by MS_ settings."""
+    from {{cookiecutter.package_name}}.model.memory import estimate_memory
+    from {{cookiecutter.package_name}}.model.settings import ModelSettings
+
+    settings = ModelSettings()
+    print(settings)
+    print(estimate_memory(settings, vocab_size, batch_size, precision).describe())
+    return []
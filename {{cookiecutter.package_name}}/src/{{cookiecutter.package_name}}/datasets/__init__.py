@@ -2,6 +2,47 @@
 ========
 Module for loading datasets into torch.
 All of these functions relate to actions doing training.
+
+This submodule contains functions and classes from the following files:
+
+* streaming.py
+* batching.py
+* vocab.py
+
 """
 
-__all__ = []
+from {{cookiecutter.package_name}}.datasets.streaming import StreamingDataset
+from {{cookiecutter.package_name}}.datasets.streaming import Throughput
+from {{cookiecutter.package_name}}.datasets.streaming import make_loader
+from {{cookiecutter.package_name}}.datasets.streaming import pad_collate
+from {{cookiecutter.package_name}}.datasets.batching import BucketedDataset
+from {{cookiecutter.package_name}}.datasets.batching import PackedDataset
+from {{cookiecutter.package_name}}.datasets.batching import PaddingStats
+from {{cookiecutter.package_name}}.datasets.batching import collate_padded
+from {{cookiecutter.package_name}}.datasets.batching import document_mask
+from {{cookiecutter.package_name}}.datasets.batching import make_batches
+from {{cookiecutter.package_name}}.datasets.vocab import TokenCounts
+from {{cookiecutter.package_name}}.datasets.vocab import Vocab
+from {{cookiecutter.package_name}}.datasets.vocab import build_vocab
+from {{cookiecutter.package_name}}.datasets.vocab import model_vocab
+from {{cookiecutter.package_name}}.datasets.vocab import split_fingerprint
+from {{cookiecutter.package_name}}.datasets.vocab import vocab_path
+
+__all__ = [
+    "StreamingDataset",
+    "Throughput",
+    "make_loader",
+    "pad_collate",
+    "BucketedDataset",
+    "PackedDataset",
+    "PaddingStats",
+    "collate_padded",
+    "document_mask",
+    "make_batches",
+    "TokenCounts",
+    "Vocab",
+    "build_vocab",
+    "model_vocab",
+    "split_fingerprint",
+    "vocab_path",
+]
@@ -0,0 +1,335 @@
+"""
+Batching
+========
+Batching of variable length sequences without wasting compute on padding.
+
+Batches are dicts of (batch, length) tensors:
+
+* tokens: the tokens.
+* documents: which sequence a token belongs to. -1 marks padding.
+* positions: position of a token within its sequence.
+"""
+
+import random
+from functools import partial
+
+import torch
+from torch.utils.data import IterableDataset
+
+from {{cookiecutter.package_name}}.datasets.streaming import make_loader
+
+
+def packed_contexts(sequences, context: int, pad: int = 0):
+    """
+    Packs sequences back to back into fixed length contexts.
+    Sequences longer than the remaining space continue in the next context.
+    Every piece is a document of its own with positions from 0, as it cannot
+    attend to the tokens of the earlier pieces in other contexts.
+
+    Parameters
+    ----------
+    sequences: Iterable
+        Iterable of 1D tensors.
+    context: int
+        Length of a context.
+    pad: int
+        Padding token of the last, partially filled context.
+
+    Yields
+    ------
+    context: dict
+        tokens, documents and positions tensors of shape (context,).
+    """
+
+    def empty():
+        """Returns an empty context."""
+        return {
+            "tokens": torch.full((context,), pad, dtype=torch.long),
+            "documents": torch.full((context,), -1, dtype=torch.long),
+            "positions": torch.zeros(context, dtype=torch.long),
+        }
+
+    current, filled, document = empty(), 0, 0
+    for sequence in sequences:
+        start = 0
+        while start < len(sequence):
+            n = min(context - filled, len(sequence) - start)
+            current["tokens"][filled : filled + n] = sequence[start : start + n]  # noqa
+            current["documents"][filled : filled + n] = document  # noqa
+            current["positions"][filled : filled + n] = torch.arange(n)  # noqa
+            filled += n
+            start += n
+            if filled == context:
+                yield current
+                current, filled, document = empty(), 0, 0
+        if filled > 0:
+            document += 1
+
+    if filled > 0:
+        yield current
+
+
+def collate_padded(sequences: list, pad: int = 0, max_length: int = None) -> dict:
+    """
+    Pads sequences to the longest one.
+
+    Parameters
+    ----------
+    sequences: list
+        List of 1D tensors.
+    pad: int
+        Padding token.
+    max_length: int
+        Sequences are truncated to this length. Defaults to no truncation.
+
+    Returns
+    -------
+    batch: dict
+        tokens, documents and positions tensors of shape (batch, longest sequence).
+    """
+    sequences = [s[:max_length] for s in sequences]
+    length = max(len(s) for s in sequences)
+    batch = {
+        "tokens": torch.full((len(sequences), length), pad, dtype=torch.long),
+        "documents": torch.full((len(sequences), length), -1, dtype=torch.long),
+        "positions": torch.arange(length).repeat(len(sequences), 1),
+    }
+    for i, sequence in enumerate(sequences):
+        batch["tokens"][i, : len(sequence)] = sequence
+        batch["documents"][i, : len(sequence)] = 0
+    return batch
+
+
+def document_mask(documents: torch.Tensor) -> torch.Tensor:
+    """
+    Causal attention mask that keeps tokens from attending across sequences or to padding.
+
+    Parameters
+    ----------
+    documents: torch.Tensor
+        documents tensor of shape (batch, length) of a batch.
+
+    Returns
+    -------
+    mask: torch.Tensor
+        Boolean tensor of shape (batch, length, length). True where query i may attend to key j.
+        The diagonal is always True, so padding rows stay well defined.
+    """
+    length = documents.shape[-1]
+    causal = torch.ones(
+        length, length, dtype=torch.bool, device=documents.device
+    ).tril()
+    same = documents.unsqueeze(-1) == documents.unsqueeze(-2)
+    real = (documents >= 0).unsqueeze(-2)
+    diagonal = torch.eye(length, dtype=torch.bool, device=documents.device)
+    return (causal & same & real) | diagonal
+
+
+class PackedDataset(IterableDataset):
+    """
+    Packs the sequences of a dataset into fixed length contexts. Use with batch_size contexts per batch.
+    """
+
+    def __init__(self, dataset, context: int, pad: int = 0):
+        """
+        Initialize the PackedDataset class.
+
+        Parameters
+        ----------
+        dataset: IterableDataset
+            Dataset of 1D tensors, e.g. a StreamingDataset.
+        context: int
+            Length of a context.
+        pad: int
+            Padding token.
+        """
+        self.dataset = dataset
+        self.context = context
+        self.pad = pad
+
+    def __iter__(self):
+        """
+        Iterate over packed contexts.
+        """
+        yield from packed_contexts(self.dataset, self.context, self.pad)
+
+
+class BucketedDataset(IterableDataset):
+    """
+    Groups sequences of similar length into batches under a token budget. Use with batch_size=None.
+
+    A buffer of sequences is sorted by length and cut into batches whose
+    padded size is at most max_tokens. The batches of a buffer are yielded in
+    random order, so training does not see lengths in sorted order.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        max_tokens: int,
+        buffer_size: int = 1024,
+        max_length: int = None,
+        pad: int = 0,
+        shuffle: bool = True,
+        seed: int = 0,
+    ):
+        """
+        Initialize the BucketedDataset class.
+
+        Parameters
+        ----------
+        dataset: IterableDataset
+            Dataset of 1D tensors, e.g. a StreamingDataset.
+        max_tokens: int
+            Maximum of batch size times longest sequence of a batch.
+        buffer_size: int
+            Number of sequences sorted together. Larger buffers waste less padding.
+        max_length: int
+            Sequences are truncated to this length. Defaults to no truncation.
+        pad: int
+            Padding token.
+        shuffle: bool
+            If True, the batches of a buffer are shuffled.
+        seed: int
+            Seed of the shuffle.
+        """
+        self.dataset = dataset
+        self.max_tokens = max_tokens
+        self.buffer_size = buffer_size
+        self.max_length = max_length
+        self.pad = pad
+        self.shuffle = shuffle
+        self.seed = seed
+
+    def _batches(self, buffer: list) -> list:
+        """
+        Parameters
+        ----------
+        buffer: list
+            List of 1D tensors.
+
+        Returns
+        -------
+        batches: list
+            Lists of sequences of similar length under the token budget.
+        """
+        batches, batch = [], []
+        for sequence in sorted(buffer, key=len):
+            if batch and (len(batch) + 1) * len(sequence) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(sequence)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        """
+        Iterate over collated batches.
+        """
+        rng = random.Random(self.seed + getattr(self.dataset, "epoch", 0))
+        buffer = []
+        for sequence in self.dataset:
+            buffer.append(sequence[: self.max_length])
+            if len(buffer) < self.buffer_size:
+                continue
+            batches = self._batches(buffer)
+            if self.shuffle:
+                rng.shuffle(batches)
+            for batch in batches:
+                yield collate_padded(batch, self.pad)
+            buffer = []
+
+        for batch in self._batches(buffer):
+            yield collate_padded(batch, self.pad)
+
+
+class PaddingStats:
+    """
+    Counts how many token slots of the batches hold real tokens.
+    """
+
+    def __init__(self):
+        """
+        Initialize the PaddingStats class.
+        """
+        self.tokens = 0
+        self.slots = 0
+
+    def update(self, batch: dict) -> None:
+        """
+        Parameters
+        ----------
+        batch: dict
+            A batch with a documents tensor.
+        """
+        documents = batch["documents"]
+        self.tokens += int((documents >= 0).sum())
+        self.slots += documents.numel()
+
+    @property
+    def efficiency(self) -> float:
+        """
+        Returns
+        -------
+        efficiency: float
+            Fraction of token slots that are not padding.
+        """
+        return self.tokens / self.slots if self.slots else 1.0
+
+
+def make_batches(
+    dataset,
+    batching: str = "bucket",
+    batch_size: int = 32,
+    context: int = 512,
+    num_workers: int = 0,
+    pad: int = 0,
+):
+    """
+    DataLoader producing batch dicts from a dataset of sequences.
+
+    Parameters
+    ----------
+    dataset: IterableDataset
+        Dataset of 1D tensors, e.g. a StreamingDataset.
+    batching: str
+        "pad" pads batch_size sequences to the longest one, "pack" packs sequences
+        into batch_size contexts and "bucket" groups sequences of similar length
+        into batches of at most batch_size * context tokens.
+    batch_size: int
+        Number of sequences or contexts per batch.
+    context: int
+        Context length of the model. Longer sequences are truncated or, when packing, split.
+    num_workers: int
+        Number of DataLoader worker processes.
+    pad: int
+        Padding token.
+
+    Returns
+    -------
+    loader: DataLoader
+        The DataLoader.
+    """
+    if batching == "pad":
+        return make_loader(
+            dataset,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            collate_fn=partial(collate_padded, pad=pad, max_length=context),
+        )
+    if batching == "pack":
+        return make_loader(
+            PackedDataset(dataset, context, pad),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            collate_fn=None,
+        )
+    if batching == "bucket":
+        return make_loader(
+            BucketedDataset(dataset, batch_size * context, max_length=context, pad=pad),
+            batch_size=None,
+            num_workers=num_workers,
+            collate_fn=None,
+        )
+    raise ValueError(f"Unknown batching {batching}")
@@ -0,0 +1,346 @@
+"""
+Streaming
+=========
+Streaming datasets over split lists and packed shards.
+"""
+
+import os
+import time
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+from {{cookiecutter.package_name}}.preprocess import ShardReader, assign_split
+from {{cookiecutter.package_name}}.preprocess.shards import SPLITS
+
+
+def distributed_rank() -> tuple:
+    """
+    Rank and world size of this process.
+
+    Taken from torch.distributed if it is initialized, otherwise from the
+    RANK and WORLD_SIZE environment variables set by torchrun.
+
+    Returns
+    -------
+    rank: int
+        Rank of this process.
+    world_size: int
+        Number of processes.
+    """
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+
+def load_csv(filename: str) -> np.ndarray:
+    """
+    Default loader for cleaned files listed in a split list.
+
+    Parameters
+    ----------
+    filename: str
+        Path to a csv file of integer tokens.
+
+    Returns
+    -------
+    tokens: np.ndarray
+        Flat array of the tokens in the file.
+    """
+    return np.loadtxt(filename, delimiter=",", dtype=np.int64, ndmin=1).reshape(-1)
+
+
+class StreamingDataset(IterableDataset):
+    """
+    Iterable dataset of token sequences divided between distributed ranks and DataLoader workers.
+
+    Every (rank, worker) pair reads a disjoint stride of the same, optionally
+    shuffled, order. So each sample is read exactly once per epoch.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        split: str = None,
+        shuffle: bool = False,
+        seed: int = 0,
+        load=load_csv,
+        rank: int = None,
+        world_size: int = None,
+        vocab=None,
+    ):
+        """
+        Initialize the StreamingDataset class.
+
+        Parameters
+        ----------
+        source: str
+            A split list such as data/train.txt, or a folder written by a ShardWriter.
+        split: str
+            Only for shards. One of "train", "val" and "test". Sequences are
+            selected by the split stored in the index when the shards were written,
+            or by assign_split on their name for shards written without one.
+            Defaults to all sequences.
+        shuffle: bool
+            If True, the order is shuffled every epoch. See set_epoch.
+        seed: int
+            Seed of the shuffle. Must be the same on all ranks.
+        load: callable
+            Only for split lists. Function loading the tokens of a listed file.
+        rank: int
+            Rank of this process. Defaults to distributed_rank.
+        world_size: int
+            Number of processes. Defaults to distributed_rank.
+        vocab: Vocab
+            If given, sequences are encoded to the ids of the vocabulary, see datasets.vocab.
+        """
+        self.source = source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.load = load
+        self.vocab = vocab
+        self.epoch = 0
+
+        default_rank, default_world_size = distributed_rank()
+        self.rank = default_rank if rank is None else rank
+        self.world_size = default_world_size if world_size is None else world_size
+
+        if os.path.isdir(source):
+            self.shards = ShardReader(source)
+            self.items = np.arange(len(self.shards))
+            if split is not None:
+                codes = self.shards.index["split"].copy()
+                for i in np.flatnonzero(codes < 0):
+                    codes[i] = SPLITS.index(assign_split(self.shards.names[i]))
+                self.items = np.flatnonzero(codes == SPLITS.index(split))
+        else:
+            self.shards = None
+            with open(source) as f:
+                self.items = f.read().splitlines()
+
+    @classmethod
+    def from_data_path(cls, data_path: str, split: str, **kwargs):
+        """
+        Dataset of a split in the data folder. Uses the packed shards if they exist, otherwise the split list.
+
+        Parameters
+        ----------
+        data_path: str
+            Path to the data folder.
+        split: str
+            One of "train", "val" and "test".
+        kwargs
+            Passed on to StreamingDataset.
+
+        Returns
+        -------
+        dataset: StreamingDataset
+            Dataset of the split.
+        """
+        shards = os.path.join(data_path, "shards")
+        if os.path.exists(os.path.join(shards, "index.npy")):
+            return cls(shards, split=split, **kwargs)
+        return cls(os.path.join(data_path, f"{split}.txt"), **kwargs)
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch, which together with the seed decides the shuffle.
+
+        Parameters
+        ----------
+        epoch: int
+            Current epoch.
+        """
+        self.epoch = epoch
+
+    def order(self) -> np.ndarray:
+        """
+        Returns
+        -------
+        order: np.ndarray
+            Positions in self.items in the order of this epoch. The same on all ranks.
+        """
+        if self.shuffle:
+            return np.random.RandomState(self.seed + self.epoch).permutation(
+                len(self.items)
+            )
+        return np.arange(len(self.items))
+
+    def __len__(self) -> int:
+        """Number of samples this rank reads per epoch."""
+        return len(range(self.rank, len(self.items), self.world_size))
+
+    def __iter__(self):
+        """
+        Iterate over the sequences of this rank and DataLoader worker.
+        """
+        worker = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker is None else (worker.id, worker.num_workers)
+        )
+
+        # Strided by rank first, so a rank reads the same samples for any number of workers.
+        order = self.order()[self.rank :: self.world_size]  # noqa
+        for position in order[worker_id::num_workers]:
+            yield self[position]
+
+    def name(self, position) -> str:
+        """
+        Parameters
+        ----------
+        position: int
+            Position in self.items.
+
+        Returns
+        -------
+        name: str
+            Name of the sequence, the file name without extension for split lists.
+        """
+        item = self.items[position]
+        if self.shards is not None:
+            return self.shards.names[item]
+        return os.path.splitext(os.path.basename(item))[0]
+
+    def __getitem__(self, position) -> torch.Tensor:
+        """
+        Parameters
+        ----------
+        position: int
+            Position in self.items.
+
+        Returns
+        -------
+        tokens: torch.Tensor
+            The sequence as int64 tensor.
+        """
+        item = self.items[position]
+        if self.shards is not None:
+            tokens = self.shards[item]
+        else:
+            tokens = self.load(item)
+        if self.vocab is not None:
+            tokens = self.vocab.encode(tokens)
+        return torch.from_numpy(np.array(tokens, dtype=np.int64))
+
+
+def pad_collate(batch: list, pad: int = 0) -> torch.Tensor:
+    """
+    Pads a batch of sequences to the longest one.
+
+    Parameters
+    ----------
+    batch: list
+        List of 1D tensors.
+    pad: int
+        Padding token.
+
+    Returns
+    -------
+    batch: torch.Tensor
+        Tensor of shape (batch, longest sequence).
+    """
+    return pad_sequence(batch, batch_first=True, padding_value=pad)
+
+
+def make_loader(
+    dataset: IterableDataset,
+    batch_size: int = 32,
+    num_workers: int = 0,
+    prefetch_factor: int = 2,
+    pin_memory: bool = None,
+    collate_fn=pad_collate,
+) -> DataLoader:
+    """
+    DataLoader with prefetching workers and pinned memory.
+
+    Parameters
+    ----------
+    dataset: IterableDataset
+        Dataset to load.
+    batch_size: int
+        Number of sequences per batch.
+    num_workers: int
+        Number of worker processes loading batches.
+    prefetch_factor: int
+        Number of batches each worker loads ahead.
+    pin_memory: bool
+        Whether batches are copied to pinned memory for fast transfer to the GPU.
+        Defaults to True if CUDA is available.
+    collate_fn: callable
+        Function combining a list of sequences into a batch.
+
+    Returns
+    -------
+    loader: DataLoader
+        The DataLoader.
+    """
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+
+    kwargs = {"prefetch_factor": prefetch_factor} if num_workers > 0 else {}
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        collate_fn=collate_fn,
+        **kwargs,
+    )
+
+
+class Throughput:
+    """
+    Wraps an iterable of batches and measures how fast it produces samples.
+    """
+
+    def __init__(self, iterable):
+        """
+        Initialize the Throughput class.
+
+        Parameters
+        ----------
+        iterable: Iterable
+            Iterable of batches. The first dimension of a batch, or of its
+            tokens if it is a dict, is its number of samples.
+        """
+        self.iterable = iterable
+        self.samples = 0
+        self.batches = 0
+        self.wait = 0.0
+        self.start = None
+
+    def __len__(self) -> int:
+        """Number of batches of the wrapped iterable."""
+        return len(self.iterable)
+
+    def __iter__(self):
+        """
+        Iterate over the batches while counting samples and time spent waiting for them.
+        """
+        self.start = time.perf_counter()
+        iterator = iter(self.iterable)
+        while True:
+            before = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.wait += time.perf_counter() - before
+            self.samples += len(batch["tokens"] if isinstance(batch, dict) else batch)
+            self.batches += 1
+            yield batch
+
+    @property
+    def samples_per_second(self) -> float:
+        """
+        Returns
+        -------
+        rate: float
+            Samples produced per second since iteration started.
+        """
+        if self.start is None:
+            return 0.0
+        elapsed = time.perf_counter() - self.start
+        return self.samples / elapsed if elapsed > 0 else 0.0
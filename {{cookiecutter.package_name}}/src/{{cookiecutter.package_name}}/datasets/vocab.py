@@ -0,0 +1,342 @@
+"""
+Vocab
+=====
+Vocabulary of the tokens of the train split.
+
+Cleaned files hold token values, e.g. the events of model.render. A Vocab maps
+the values seen often enough in the train split to consecutive ids, so the
+embedding of the model only has rows for tokens it can learn. Other values map
+to the unknown id 0, which decodes to -1 and is ignored when rendering.
+
+Tokens are counted over chunks of the train split on a pool of processes.
+Every chunk gives a TokenCounts, which are merged as they finish. The
+vocabulary is cached in the data folder as vocab.npz, together with a
+fingerprint of the train split and the pruning parameters, and reused until
+either changes. Training saves the vocabulary next to the model, e.g.
+models/model.vocab.npz, which generation loads with model_vocab.
+"""
+
+import os
+from functools import partial
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+
+from {{cookiecutter.package_name}}.datasets.streaming import StreamingDataset
+from {{cookiecutter.package_name}}.preprocess.manifest import fingerprint
+from {{cookiecutter.package_name}}.preprocess.parallel import chunked, parallel_map
+
+VOCAB_FILE = "vocab.npz"
+UNKNOWN_ID = 0
+UNKNOWN_TOKEN = -1
+
+
+class TokenCounts(NamedTuple):
+    """
+    Number of occurrences of every token value, sorted by value.
+    """
+
+    tokens: np.ndarray
+    counts: np.ndarray
+
+    @classmethod
+    def of(cls, tokens) -> "TokenCounts":
+        """
+        Parameters
+        ----------
+        tokens: array_like
+            Token values.
+
+        Returns
+        -------
+        counts: TokenCounts
+            The counts of the values.
+        """
+        values, counts = np.unique(
+            np.asarray(tokens, dtype=np.int64).reshape(-1), return_counts=True
+        )
+        return cls(values, counts.astype(np.int64))
+
+    def merge(self, other: "TokenCounts") -> "TokenCounts":
+        """
+        Parameters
+        ----------
+        other: TokenCounts
+            Counts of other tokens.
+
+        Returns
+        -------
+        counts: TokenCounts
+            The counts of the tokens of both.
+        """
+        values, inverse = np.unique(
+            np.concatenate([self.tokens, other.tokens]), return_inverse=True
+        )
+        counts = np.zeros(len(values), dtype=np.int64)
+        np.add.at(counts, inverse, np.concatenate([self.counts, other.counts]))
+        return TokenCounts(values, counts)
+
+
+def count_tokens(load: Callable, items: list) -> TokenCounts:
+    """
+    Counts the tokens of a chunk of a split.
+
+    Parameters
+    ----------
+    load: Callable
+        Function loading the tokens of an item, e.g. load_csv or a ShardReader.
+    items: list
+        Items of the split, file names or sequence indices.
+
+    Returns
+    -------
+    counts: TokenCounts
+        The counts of the tokens of all items.
+    """
+    tokens = [np.asarray(load(item), dtype=np.int64).reshape(-1) for item in items]
+    return TokenCounts.of(np.concatenate(tokens) if tokens else [])
+
+
+class Vocab:
+    """
+    Array backed mapping between token values and ids.
+
+    Id 0 is the unknown token, the values follow sorted from id 1. Lookups are
+    binary searches over the sorted values, so they work on whole sequences at once.
+    """
+
+    def __init__(self, tokens, counts=None, source: str = ""):
+        """
+        Initialize the Vocab class.
+
+        Parameters
+        ----------
+        tokens: array_like
+            Distinct token values.
+        counts: array_like
+            Number of occurrences of every value in the train split.
+        source: str
+            Fingerprint of the split and parameters the vocabulary was built from.
+        """
+        tokens = np.asarray(tokens, dtype=np.int64)
+        counts = np.zeros(len(tokens), np.int64) if counts is None else counts
+        order = np.argsort(tokens, kind="stable")
+        self.tokens = tokens[order]
+        self.counts = np.asarray(counts, dtype=np.int64)[order]
+        self.source = source
+
+    def __len__(self) -> int:
+        """Number of ids, including the unknown id."""
+        return len(self.tokens) + 1
+
+    def encode(self, tokens) -> np.ndarray:
+        """
+        Parameters
+        ----------
+        tokens: array_like
+            Token values.
+
+        Returns
+        -------
+        ids: np.ndarray
+            Their ids, UNKNOWN_ID for values not in the vocabulary.
+        """
+        tokens = np.asarray(tokens, dtype=np.int64)
+        if len(self.tokens) == 0:
+            return np.full(tokens.shape, UNKNOWN_ID, dtype=np.int64)
+        positions = np.searchsorted(self.tokens, tokens)
+        positions = np.minimum(positions, len(self.tokens) - 1)
+        return np.where(self.tokens[positions] == tokens, positions + 1, UNKNOWN_ID)
+
+    def decode(self, ids) -> np.ndarray:
+        """
+        Parameters
+        ----------
+        ids: array_like
+            Token ids.
+
+        Returns
+        -------
+        tokens: np.ndarray
+            Their values, UNKNOWN_TOKEN for the unknown id.
+        """
+        table = np.concatenate([[UNKNOWN_TOKEN], self.tokens])
+        return table[np.asarray(ids, dtype=np.int64)]
+
+    @classmethod
+    def from_counts(
+        cls,
+        counts: TokenCounts,
+        min_freq: int = 1,
+        max_size: int = None,
+        source: str = "",
+    ) -> "Vocab":
+        """
+        Parameters
+        ----------
+        counts: TokenCounts
+            Counts of the tokens of the train split.
+        min_freq: int
+            Values occurring less often are left out.
+        max_size: int
+            Maximum number of ids, including the unknown id. The most frequent
+            values are kept. Defaults to no limit.
+        source: str
+            See Vocab.
+
+        Returns
+        -------
+        vocab: Vocab
+            The vocabulary.
+        """
+        keep = counts.counts >= min_freq
+        tokens, frequent = counts.tokens[keep], counts.counts[keep]
+        if max_size is not None and len(tokens) > max_size - 1:
+            # Most frequent first, ties broken by the smaller value.
+            order = np.lexsort((tokens, -frequent))[: max(max_size - 1, 0)]
+            tokens, frequent = tokens[order], frequent[order]
+        return cls(tokens, frequent, source)
+
+    def save(self, path: str) -> None:
+        """
+        Saves the vocabulary as npz file. The file is replaced atomically.
+
+        Parameters
+        ----------
+        path: str
+            Path to save to.
+        """
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(f, tokens=self.tokens, counts=self.counts, source=self.source)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "Vocab":
+        """
+        Parameters
+        ----------
+        path: str
+            Path to a file written by save.
+
+        Returns
+        -------
+        vocab: Vocab
+            The vocabulary.
+        """
+        with np.load(path) as data:
+            return cls(data["tokens"], data["counts"], str(data["source"]))
+
+
+def split_fingerprint(dataset: StreamingDataset) -> str:
+    """
+    Parameters
+    ----------
+    dataset: StreamingDataset
+        Dataset of a split.
+
+    Returns
+    -------
+    fingerprint: str
+        Fingerprint of the size and modification time of the files the split
+        is read from, which changes when the split is preprocessed again.
+    """
+    if dataset.shards is not None:
+        folder = dataset.shards.folder
+        paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))]
+        selection = dataset.items.tobytes()
+    else:
+        paths = [dataset.source, *dataset.items]
+        selection = b""
+    stats = [(path, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths]
+    return fingerprint(stats, selection)
+
+
+def build_vocab(
+    data_path: str,
+    min_freq: int = 1,
+    max_size: int = None,
+    workers: int = 1,
+    chunksize: int = 256,
+    cache: bool = True,
+) -> Vocab:
+    """
+    Builds the vocabulary of the train split, or loads it from the cache.
+
+    Parameters
+    ----------
+    data_path: str
+        Path to the data folder.
+    min_freq: int
+        Values occurring less often are left out.
+    max_size: int
+        Maximum number of ids, including the unknown id. Defaults to no limit.
+    workers: int
+        Number of processes counting tokens.
+    chunksize: int
+        Number of sequences counted per task.
+    cache: bool
+        If True, the vocabulary is read from and written to vocab.npz in the data folder.
+
+    Returns
+    -------
+    vocab: Vocab
+        The vocabulary.
+    """
+    dataset = StreamingDataset.from_data_path(data_path, "train", rank=0, world_size=1)
+    source = fingerprint(split_fingerprint(dataset), min_freq, max_size)
+    path = os.path.join(data_path, VOCAB_FILE)
+    if cache and os.path.exists(path):
+        vocab = Vocab.load(path)
+        if vocab.source == source:
+            return vocab
+
+    load = dataset.load if dataset.shards is None else dataset.shards.__getitem__
+    counts = TokenCounts.of([])
+    for result in parallel_map(
+        partial(count_tokens, load),
+        chunked(dataset.items, chunksize),
+        workers=workers,
+        chunksize=1,
+        ordered=False,
+    ):
+        if result.error is not None:
+            raise RuntimeError(
+                f"Failed to count the tokens of chunk {result.index}:\n{result.error}"
+            )
+        counts = counts.merge(result.value)
+
+    vocab = Vocab.from_counts(counts, min_freq, max_size, source)
+    if cache:
+        vocab.save(path)
+    return vocab
+
+
+def vocab_path(model_path: str) -> str:
+    """
+    Parameters
+    ----------
+    model_path: str
+        Path to a model saved by train, e.g. models/model.pt.
+
+    Returns
+    -------
+    path: str
+        Path of the vocabulary of the model, e.g. models/model.vocab.npz.
+    """
+    return f"{os.path.splitext(model_path)[0]}.vocab.npz"
+
+
+def model_vocab(model_path: str) -> Optional[Vocab]:
+    """
+    Parameters
+    ----------
+    model_path: str
+        Path to a model saved by train.
+
+    Returns
+    -------
+    vocab: Vocab or None
+        The vocabulary of the model. None for models trained on token values directly.
+    """
+    path = vocab_path(model_path)
+    return Vocab.load(path) if os.path.exists(path) else None
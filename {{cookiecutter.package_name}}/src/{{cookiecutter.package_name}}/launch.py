@@ -0,0 +1,143 @@
+"""
+Launch
+======
+Where this process runs in a job, read from the environment of the launcher.
+
+* SLURM: one task per process, started with srun. Rank and world size are
+  taken from SLURM_PROCID and SLURM_STEP_NUM_TASKS, the master is the first
+  node of SLURM_JOB_NODELIST. The batch script itself is a single process,
+  even if the job has more tasks.
+* torchrun: RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT.
+
+Without either, this is a single process. The module does not import torch,
+so the CLI can check the launch before it loads the stages.
+"""
+
+import os
+import re
+from typing import NamedTuple
+
+
+class DistributedContext(NamedTuple):
+    """
+    Place of this process in the job.
+
+    Parameters
+    ----------
+    rank: int
+        Rank of this process.
+    local_rank: int
+        Rank of this process on its node. Selects the GPU.
+    world_size: int
+        Number of processes.
+    master_addr: str
+        Host of rank 0.
+    master_port: int
+        Port rank 0 listens on.
+    """
+
+    rank: int = 0
+    local_rank: int = 0
+    world_size: int = 1
+    master_addr: str = "127.0.0.1"
+    master_port: int = 29500
+
+    @property
+    def is_main(self) -> bool:
+        """True on rank 0, which logs and saves."""
+        return self.rank == 0
+
+    @property
+    def is_distributed(self) -> bool:
+        """True if there is more than one process."""
+        return self.world_size > 1
+
+
+def first_host(nodelist: str) -> str:
+    """
+    First host of a compressed SLURM node list, e.g. "node[03-05,9],gpu1" gives "node03".
+
+    Parameters
+    ----------
+    nodelist: str
+        Value of SLURM_JOB_NODELIST.
+
+    Returns
+    -------
+    host: str
+        Name of the first node.
+    """
+    match = re.match(r"([^,\[]+)(?:\[([^\]]+)\])?", nodelist.strip())
+    if match is None:
+        raise ValueError(f"Cannot parse node list {nodelist!r}")
+    prefix, ranges = match.groups()
+    if ranges is None:
+        return prefix
+    return prefix + re.split(r"[,-]", ranges)[0]
+
+
+# Step ids of the batch script, the extern step and similar are at the top of the range.
+SPECIAL_STEPS = 0xFFFFFFF0
+
+
+def slurm_step_tasks(env=os.environ) -> int:
+    """
+    Parameters
+    ----------
+    env: Mapping
+        Environment of the process.
+
+    Returns
+    -------
+    tasks: int
+        Number of tasks of the job step started with srun this process belongs to.
+        0 outside of SLURM and in the batch script, where SLURM_NTASKS and
+        SLURM_PROCID are set as well but only one process runs.
+    """
+    if "SLURM_STEP_ID" not in env or "SLURM_PROCID" not in env:
+        return 0
+    if int(env["SLURM_STEP_ID"]) >= SPECIAL_STEPS:
+        return 0
+    return int(env.get("SLURM_STEP_NUM_TASKS", 1))
+
+
+def detect() -> DistributedContext:
+    """
+    Reads the place of this process from the environment of SLURM or torchrun.
+
+    SLURM is used for job steps started by srun with more than one task,
+    otherwise the variables of torchrun. MASTER_ADDR and MASTER_PORT override the values
+    derived from SLURM. The default port depends on the job id, so jobs
+    sharing a node do not collide.
+
+    Returns
+    -------
+    context: DistributedContext
+        Context of this process. A single process if neither launcher is found.
+    """
+    env = os.environ
+    tasks = slurm_step_tasks(env)
+    if tasks > 1:
+        job_id = env.get("SLURM_JOB_ID", "0")
+        return DistributedContext(
+            rank=int(env["SLURM_PROCID"]),
+            local_rank=int(env.get("SLURM_LOCALID", 0)),
+            world_size=tasks,
+            master_addr=env.get(
+                "MASTER_ADDR", first_host(env.get("SLURM_JOB_NODELIST", "127.0.0.1"))
+            ),
+            master_port=int(
+                env.get("MASTER_PORT", 20000 + int(job_id[-4:] or 0) % 10000)
+            ),
+        )
+
+    if "WORLD_SIZE" in env:
+        return DistributedContext(
+            rank=int(env.get("RANK", 0)),
+            local_rank=int(env.get("LOCAL_RANK", 0)),
+            world_size=int(env["WORLD_SIZE"]),
+            master_addr=env.get("MASTER_ADDR", "127.0.0.1"),
+            master_port=int(env.get("MASTER_PORT", 29500)),
+        )
+
+    return DistributedContext()
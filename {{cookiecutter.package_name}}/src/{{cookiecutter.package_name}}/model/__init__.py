@@ -4,16 +4,67 @@ Model related classes and functions used for training and generating.
 
 This submodule contains functions and classes from the following files:
 
+* checkpoint.py
+* distributed.py
+* generate.py
+* memory.py
+* metrics.py
+* optimize.py
+* render.py
+* scheduler.py
+* settings.py
 * train.py
 * transformer.py
 
 """
 
+from {{cookiecutter.package_name}}.model.checkpoint import Checkpointer
+from {{cookiecutter.package_name}}.model.distributed import (
+    DistributedContext,
+    cleanup_distributed,
+    setup_distributed,
+)
+from {{cookiecutter.package_name}}.model.generate import Generator, generate
+from {{cookiecutter.package_name}}.model.memory import MemoryEstimate, estimate_memory
+from {{cookiecutter.package_name}}.model.metrics import (
+    MetricsLogger,
+    plot_metrics,
+    read_metrics,
+)
+from {{cookiecutter.package_name}}.model.optimize import optimized_model, quantize
+from {{cookiecutter.package_name}}.model.render import MidiWriter, events_to_midi
+from {{cookiecutter.package_name}}.model.scheduler import Scheduler
+from {{cookiecutter.package_name}}.model.settings import ModelSettings
 from {{cookiecutter.package_name}}.model.train import train
-from {{cookiecutter.package_name}}.model.transformer import Transformer
+from {{cookiecutter.package_name}}.model.transformer import (
+    KVCache,
+    Transformer,
+    get_device,
+    load_model,
+)
 
 
 __all__ = [
+    "Checkpointer",
+    "DistributedContext",
+    "cleanup_distributed",
+    "estimate_memory",
+    "Generator",
+    "generate",
+    "get_device",
+    "KVCache",
+    "load_model",
+    "MemoryEstimate",
+    "MetricsLogger",
+    "MidiWriter",
+    "ModelSettings",
+    "events_to_midi",
+    "optimized_model",
+    "quantize",
+    "plot_metrics",
+    "read_metrics",
+    "Scheduler",
+    "setup_distributed",
     "train",
     "Transformer",
 ]
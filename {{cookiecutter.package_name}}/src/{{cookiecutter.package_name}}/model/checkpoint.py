@@ -0,0 +1,286 @@
+"""
+Checkpoint
+==========
+Asynchronous, atomic training checkpoints with a retention policy.
+
+Saving copies the state to host memory and writes it on a background
+thread, so training continues while the file is written. Files are written
+under a temporary name and renamed, so a preempted job never leaves a
+partial checkpoint behind. The first save waits for its write, so the time a
+checkpoint takes is known before a deadline depends on it.
+"""
+
+import os
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+import numpy as np
+import torch
+
+PATTERN = re.compile(
+    r"^checkpoint_step(?P<step>\d+)_(?P<time>\d{8}T\d{6})(?:_val(?P<loss>[\d.eE+-]+|nan|inf))?\.pt$"
+)
+
+
+class CheckpointFile(NamedTuple):
+    """
+    A checkpoint on disk, described by its name.
+
+    Parameters
+    ----------
+    path: str
+        Path to the file.
+    step: int
+        Optimizer step the checkpoint was taken at.
+    time: str
+        UTC time the checkpoint was taken at, as YYYYMMDDTHHMMSS.
+    val_loss: float or None
+        Validation loss of the checkpoint. None if taken within an epoch.
+    """
+
+    path: str
+    step: int
+    time: str
+    val_loss: Optional[float]
+
+
+def to_cpu(obj):
+    """
+    Copies all tensors in a nested structure of dicts, lists and tuples to host memory.
+
+    Parameters
+    ----------
+    obj
+        A tensor or a nested structure containing tensors.
+
+    Returns
+    -------
+    obj
+        The same structure with copies of the tensors, which training can no longer change.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state() -> dict:
+    """
+    Returns
+    -------
+    state: dict
+        State of the python, numpy, torch and CUDA random number generators.
+    """
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state: dict) -> None:
+    """
+    Restores the random number generators.
+
+    Parameters
+    ----------
+    state: dict
+        State returned by rng_state.
+    """
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class Checkpointer:
+    """
+    Writes checkpoints to a folder on a background thread and evicts old ones.
+
+    After every save only the keep_last newest checkpoints and the keep_best
+    checkpoints with the lowest validation loss are kept.
+    """
+
+    def __init__(self, folder: str, keep_last: int = 3, keep_best: int = 1):
+        """
+        Initialize the Checkpointer class.
+
+        Parameters
+        ----------
+        folder: str
+            Folder of the checkpoints. Created if it does not exist.
+        keep_last: int
+            Number of newest checkpoints kept.
+        keep_best: int
+            Number of checkpoints with the lowest validation loss kept.
+        """
+        self.folder = folder
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        # Longest write so far, the time reserved for the final checkpoint.
+        self.write_seconds = 0.0
+        self.written = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def checkpoints(self) -> list:
+        """
+        Returns
+        -------
+        checkpoints: list
+            CheckpointFile of every checkpoint in the folder, newest first.
+        """
+        found = []
+        for name in os.listdir(self.folder):
+            match = PATTERN.match(name)
+            if match is None:
+                continue
+            loss = match.group("loss")
+            found.append(
+                CheckpointFile(
+                    os.path.join(self.folder, name),
+                    int(match.group("step")),
+                    match.group("time"),
+                    None if loss is None else float(loss),
+                )
+            )
+        # At equal steps, the checkpoint of an epoch end is written after the one within the epoch.
+        return sorted(
+            found, key=lambda c: (c.step, c.time, c.val_loss is not None), reverse=True
+        )
+
+    def save(self, state: dict, step: int, val_loss: float = None) -> str:
+        """
+        Copies state to host memory and writes it in the background.
+
+        Waits for the previous checkpoint to be written first, so at most one
+        copy of the state is held in memory. The first checkpoint is written
+        before returning, so write_seconds is measured from then on.
+
+        Parameters
+        ----------
+        state: dict
+            State to save, e.g. model and optimizer state dicts.
+        step: int
+            Optimizer step of the state.
+        val_loss: float
+            Validation loss of the state, used by keep_best.
+
+        Returns
+        -------
+        path: str
+            Path the checkpoint is written to.
+        """
+        self.wait()
+        name = (
+            f"checkpoint_step{step:08d}_{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}"
+        )
+        if val_loss is not None:
+            name += f"_val{val_loss:.6g}"
+        path = os.path.join(self.folder, f"{name}.pt")
+        self.pending = self.executor.submit(self._write, to_cpu(state), path)
+        if not self.written:
+            self.wait()
+        return path
+
+    def _write(self, state: dict, path: str) -> None:
+        """
+        Writes state atomically to path and applies the retention policy.
+
+        Parameters
+        ----------
+        state: dict
+            State in host memory.
+        path: str
+            Path of the checkpoint.
+        """
+        start = time.perf_counter()
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.write_seconds = max(self.write_seconds, time.perf_counter() - start)
+        self.written += 1
+        self.evict()
+
+    def evict(self) -> list:
+        """
+        Removes the checkpoints the retention policy does not keep.
+
+        Returns
+        -------
+        removed: list
+            Paths of the removed checkpoints.
+        """
+        checkpoints = self.checkpoints()
+        keep = {c.path for c in checkpoints[: self.keep_last]}
+        scored = [c for c in checkpoints if c.val_loss is not None]
+        keep |= {
+            c.path for c in sorted(scored, key=lambda c: c.val_loss)[: self.keep_best]
+        }
+
+        removed = [c.path for c in checkpoints if c.path not in keep]
+        for path in removed:
+            os.remove(path)
+        return removed
+
+    def wait(self) -> None:
+        """
+        Waits until the pending checkpoint is written. Raises the error of the write if it failed.
+        """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def load_latest(self, map_location="cpu") -> Optional[dict]:
+        """
+        Loads the newest checkpoint that can be read. Unreadable checkpoints are skipped.
+
+        Parameters
+        ----------
+        map_location
+            Passed on to torch.load.
+
+        Returns
+        -------
+        state: dict or None
+            The state, or None if there is no readable checkpoint.
+        """
+        self.wait()
+        for checkpoint in self.checkpoints():
+            try:
+                state = torch.load(
+                    checkpoint.path, map_location=map_location, weights_only=False
+                )
+            except Exception as e:
+                print(f"Skipping unreadable checkpoint {checkpoint.path}: {e}")
+                continue
+            state["path"] = checkpoint.path
+            return state
+        return None
+
+    def close(self) -> None:
+        """
+        Waits for the pending checkpoint and stops the background thread.
+        """
+        self.wait()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        """Returns the checkpointer."""
+        return self
+
+    def __exit__(self, *exc) -> None:
+        """Waits for the pending checkpoint."""
+        self.close()
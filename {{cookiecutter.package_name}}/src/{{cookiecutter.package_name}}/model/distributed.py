@@ -0,0 +1,197 @@
+"""
+Distributed
+===========
+Data parallel training over several processes and nodes with torch.distributed.
+
+The process group is set up from the environment of the launcher, SLURM or
+torchrun, see launch.detect. Without either, training runs in a single
+process. NCCL is used on GPUs and gloo on CPUs, so several processes on one
+machine also work.
+"""
+
+import torch
+import torch.distributed as dist
+
+from {{cookiecutter.package_name}}.launch import DistributedContext, detect
+
+
+def setup_distributed(context: DistributedContext = None, backend: str = None):
+    """
+    Joins the process group of the job and selects the GPU of this process.
+
+    Parameters
+    ----------
+    context: DistributedContext
+        Place of this process. Defaults to detect.
+    backend: str
+        "nccl" or "gloo". Defaults to nccl if CUDA is available, otherwise gloo.
+
+    Returns
+    -------
+    context: DistributedContext
+        Context of this process.
+    """
+    context = detect() if context is None else context
+    if not context.is_distributed or initialized():
+        return context
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(context.local_rank % torch.cuda.device_count())
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+
+    dist.init_process_group(
+        backend,
+        init_method=f"tcp://{context.master_addr}:{context.master_port}",
+        rank=context.rank,
+        world_size=context.world_size,
+    )
+    return context
+
+
+def initialized() -> bool:
+    """
+    Returns
+    -------
+    initialized: bool
+        True if this process joined a process group.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def cleanup_distributed() -> None:
+    """
+    Leaves the process group if this process joined one.
+    """
+    if initialized():
+        dist.destroy_process_group()
+
+
+def is_main_process() -> bool:
+    """
+    Returns
+    -------
+    main: bool
+        True on rank 0 or if training is not distributed.
+    """
+    return not initialized() or dist.get_rank() == 0
+
+
+def print0(*args, **kwargs) -> None:
+    """
+    Prints on rank 0 only.
+
+    Parameters
+    ----------
+    args
+        Passed on to print.
+    kwargs
+        Passed on to print.
+    """
+    if is_main_process():
+        print(*args, **kwargs)
+
+
+REDUCE_OPS = {
+    "sum": dist.ReduceOp.SUM,
+    "min": dist.ReduceOp.MIN,
+    "max": dist.ReduceOp.MAX,
+}
+
+
+def all_reduce(*values: float, op: str = "sum") -> list:
+    """
+    Reduces numbers over all processes.
+
+    Parameters
+    ----------
+    values: float
+        Numbers of this process.
+    op: str
+        "sum", "min" or "max".
+
+    Returns
+    -------
+    reduced: list
+        Every number reduced over all processes. The numbers themselves if not distributed.
+    """
+    if not initialized():
+        return list(values)
+    device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=REDUCE_OPS[op])
+    return tensor.tolist()
+
+
+def any_process(flag: bool) -> bool:
+    """
+    Whether a flag is set on any process. Used so all processes stop together.
+
+    Parameters
+    ----------
+    flag: bool
+        Flag of this process.
+
+    Returns
+    -------
+    flag: bool
+        True if the flag is set on at least one process.
+    """
+    return all_reduce(float(flag), op="max")[0] > 0
+
+
+def gather_objects(obj) -> list:
+    """
+    Collects a picklable object from every process.
+
+    Parameters
+    ----------
+    obj
+        Object of this process.
+
+    Returns
+    -------
+    objects: list
+        The object of every process, indexed by rank.
+    """
+    if not initialized():
+        return [obj]
+    objects = [None] * dist.get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def broadcast_object(obj):
+    """
+    Sends a picklable object from rank 0 to every process.
+
+    Parameters
+    ----------
+    obj
+        Object of this process. Only the one of rank 0 is used.
+
+    Returns
+    -------
+    obj
+        The object of rank 0.
+    """
+    if not initialized():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def unwrap(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Parameters
+    ----------
+    model: torch.nn.Module
+        A model, possibly wrapped in DistributedDataParallel.
+
+    Returns
+    -------
+    model: torch.nn.Module
+        The wrapped model.
+    """
+    return model.module if hasattr(model, "module") else model
@@ -0,0 +1,284 @@
+"""
+Generate
+========
+Batched generation with a key/value cache and continuous batching.
+
+The engine keeps a fixed number of slots decoding together. Every step feeds
+only the newest token of every slot, the earlier tokens are read from the
+KVCache, so a step does not recompute the prefix. When a sequence finishes
+its slot is refilled with the next prompt right away instead of waiting for
+the whole batch, so the batch stays full until the prompts run out.
+"""
+
+import re
+import time
+from typing import Iterable, Iterator
+
+import torch
+
+from {{cookiecutter.package_name}}.datasets import StreamingDataset, model_vocab
+from {{cookiecutter.package_name}}.model.optimize import optimized_model
+from {{cookiecutter.package_name}}.model.render import MidiWriter
+from {{cookiecutter.package_name}}.model.transformer import KVCache, get_device
+
+
+def sample(
+    logits: torch.Tensor, temperature: float = 1.0, top_k: int = None
+) -> torch.Tensor:
+    """
+    Parameters
+    ----------
+    logits: torch.Tensor
+        Next token logits of shape (batch, vocab_size).
+    temperature: float
+        Sampling temperature. 0 picks the most likely token.
+    top_k: int
+        If given, only the top_k most likely tokens are sampled.
+
+    Returns
+    -------
+    tokens: torch.Tensor
+        One token per row.
+    """
+    if temperature <= 0:
+        return logits.argmax(-1)
+    logits = logits.float() / temperature
+    if top_k is not None:
+        kth = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    return torch.multinomial(torch.softmax(logits, dim=-1), 1).squeeze(-1)
+
+
+class Generator:
+    """
+    Continues many prompts at once with a key/value cache and continuous batching.
+    """
+
+    def __init__(
+        self,
+        model,
+        slots: int = 32,
+        max_new_tokens: int = 256,
+        temperature: float = 1.0,
+        top_k: int = None,
+        eos: int = None,
+    ):
+        """
+        Initialize the Generator class.
+
+        Parameters
+        ----------
+        model: TransformerModel
+            The model.
+        slots: int
+            Number of sequences decoded together.
+        max_new_tokens: int
+            Maximum number of tokens generated per prompt.
+        temperature: float
+            Sampling temperature, see sample.
+        top_k: int
+            Number of most likely tokens sampled from, see sample.
+        eos: int
+            Token that ends a sequence. Defaults to none.
+        """
+        self.model = model
+        self.slots = slots
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.eos = eos
+        self.tokens = 0
+        self.sequences = 0
+        self.seconds = 0.0
+
+    @property
+    def tokens_per_second(self) -> float:
+        """Generated tokens per second so far."""
+        return self.tokens / max(self.seconds, 1e-9)
+
+    @torch.inference_mode()
+    def run(self, prompts: Iterable) -> Iterator[tuple]:
+        """
+        Generates continuations of prompts.
+
+        Prompts are truncated to their last tokens, so prompt and continuation
+        fit into the context of the model.
+
+        Parameters
+        ----------
+        prompts: Iterable
+            Pairs of a key, e.g. a name, and a 1D tensor of prompt tokens.
+
+        Yields
+        ------
+        key
+            Key of the prompt.
+        tokens: torch.Tensor
+            The generated tokens, without the prompt. Sequences are yielded as
+            they finish, which is not necessarily the order of the prompts.
+        """
+        self.model.eval()
+        cache = KVCache(self.model, self.slots)
+        limit = self.model.context - self.max_new_tokens
+        if limit < 1:
+            raise ValueError(
+                f"max_new_tokens must be below the context of {self.model.context}"
+            )
+        prompts = iter(prompts)
+        keys = [None] * self.slots
+        outputs = [[] for _ in range(self.slots)]
+        device = get_device()
+        following = torch.zeros(self.slots, dtype=torch.long, device=device)
+        free = list(range(self.slots))
+        active = []
+
+        start = time.perf_counter()
+        try:
+            while True:
+                # Refill free slots. Prompts have different lengths, so every prompt is run on its own.
+                while free:
+                    prompt = next(prompts, None)
+                    if prompt is None:
+                        break
+                    slot = free.pop()
+                    keys[slot], tokens = prompt
+                    tokens = tokens[-limit:].to(device)
+                    cache.reset([slot])
+                    logits = self.model(tokens[None], cache=cache, rows=[slot])
+                    following[slot] = sample(
+                        logits[:, -1], self.temperature, self.top_k
+                    )[0]
+                    outputs[slot] = []
+                    active.append(slot)
+                if not active:
+                    return
+
+                # Every sampled token is recorded before it is fed, so finished slots skip the last step.
+                finished = []
+                for slot, token in zip(active, following[active].tolist()):
+                    outputs[slot].append(token)
+                    if len(outputs[slot]) >= self.max_new_tokens or token == self.eos:
+                        finished.append(slot)
+                self.tokens += len(active)
+                for slot in finished:
+                    active.remove(slot)
+                    free.append(slot)
+                    self.sequences += 1
+                    self.seconds = time.perf_counter() - start
+                    yield keys[slot], torch.tensor(outputs[slot], dtype=torch.long)
+                if not active:
+                    continue
+
+                rows = torch.tensor(active, device=device)
+                logits = self.model(following[rows, None], cache=cache, rows=active)
+                following[rows] = sample(logits[:, -1], self.temperature, self.top_k)
+        finally:
+            self.seconds = time.perf_counter() - start
+
+
+def generate(
+    data_path: str,
+    model_path: str,
+    output_path: str,
+    max_gen: int = 1000,
+    slots: int = 32,
+    max_new_tokens: int = 256,
+    prompt_tokens: int = 64,
+    temperature: float = 1.0,
+    top_k: int = None,
+    heads: int = None,
+    workers: int = 1,
+    queue_size: int = 64,
+    quantize: bool = False,
+    compile: bool = False,
+    threads: int = None,
+    tolerance: float = 0.02,
+) -> int:
+    """
+    Continues the beginnings of test set sequences with a trained model.
+
+    Models trained with a vocabulary get prompts encoded with it and their
+    output decoded, see datasets.vocab.
+
+    Parameters
+    ----------
+    data_path: str
+        Path to the data folder with the test split.
+    model_path: str
+        Path to the model saved by train.
+    output_path: str
+        Folder the samples are written to, one MIDI file per sample named after
+        its position and its test sequence. Samples whose file exists, e.g.
+        from an interrupted run, are skipped.
+    max_gen: int
+        Maximum number of samples.
+    slots: int
+        Number of samples decoded together.
+    max_new_tokens: int
+        Number of tokens generated per sample.
+    prompt_tokens: int
+        Number of tokens of a test sequence used as prompt.
+    temperature: float
+        Sampling temperature. 0 picks the most likely token.
+    top_k: int
+        If given, only the top_k most likely tokens are sampled.
+    heads: int
+        Only for models saved without settings, see load_model.
+    workers: int
+        Number of worker processes rendering MIDI files while the model decodes.
+        0 renders in this process.
+    queue_size: int
+        Maximum number of samples waiting to be rendered.
+    quantize: bool
+        If True, the model is quantized to int8 on CPUs, unless that worsens the
+        validation perplexity by more than tolerance. See model.optimize.
+    compile: bool
+        If True, the model is partly compiled with torch.compile.
+    threads: int
+        Number of threads of torch. Defaults to the CPUs available to the job.
+    tolerance: float
+        Allowed relative increase of the validation perplexity by quantization.
+
+    Returns
+    -------
+    samples: int
+        Number of generated samples.
+    """
+    model = optimized_model(
+        model_path, data_path, quantize, compile, threads, tolerance, heads
+    )
+    vocab = model_vocab(model_path)
+    test_data = StreamingDataset.from_data_path(
+        data_path, "test", rank=0, world_size=1, vocab=vocab
+    )
+    count = min(max_gen, len(test_data))
+    print(f"Generating {count} samples with {slots} slots on {get_device()}")
+    writer = MidiWriter(output_path, workers=workers, queue_size=queue_size)
+    skipped = 0
+
+    def prompts() -> Iterator[tuple]:
+        """Names and prompts of the test sequences without a MIDI file yet."""
+        nonlocal skipped
+        for position in range(count):
+            name = re.sub(r"[^\w.-]", "_", test_data.name(position))
+            name = f"{position:06d}_{name}"
+            if writer.exists(name):
+                skipped += 1
+                continue
+            tokens = test_data[position]
+            if len(tokens):
+                yield name, tokens[:prompt_tokens]
+
+    generator = Generator(model, slots, max_new_tokens, temperature, top_k)
+    with writer:
+        for name, tokens in generator.run(prompts()):
+            tokens = tokens.cpu().numpy()
+            writer.write(name, tokens if vocab is None else vocab.decode(tokens))
+
+    print(
+        f"Generated {generator.sequences} samples and {generator.tokens} tokens "
+        f"in {generator.seconds:.1f}s, {generator.tokens_per_second:.1f} tokens/s"
+    )
+    if skipped:
+        print(f"Skipped {skipped} samples written by an earlier run")
+    return generator.sequences
@@ -0,0 +1,167 @@
+"""
+Memory
+======
+Estimates the peak memory of training a configuration, before a job is submitted.
+
+The estimate adds up
+
+* the fp32 weights, their gradients and the two AdamW moments,
+* the activations kept for the backward pass, per block and token,
+* the logits and the fp32 copies of them made by the loss.
+
+Activations are counted from the layers of model.transformer. With
+attention="math" every block keeps attention weights of shape (context,
+context) per head, which is what limits long contexts. With "sdpa" these are
+not kept, assuming a memory efficient kernel is used. With checkpointing only
+the inputs of the blocks are kept, plus the activations of the one block that
+is recomputed at a time. Allocator overhead and the CUDA context are not
+included, so leave some headroom.
+"""
+
+from typing import NamedTuple
+
+from {{cookiecutter.package_name}}.model.settings import ModelSettings
+
+BYTES = {"fp32": 4, "bf16": 2, "fp16": 2}
+GIB = 1024**3
+
+
+class MemoryEstimate(NamedTuple):
+    """
+    Estimated peak memory of training, in bytes.
+    """
+
+    parameters: int
+    weights: int
+    gradients: int
+    optimizer: int
+    activations: int
+    logits: int
+
+    @property
+    def total(self) -> int:
+        """Estimated peak memory in bytes."""
+        return (
+            self.weights
+            + self.gradients
+            + self.optimizer
+            + self.activations
+            + self.logits
+        )
+
+    def describe(self) -> str:
+        """
+        Returns
+        -------
+        description: str
+            The estimate in GiB, one line per part.
+        """
+        lines = [f"Parameters: {self.parameters:,}"]
+        for name in ("weights", "gradients", "optimizer", "activations", "logits"):
+            lines.append(f"{name.capitalize()}: {getattr(self, name) / GIB:.2f} GiB")
+        lines.append(f"Total: {self.total / GIB:.2f} GiB")
+        return "\n".join(lines)
+
+
+def count_parameters(settings: ModelSettings, vocab_size: int) -> int:
+    """
+    Parameters
+    ----------
+    settings: ModelSettings
+        Architecture of the model.
+    vocab_size: int
+        Number of tokens.
+
+    Returns
+    -------
+    parameters: int
+        Number of parameters of the TransformerModel. The output layer shares the token embedding.
+    """
+    dim, hidden = settings.dim, settings.mlp_ratio * settings.dim
+    block = (
+        2 * 2 * dim  # layer norms
+        + 3 * dim * dim
+        + 3 * dim  # qkv
+        + dim * dim
+        + dim  # proj
+        + dim * hidden
+        + hidden
+        + hidden * dim
+        + dim  # mlp
+    )
+    return (vocab_size + settings.context) * dim + settings.layers * block + 2 * dim
+
+
+def block_activations(settings: ModelSettings, precision: str = "fp32") -> int:
+    """
+    Parameters
+    ----------
+    settings: ModelSettings
+        Architecture of the model.
+    precision: str
+        "fp32", "bf16" or "fp16", the type of the activations under autocast.
+
+    Returns
+    -------
+    bytes: int
+        Bytes a block keeps for the backward pass per token.
+    """
+    size = BYTES[precision]
+    dim, hidden = settings.dim, settings.mlp_ratio * settings.dim
+    # The residual stream and layer norms stay in fp32.
+    kept = 4 * dim * 3
+    # Inputs of the linear layers, qkv, attention output and dropout masks.
+    kept += size * (dim + 3 * dim + dim + dim + hidden + hidden) + 2 * dim
+    if settings.attention == "math":
+        # fp32 scores and softmax, weights in the activation type and the dropout mask.
+        kept += settings.heads * settings.context * (4 + 4 + size + 1)
+    else:
+        # Log-sum-exp of every query.
+        kept += settings.heads * 4
+    return kept
+
+
+def estimate_memory(
+    settings: ModelSettings,
+    vocab_size: int = 512,
+    batch_size: int = 32,
+    precision: str = "fp32",
+) -> MemoryEstimate:
+    """
+    Estimates the peak memory of a training step on one device.
+
+    Parameters
+    ----------
+    settings: ModelSettings
+        Architecture of the model.
+    vocab_size: int
+        Number of tokens.
+    batch_size: int
+        Number of sequences per batch. Batches are assumed to fill the context.
+    precision: str
+        "fp32", "bf16" or "fp16".
+
+    Returns
+    -------
+    estimate: MemoryEstimate
+        The estimate.
+    """
+    parameters = count_parameters(settings, vocab_size)
+    tokens = batch_size * settings.context
+    per_block = block_activations(settings, precision)
+    if settings.checkpointing:
+        kept = settings.layers * 4 * settings.dim + per_block
+    else:
+        kept = settings.layers * per_block
+    # Embeddings and final layer norm.
+    kept += 4 * settings.dim * 3
+    # Logits, their fp32 copy and the log-softmax kept by cross entropy.
+    logits = tokens * vocab_size * (BYTES[precision] + 4 + 4)
+    return MemoryEstimate(
+        parameters=parameters,
+        weights=4 * parameters,
+        gradients=4 * parameters,
+        optimizer=2 * 4 * parameters,
+        activations=tokens * kept,
+        logits=logits,
+    )
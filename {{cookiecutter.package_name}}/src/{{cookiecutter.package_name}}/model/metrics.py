@@ -0,0 +1,322 @@
+"""
+Metrics
+=======
+Buffered logging of training metrics to CSV or JSONL and reading them back for plotting.
+
+Records are kept in memory and appended to the file in one write when the
+buffer is full or flush_seconds passed, so many ranks logging every few
+steps do not load a shared filesystem.
+
+pandas and altair are only imported to read and plot metrics, so training does
+not pay for them.
+"""
+
+import csv
+import glob
+import json
+import os
+import re
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+
+import torch
+
+if TYPE_CHECKING:
+    import altair as alt
+    import pandas as pd
+
+FIELDS = [
+    "time",
+    "kind",
+    "epoch",
+    "step",
+    "train_loss",
+    "train_ppl",
+    "val_loss",
+    "val_ppl",
+    "tokens",
+    "tokens_per_s",
+    "samples_per_s",
+    "data_wait",
+    "padding_efficiency",
+    "rss_mb",
+    "accelerator_mb",
+]
+
+
+def memory_stats() -> dict:
+    """
+    Returns
+    -------
+    stats: dict
+        rss_mb, the peak resident memory of this process, and accelerator_mb,
+        the peak memory allocated on the current GPU, in MiB. accelerator_mb
+        is 0 without a GPU.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere.
+    rss_mb = rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+    accelerator_mb = (
+        torch.cuda.max_memory_allocated() / 2**20
+        if torch.cuda.is_available()
+        else 0.0
+    )
+    return {"rss_mb": round(rss_mb, 1), "accelerator_mb": round(accelerator_mb, 1)}
+
+
+def metrics_format(path: str) -> str:
+    """
+    Parameters
+    ----------
+    path: str
+        Path to a metrics file.
+
+    Returns
+    -------
+    format: str
+        "jsonl" for .jsonl and .json files, otherwise "csv".
+    """
+    return "jsonl" if path.endswith((".jsonl", ".json")) else "csv"
+
+
+def upgrade_csv(path: str) -> list:
+    """
+    Rewrites a CSV metrics file with a header other than FIELDS, e.g. from an
+    older version, so records with the current fields can be appended to it.
+
+    Parameters
+    ----------
+    path: str
+        Path to an existing CSV metrics file.
+
+    Returns
+    -------
+    fields: list
+        Columns of the file. FIELDS followed by columns only the old file has.
+    """
+    with open(path, newline="") as f:
+        header = next(csv.reader(f), [])
+    if header == FIELDS or not header:
+        return FIELDS
+
+    fields = FIELDS + [name for name in header if name not in FIELDS]
+    with open(path, newline="") as f, open(f"{path}.tmp", "w", newline="") as out:
+        writer = csv.DictWriter(out, fieldnames=fields)
+        writer.writeheader()
+        for row in csv.DictReader(f):
+            # Logs written before the kind column existed hold one record per epoch.
+            row.setdefault("kind", "epoch")
+            writer.writerow(row)
+    os.replace(f"{path}.tmp", path)
+    return fields
+
+
+def rank_path(path: str, rank: int) -> str:
+    """
+    Parameters
+    ----------
+    path: str
+        Path to a metrics file, e.g. log.csv.
+    rank: int
+        Rank of a process.
+
+    Returns
+    -------
+    path: str
+        Path of the metrics file of the rank, e.g. log.rank3.csv.
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.rank{rank}{ext}"
+
+
+class MetricsLogger:
+    """
+    Buffers metric records and appends them to a CSV or JSONL file.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        rank: int = 0,
+        per_rank: bool = False,
+        append: bool = False,
+        flush_seconds: float = 30.0,
+        flush_records: int = 256,
+    ):
+        """
+        Initialize the MetricsLogger class.
+
+        Parameters
+        ----------
+        path: str
+            Path to the metrics file. The format follows the extension, see metrics_format.
+        rank: int
+            Rank of this process.
+        per_rank: bool
+            If True, every rank writes its own file, see rank_path.
+            Otherwise only rank 0 writes and logging on other ranks does nothing.
+        append: bool
+            If True, records are appended to an existing file, e.g. when resuming.
+            A CSV file with other columns is rewritten first, see upgrade_csv.
+            Otherwise the file is replaced.
+        flush_seconds: float
+            Maximum seconds records are buffered.
+        flush_records: int
+            Maximum number of buffered records.
+        """
+        self.path = rank_path(path, rank) if per_rank else path
+        self.format = metrics_format(path)
+        self.enabled = per_rank or rank == 0
+        self.rank = rank
+        self.flush_seconds = flush_seconds
+        self.flush_records = flush_records
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.fields = FIELDS
+
+        if self.enabled and os.path.exists(self.path):
+            if not append:
+                os.remove(self.path)
+            elif self.format == "csv":
+                self.fields = upgrade_csv(self.path)
+
+    def log(self, kind: str = "step", **values) -> None:
+        """
+        Adds a record and flushes the buffer if it is due.
+
+        Parameters
+        ----------
+        kind: str
+            Kind of the record, e.g. "step" or "epoch".
+        values
+            The metrics. CSV files keep the columns in FIELDS, JSONL files all of them.
+        """
+        if not self.enabled:
+            return
+        self.buffer.append(
+            {
+                "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "kind": kind,
+                **values,
+            }
+        )
+        if (
+            len(self.buffer) >= self.flush_records
+            or time.monotonic() - self.last_flush >= self.flush_seconds
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Appends the buffered records to the file in a single write.
+        """
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        records, self.buffer = self.buffer, []
+
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", newline="") as f:
+            if self.format == "jsonl":
+                f.write("".join(json.dumps(r) + "\n" for r in records))
+                return
+            writer = csv.DictWriter(f, fieldnames=self.fields, extrasaction="ignore")
+            if new:
+                writer.writeheader()
+            writer.writerows(records)
+
+    def close(self) -> None:
+        """
+        Flushes the remaining records.
+        """
+        self.flush()
+
+    def __enter__(self):
+        """Returns the logger."""
+        return self
+
+    def __exit__(self, *exc) -> None:
+        """Flushes the remaining records."""
+        self.close()
+
+
+def read_metrics(path: str, kind: str = None) -> "pd.DataFrame":
+    """
+    Reads a metrics file, or the per rank files of it, into a DataFrame.
+
+    Parameters
+    ----------
+    path: str
+        Path to the metrics file as passed to MetricsLogger.
+    kind: str
+        Only records of this kind, e.g. "step" or "epoch". Defaults to all.
+
+    Returns
+    -------
+    metrics: pd.DataFrame
+        One row per record with a rank column. time is parsed as datetime.
+    """
+    import pandas as pd
+
+    root, ext = os.path.splitext(path)
+    paths = {0: path} if os.path.exists(path) else {}
+    for rank_file in glob.glob(f"{glob.escape(root)}.rank*{ext}"):
+        match = re.search(r"\.rank(\d+)" + re.escape(ext) + "$", rank_file)
+        if match:
+            paths[int(match.group(1))] = rank_file
+    if not paths:
+        raise FileNotFoundError(f"No metrics found at {path}")
+
+    frames = []
+    for rank, file in sorted(paths.items()):
+        if metrics_format(file) == "jsonl":
+            frame = pd.read_json(file, lines=True, convert_dates=False)
+        else:
+            frame = pd.read_csv(file)
+        frames.append(frame.assign(rank=rank))
+
+    metrics = pd.concat(frames, ignore_index=True)
+    # Logs written before the kind column existed hold one record per epoch.
+    if "kind" not in metrics:
+        metrics["kind"] = "epoch"
+    metrics["time"] = pd.to_datetime(metrics["time"], format="mixed", utc=True)
+    if kind is not None:
+        metrics = metrics[metrics["kind"] == kind].reset_index(drop=True)
+    return metrics
+
+
+def plot_metrics(
+    metrics: "pd.DataFrame", y: str = "train_loss", x: str = "step"
+) -> "alt.Chart":
+    """
+    Line chart of a metric, one line per rank.
+
+    Parameters
+    ----------
+    metrics: pd.DataFrame
+        Metrics returned by read_metrics.
+    y: str
+        Metric to plot.
+    x: str
+        Column on the x axis, e.g. "step", "epoch" or "time".
+
+    Returns
+    -------
+    chart: alt.Chart
+        The chart. Save it with chart.save("chart.html").
+    """
+    import altair as alt
+
+    data = metrics.dropna(subset=[y])
+    return (
+        alt.Chart(data)
+        .mark_line()
+        .encode(x=x, y=y, color="rank:N", tooltip=[x, y, "rank"])
+        .interactive()
+    )
@@ -0,0 +1,232 @@
+"""
+Optimize
+========
+Faster CPU inference for generation.
+
+* Dynamic int8 quantization stores the weights of the linear layers as int8
+  and quantizes activations on the fly. The quantized weights are cached next
+  to the model, e.g. models/model.int8.pt, together with the result of the
+  accuracy check, and rebuilt when the model changes. The check is repeated
+  when the validation split changes, or was skipped and data is given now.
+* torch.compile compiles the feed forward layers of the blocks. Attention
+  reads the KVCache, whose length changes every step, and stays eager.
+* The number of threads follows the CPUs available to the job instead of all
+  CPUs of the node.
+
+The accuracy check compares the perplexity of the quantized model with the
+fp32 model on the validation split. If it is worse by more than the tolerance,
+the fp32 model is used.
+"""
+
+import math
+import os
+from itertools import islice
+
+import torch
+from torch import nn
+
+from {{cookiecutter.package_name}}.datasets import (
+    StreamingDataset,
+    make_batches,
+    model_vocab,
+    split_fingerprint,
+)
+from {{cookiecutter.package_name}}.model.train import evaluate
+from {{cookiecutter.package_name}}.model.transformer import load_model
+from {{cookiecutter.package_name}}.preprocess.manifest import file_hash
+from {{cookiecutter.package_name}}.preprocess.parallel import available_cpus
+
+
+def set_threads(threads: int = None) -> int:
+    """
+    Sets the number of threads torch uses for intra op parallelism.
+
+    Parameters
+    ----------
+    threads: int
+        Number of threads. Defaults to the CPUs available to the job, see available_cpus.
+
+    Returns
+    -------
+    threads: int
+        The number of threads.
+    """
+    threads = threads or available_cpus()
+    torch.set_num_threads(threads)
+    return threads
+
+
+def quantize(model: nn.Module) -> nn.Module:
+    """
+    Parameters
+    ----------
+    model: nn.Module
+        A model on the CPU.
+
+    Returns
+    -------
+    model: nn.Module
+        Copy of the model with dynamically int8 quantized linear layers.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def compile_blocks(model: nn.Module) -> nn.Module:
+    """
+    Compiles the feed forward layers of the transformer blocks with torch.compile.
+
+    Parameters
+    ----------
+    model: nn.Module
+        A TransformerModel, possibly quantized.
+
+    Returns
+    -------
+    model: nn.Module
+        The model, changed in place. Compilation happens on the first calls.
+    """
+    for block in model.blocks:
+        block.mlp = torch.compile(block.mlp, dynamic=True)
+    return model
+
+
+def perplexity(
+    model: nn.Module,
+    data_path: str,
+    batch_size: int = 32,
+    max_batches: int = 50,
+    vocab=None,
+) -> float:
+    """
+    Parameters
+    ----------
+    model: nn.Module
+        The model.
+    data_path: str
+        Path to the data folder with the validation split.
+    batch_size: int
+        Number of sequences per batch.
+    max_batches: int
+        Number of batches evaluated, from the start of the split.
+    vocab: Vocab
+        Vocabulary of the model, if it was trained with one.
+
+    Returns
+    -------
+    perplexity: float
+        Perplexity on the validation split, or nan if it is empty.
+    """
+    val_data = StreamingDataset.from_data_path(
+        data_path, "val", rank=0, world_size=1, vocab=vocab
+    )
+    if len(val_data) == 0:
+        return math.nan
+    batches = make_batches(
+        val_data, batching="pad", batch_size=batch_size, context=model.context
+    )
+    return math.exp(evaluate(model, islice(batches, max_batches)))
+
+
+def quantized_path(model_path: str) -> str:
+    """
+    Parameters
+    ----------
+    model_path: str
+        Path to a model saved by train, e.g. models/model.pt.
+
+    Returns
+    -------
+    path: str
+        Path of its cached quantized weights, e.g. models/model.int8.pt.
+    """
+    root, ext = os.path.splitext(model_path)
+    return f"{root}.int8{ext}"
+
+
+def optimized_model(
+    model_path: str,
+    data_path: str = None,
+    quantize_int8: bool = True,
+    compile: bool = False,
+    threads: int = None,
+    tolerance: float = 0.02,
+    heads: int = None,
+) -> nn.Module:
+    """
+    Loads a trained model for CPU inference.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model saved by train.
+    data_path: str
+        Path to the data folder used for the accuracy check. Without it the check is skipped.
+    quantize_int8: bool
+        If True, the linear layers are quantized to int8, see quantize. Only on CPU.
+    compile: bool
+        If True, the blocks are compiled, see compile_blocks.
+    threads: int
+        Number of threads, see set_threads.
+    tolerance: float
+        Allowed relative increase of the validation perplexity by quantization.
+    heads: int
+        Only for models saved without settings, see load_model.
+
+    Returns
+    -------
+    model: nn.Module
+        The model in evaluation mode.
+    """
+    print(f"Using {set_threads(threads)} threads")
+    model = load_model(model_path, heads=heads)
+    on_cpu = model.token_embedding.weight.device.type == "cpu"
+
+    if quantize_int8 and on_cpu:
+        path = quantized_path(model_path)
+        source = file_hash(model_path)
+        data = None
+        if data_path:
+            val_data = StreamingDataset.from_data_path(
+                data_path, "val", rank=0, world_size=1
+            )
+            data = split_fingerprint(val_data)
+        cached = torch.load(path, weights_only=False) if os.path.exists(path) else None
+        quantized = quantize(model)
+        scores = None
+        if cached is not None and cached["source"] == source:
+            print(f"Using cached int8 model {path}")
+            quantized.load_state_dict(cached["model"])
+            # Without data the cached check is the best there is.
+            if data is None or cached.get("data") == data:
+                scores = cached["perplexity"]
+        if scores is None:
+            vocab = model_vocab(model_path)
+            scores = {
+                name: perplexity(m, data_path, vocab=vocab) if data_path else math.nan
+                for name, m in (("fp32", model), ("int8", quantized))
+            }
+            torch.save(
+                {
+                    "source": source,
+                    "data": data,
+                    "model": quantized.state_dict(),
+                    "perplexity": scores,
+                },
+                path,
+            )
+        if math.isnan(scores["fp32"]):
+            print("No validation data, using the int8 model without accuracy check")
+        else:
+            print(
+                f"Validation perplexity fp32 {scores['fp32']:.4f}, int8 {scores['int8']:.4f}"
+            )
+        if not scores["int8"] > scores["fp32"] * (1 + tolerance):
+            model = quantized
+        else:
+            print(
+                f"int8 perplexity is more than {tolerance:.0%} worse, using the fp32 model"
+            )
+
+    if compile:
+        model = compile_blocks(model)
+    return model.eval()
@@ -0,0 +1,216 @@
+"""
+Render
+======
+Turns generated event tokens into MIDI files on a pool of worker processes.
+
+Tokens follow the event vocabulary of performance models:
+
+* 0-127 note on of a pitch,
+* 128-255 note off of a pitch,
+* 256-355 time shift of 10 ms to 1 s,
+* 356-387 velocity of the following notes in 32 bins.
+
+Other tokens are ignored. Rendering with mido is pure Python, so it runs in
+worker processes while the model keeps decoding. At most queue_size sequences
+wait for a worker, which caps the memory held by the queue.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import mido
+import numpy as np
+
+NOTE_ON = 0
+NOTE_OFF = 128
+TIME_SHIFT = 256
+VELOCITY = 356
+VOCAB_SIZE = 388
+SHIFT_SECONDS = 0.01
+VELOCITY_BINS = 32
+
+
+def events_to_midi(
+    tokens, ticks_per_beat: int = 480, tempo: int = 500000
+) -> mido.MidiFile:
+    """
+    Parameters
+    ----------
+    tokens: array_like
+        Event tokens.
+    ticks_per_beat: int
+        Resolution of the MIDI file.
+    tempo: int
+        Microseconds per beat.
+
+    Returns
+    -------
+    midi: mido.MidiFile
+        Single track MIDI file of the events. Notes still on at the end are turned off.
+    """
+    track = mido.MidiTrack([mido.MetaMessage("set_tempo", tempo=tempo, time=0)])
+    seconds, last_tick, velocity = 0.0, 0, 64
+    sounding = set()
+
+    def add(kind: str, note: int, note_velocity: int) -> None:
+        """Appends a message at the current time."""
+        nonlocal last_tick
+        tick = round(mido.second2tick(seconds, ticks_per_beat, tempo))
+        track.append(
+            mido.Message(kind, note=note, velocity=note_velocity, time=tick - last_tick)
+        )
+        last_tick = tick
+
+    for token in np.asarray(tokens).tolist():
+        if NOTE_ON <= token < NOTE_OFF:
+            add("note_on", token - NOTE_ON, velocity)
+            sounding.add(token - NOTE_ON)
+        elif NOTE_OFF <= token < TIME_SHIFT:
+            if token - NOTE_OFF in sounding:
+                add("note_off", token - NOTE_OFF, 0)
+                sounding.discard(token - NOTE_OFF)
+        elif TIME_SHIFT <= token < VELOCITY:
+            seconds += (token - TIME_SHIFT + 1) * SHIFT_SECONDS
+        elif VELOCITY <= token < VOCAB_SIZE:
+            bin_size = 128 // VELOCITY_BINS
+            velocity = (token - VELOCITY) * bin_size + bin_size - 1
+    for note in sorted(sounding):
+        add("note_off", note, 0)
+
+    midi = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+    midi.tracks.append(track)
+    return midi
+
+
+def render_midi(path: str, tokens) -> str:
+    """
+    Renders tokens to a MIDI file. The file is written under a temporary name
+    and renamed, so an interrupted run never leaves a partial file behind.
+
+    Parameters
+    ----------
+    path: str
+        Path of the MIDI file.
+    tokens: array_like
+        Event tokens.
+
+    Returns
+    -------
+    path: str
+        Path of the MIDI file.
+    """
+    tmp = f"{path}.tmp{os.getpid()}"
+    events_to_midi(tokens).save(tmp)
+    os.replace(tmp, path)
+    return path
+
+
+class MidiWriter:
+    """
+    Renders token sequences to MIDI files in a folder on worker processes.
+    """
+
+    def __init__(
+        self, folder: str, workers: int = 1, queue_size: int = 64, render=render_midi
+    ):
+        """
+        Initialize the MidiWriter class.
+
+        Parameters
+        ----------
+        folder: str
+            Folder of the MIDI files. Created if it does not exist.
+        workers: int
+            Number of worker processes. With 0 files are rendered in this process.
+        queue_size: int
+            Maximum number of sequences waiting for a worker. write blocks while the queue is full.
+        render: Callable
+            Function taking a path and tokens, see render_midi. Must be picklable.
+        """
+        self.folder = folder
+        self.queue_size = queue_size
+        self.render = render
+        self.written = 0
+        self.pending = deque()
+        self.executor = (
+            ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+        )
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        """
+        Parameters
+        ----------
+        name: str
+            Name of a sequence.
+
+        Returns
+        -------
+        path: str
+            Path of the MIDI file of the sequence.
+        """
+        return os.path.join(self.folder, f"{name}.mid")
+
+    def exists(self, name: str) -> bool:
+        """
+        Parameters
+        ----------
+        name: str
+            Name of a sequence.
+
+        Returns
+        -------
+        exists: bool
+            True if the MIDI file of the sequence was written, e.g. by an earlier run.
+        """
+        return os.path.exists(self.path(name))
+
+    def write(self, name: str, tokens) -> None:
+        """
+        Queues a sequence for rendering. Waits for a worker while the queue is full.
+
+        Parameters
+        ----------
+        name: str
+            Name of the sequence, which names the file.
+        tokens: array_like
+            Event tokens. Send numpy arrays rather than tensors, they are cheaper to pickle.
+        """
+        if self.executor is None:
+            self.render(self.path(name), tokens)
+            self.written += 1
+            return
+        while len(self.pending) >= self.queue_size:
+            self._collect(wait(self.pending, return_when=FIRST_COMPLETED).done)
+        self.pending.append(self.executor.submit(self.render, self.path(name), tokens))
+
+    def _collect(self, done) -> None:
+        """
+        Removes finished renders from the queue. Raises the error of a failed render.
+
+        Parameters
+        ----------
+        done: set
+            Finished futures.
+        """
+        for future in done:
+            self.pending.remove(future)
+            future.result()
+            self.written += 1
+
+    def close(self) -> None:
+        """
+        Waits for the queued sequences and stops the workers.
+        """
+        if self.executor is not None:
+            self._collect(wait(self.pending).done)
+            self.executor.shutdown()
+
+    def __enter__(self):
+        """Returns the writer."""
+        return self
+
+    def __exit__(self, *exc) -> None:
+        """Waits for the queued sequences."""
+        self.close()
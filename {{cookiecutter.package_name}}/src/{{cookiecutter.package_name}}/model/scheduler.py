@@ -0,0 +1,204 @@
+"""
+Scheduler
+=========
+Decides when training stops, so a job finishes with a checkpoint before its time limit.
+
+Training stops when
+
+* a step or token budget is used up,
+* the next step plus a final checkpoint would not finish before the deadline, or
+* the process receives SIGTERM or SIGUSR1, e.g. when SLURM preempts the job or
+  warns before its time limit with ``#SBATCH --signal=USR1@120``.
+"""
+
+import os
+import signal
+import subprocess
+import threading
+import time
+
+
+class Scheduler:
+    """
+    Tracks the budget of a training run and predicts whether the next unit of work fits.
+    """
+
+    def __init__(
+        self,
+        seconds: float,
+        max_steps: int = None,
+        max_tokens: int = None,
+        margin: float = 0.0,
+        requeue: bool = False,
+        signals: tuple = (signal.SIGTERM, signal.SIGUSR1),
+    ):
+        """
+        Initialize the Scheduler class.
+
+        Parameters
+        ----------
+        seconds: float
+            Wall clock budget in seconds, counted from start.
+        max_steps: int
+            Maximum number of optimizer steps, including the steps before a resume.
+        max_tokens: int
+            Maximum number of trained tokens, including the tokens before a resume.
+        margin: float
+            Seconds kept free before the deadline in addition to the predicted work.
+        requeue: bool
+            If True, a job stopped by a signal is requeued with scontrol.
+        signals: tuple
+            Signals that stop training.
+        """
+        self.seconds = seconds
+        self.max_steps = max_steps
+        self.max_tokens = max_tokens
+        self.margin = margin
+        self.requeue = requeue
+        self.signals = signals
+
+        self.deadline = None
+        self.steps = 0
+        self.tokens = 0
+        self.step_seconds = 0.0
+        self.last_seconds = 0.0
+        self.save_seconds = 0.0
+        self.eval_seconds = 0.0
+        self.received = None
+        self._last = None
+        self._handlers = {}
+
+    def start(self, steps: int = 0, tokens: int = 0) -> "Scheduler":
+        """
+        Starts the clock and installs the signal handlers.
+
+        Parameters
+        ----------
+        steps: int
+            Optimizer steps taken before a resume.
+        tokens: int
+            Tokens trained before a resume.
+
+        Returns
+        -------
+        scheduler: Scheduler
+            The scheduler.
+        """
+        self.deadline = time.time() + self.seconds
+        self.steps = steps
+        self.tokens = tokens
+        self._last = time.perf_counter()
+        # Handlers can only be installed from the main thread.
+        if threading.current_thread() is threading.main_thread():
+            for signum in self.signals:
+                self._handlers[signum] = signal.signal(signum, self._handle)
+        return self
+
+    def _handle(self, signum, frame) -> None:
+        """
+        Remembers the signal. Training stops at the end of the current step.
+
+        Parameters
+        ----------
+        signum: int
+            The signal.
+        frame
+            Current stack frame.
+        """
+        self.received = signum
+        print(f"Received {signal.Signals(signum).name}, stopping after this step")
+
+    def step(self, tokens: int = 0) -> None:
+        """
+        Records a finished optimizer step.
+
+        Parameters
+        ----------
+        tokens: int
+            Number of tokens trained in the step over all processes.
+        """
+        now = time.perf_counter()
+        seconds = now - self._last
+        self._last = now
+        self.last_seconds = seconds
+        # Slow steps count fully at once, fast steps only lower the estimate gradually.
+        self.step_seconds = max(seconds, 0.9 * self.step_seconds + 0.1 * seconds)
+        self.steps += 1
+        self.tokens += tokens
+
+    def resume_clock(self) -> None:
+        """
+        Excludes the time since the last step, e.g. evaluation, from the next step duration.
+        """
+        self._last = time.perf_counter()
+
+    def record(self, save: float = None, evaluate: float = None) -> None:
+        """
+        Records how long saving a checkpoint or evaluating took.
+
+        Parameters
+        ----------
+        save: float
+            Seconds to write a checkpoint.
+        evaluate: float
+            Seconds to evaluate.
+        """
+        if save is not None:
+            self.save_seconds = max(self.save_seconds, save)
+        if evaluate is not None:
+            self.eval_seconds = evaluate
+
+    @property
+    def exhausted(self) -> bool:
+        """True if the step or token budget is used up."""
+        return (self.max_steps is not None and self.steps >= self.max_steps) or (
+            self.max_tokens is not None and self.tokens >= self.max_tokens
+        )
+
+    def fits(self, seconds: float = None) -> bool:
+        """
+        Whether work of the given duration still finishes, with a final checkpoint, before the deadline.
+
+        Parameters
+        ----------
+        seconds: float
+            Duration of the work. Defaults to the predicted duration of a step.
+
+        Returns
+        -------
+        fits: bool
+            False if the work would overrun the deadline or a stop signal was received.
+        """
+        if self.received is not None:
+            return False
+        seconds = self.step_seconds if seconds is None else seconds
+        reserve = self.save_seconds + self.margin
+        return time.time() + seconds + reserve <= self.deadline
+
+    @property
+    def remaining(self) -> float:
+        """Seconds left until the deadline."""
+        return self.deadline - time.time()
+
+    def requeue_job(self) -> bool:
+        """
+        Requeues the SLURM job if requeue is set and training was stopped by a signal.
+
+        Returns
+        -------
+        requeued: bool
+            True if the job was requeued.
+        """
+        job_id = os.environ.get("SLURM_JOB_ID")
+        if not self.requeue or self.received is None or job_id is None:
+            return False
+        print(f"Requeuing job {job_id}")
+        return subprocess.run(["scontrol", "requeue", job_id]).returncode == 0
+
+    def close(self) -> None:
+        """
+        Restores the previous signal handlers.
+        """
+        for signum, handler in self._handlers.items():
+            signal.signal(signum, handler)
+        self._handlers = {}
@@ -1,9 +1,19 @@
 """Settings
 ========
 Settings used for training and evaluating the model.
+
+The settings of a trained model are saved next to it, e.g.
+models/model.settings.json, so it is loaded with its own architecture
+whatever the environment of a later run holds.
 """
 
-from pydantic import BaseSettings
+import json
+import os
+from typing import Optional
+
+from pydantic import BaseSettings, validator
+
+ATTENTION = ("math", "sdpa")
 
 
 class ModelSettings(BaseSettings):
@@ -12,11 +22,113 @@ class ModelSettings(BaseSettings):
 
     Parameters
     ----------
+    context: int
+        Context length of the model.
+    layers: int
+        Number of transformer blocks.
+    heads: int
+        Number of attention heads. Must divide dim.
+    dim: int
+        Model dimension.
+    mlp_ratio: int
+        Hidden dimension of the feed forward layers as multiple of dim.
+    dropout: float
+        Dropout rate.
+    checkpointing: bool
+        If True, the activations of the blocks are recomputed in the backward
+        pass instead of kept, which trades about a third more compute for
+        activation memory that no longer grows with the number of layers.
+    attention: str
+        "math" computes the attention weights explicitly, which keeps a
+        (context, context) matrix per head. "sdpa" uses
+        torch.nn.functional.scaled_dot_product_attention, which picks a memory
+        efficient kernel where one is available.
     """
 
+    context: int = 512
+    layers: int = 4
+    heads: int = 8
+    dim: int = 256
+    mlp_ratio: int = 4
+    dropout: float = 0.1
+    checkpointing: bool = False
+    attention: str = "math"
+
     class Config:
         """Config"""
 
         env_prefix = "MS_"
         env_file = ".env"
         env_file_encoding = "utf-8"
+
+    @validator("dim")
+    def heads_divide_dim(cls, dim: int, values: dict) -> int:
+        """Checks that the heads split the model dimension evenly."""
+        if "heads" in values and dim % values["heads"]:
+            raise ValueError(f"{values['heads']} heads do not divide dim {dim}")
+        return dim
+
+    @validator("attention")
+    def known_attention(cls, attention: str) -> str:
+        """Checks that the attention implementation exists."""
+        if attention not in ATTENTION:
+            raise ValueError(f"attention must be one of {ATTENTION}, got {attention!r}")
+        return attention
+
+    def architecture(self) -> dict:
+        """
+        Returns
+        -------
+        kwargs: dict
+            Keyword arguments of TransformerModel for these settings.
+        """
+        return self.dict()
+
+    def save(self, model_path: str) -> None:
+        """
+        Saves the settings next to a model, see settings_path.
+
+        Parameters
+        ----------
+        model_path: str
+            Path to the model trained with these settings.
+        """
+        path = settings_path(model_path)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.dict(), f, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def of_model(cls, model_path: str) -> Optional["ModelSettings"]:
+        """
+        Parameters
+        ----------
+        model_path: str
+            Path to a model saved by train.
+
+        Returns
+        -------
+        settings: ModelSettings or None
+            The settings the model was trained with. None for models saved without them.
+        """
+        path = settings_path(model_path)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            # Explicit values take precedence over the environment.
+            return cls(**json.load(f))
+
+
+def settings_path(model_path: str) -> str:
+    """
+    Parameters
+    ----------
+    model_path: str
+        Path to a model saved by train, e.g. models/model.pt.
+
+    Returns
+    -------
+    path: str
+        Path of its settings, e.g. models/model.settings.json.
+    """
+    return f"{os.path.splitext(model_path)[0]}.settings.json"
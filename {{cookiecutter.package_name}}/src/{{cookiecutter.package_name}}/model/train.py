@@ -9,8 +9,45 @@ import pendulum as pendulum
 import pkbar
 import time
 import math
+from contextlib import nullcontext
+from itertools import islice
+from typing import Callable
 
-from {{cookiecutter.package_name}}.model.transformer import device
+import torch
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+from torch.profiler import record_function
+
+from {{cookiecutter.package_name}}.datasets import (
+    PaddingStats,
+    StreamingDataset,
+    Throughput,
+    build_vocab,
+    make_batches,
+    vocab_path,
+)
+from {{cookiecutter.package_name}}.model.checkpoint import Checkpointer, rng_state, set_rng_state
+from {{cookiecutter.package_name}}.model.distributed import (
+    all_reduce,
+    any_process,
+    broadcast_object,
+    cleanup_distributed,
+    gather_objects,
+    print0,
+    setup_distributed,
+    unwrap,
+)
+from {{cookiecutter.package_name}}.model.metrics import MetricsLogger, memory_stats
+from {{cookiecutter.package_name}}.model.scheduler import Scheduler
+from {{cookiecutter.package_name}}.model.settings import ModelSettings
+from {{cookiecutter.package_name}}.model.transformer import Transformer, get_device
+
+IGNORE_INDEX = -100
+PRECISIONS = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
 
 
 def train(
@@ -19,10 +56,48 @@ def train(
     hours: int = 60,
     minutes: int = 0,
     logfile: str = "log.txt",
-):
+    batch_size: int = 32,
+    num_workers: int = 0,
+    batching: str = "bucket",
+    settings: ModelSettings = None,
+    vocab_size: int = 512,
+    min_freq: int = 1,
+    vocab_workers: int = 1,
+    precision: str = "fp32",
+    accumulate: int = 1,
+    lr: float = 3e-4,
+    resume: bool = True,
+    checkpoint_minutes: float = 30,
+    keep_last: int = 3,
+    keep_best: int = 1,
+    max_steps: int = None,
+    max_tokens: int = None,
+    margin: float = 0.0,
+    requeue: bool = False,
+    log_every: int = 10,
+    log_per_rank: bool = False,
+    profiler=None,
+) -> bool:
     """
     Train loop for the Transformer model.
 
+    Runs data parallel over all processes of the job when started with srun
+    or torchrun, see model.distributed. Every process trains on its own part
+    of the data, rank 0 logs and saves.
+
+    Checkpoints are written to the snapshots folder next to model_path after
+    every epoch and every checkpoint_minutes within an epoch. With resume,
+    training continues from the newest readable checkpoint, including the
+    optimizer, the random number generators and the position in the epoch.
+
+    The vocabulary is built from the train split, or taken from the cache in
+    the data folder, and saved next to the model, see datasets.vocab. A
+    resumed run keeps the vocabulary of its checkpoint.
+
+    Training stops with a checkpoint when a budget is used up, when the next
+    step would not finish before the time limit or on SIGTERM and SIGUSR1,
+    see model.scheduler.
+
     Parameters
     ----------
     data_path: str
@@ -30,79 +105,602 @@ def train(
     model_path: str
         Path to the model.
     hours: int
-        Number of hours to train for.
+        Number of hours to train for, including saving.
     minutes: int
-        Number of minutes to train for.
+        Number of minutes to train for, including saving.
     logfile: str
-        Path to the log file.
+        Path to the metrics file. CSV, or JSONL if it ends with .jsonl, see model.metrics.
+    batch_size: int
+        Number of sequences per batch and process.
+    num_workers: int
+        Number of DataLoader worker processes prefetching batches.
+    batching: str
+        How sequences are batched. "pad", "pack" or "bucket", see make_batches.
+    settings: ModelSettings
+        Architecture of the model, its context length and memory saving options.
+        Defaults to ModelSettings(), read from the environment and .env. Saved
+        next to the model, so generation rebuilds the same architecture.
+    vocab_size: int
+        Maximum number of tokens of the model, including the unknown token.
+    min_freq: int
+        Tokens occurring less often in the train split are mapped to the unknown token.
+    vocab_workers: int
+        Number of processes counting the tokens of the train split for the vocabulary.
+    precision: str
+        "fp32", "bf16" or "fp16". bf16 and fp16 run the forward pass under autocast,
+        fp16 with loss scaling. bf16 also works on CPU.
+    accumulate: int
+        Number of batches whose gradients are accumulated per optimizer step.
+        The effective batch size is batch_size * accumulate.
+    lr: float
+        Learning rate.
+    resume: bool
+        If True, resume from the newest checkpoint in the snapshots folder.
+    checkpoint_minutes: float
+        Minutes between checkpoints within an epoch.
+    keep_last: int
+        Number of newest checkpoints kept.
+    keep_best: int
+        Number of checkpoints with the lowest validation loss kept.
+    max_steps: int
+        Maximum number of optimizer steps. Defaults to no limit.
+    max_tokens: int
+        Maximum number of trained tokens. Defaults to no limit.
+    margin: float
+        Seconds kept free before the time limit.
+    requeue: bool
+        If True, the SLURM job is requeued when it is stopped by a signal.
+    log_every: int
+        Number of optimizer steps between step records in the metrics file. 0 disables them.
+    log_per_rank: bool
+        If True, every rank writes its own metrics file. Otherwise only rank 0 logs.
+    profiler: Profiler
+        If given, a window of steps is profiled with torch.profiler, see profiling.Profiler.
+
+    Returns
+    -------
+    finished: bool
+        True if the step or token budget was used up. False if training stopped
+        early, by a signal or the time limit, and should be resumed.
     """
 
-    print(data_path)
+    job = setup_distributed()
+    main = job.is_main
 
-    print("Composing model")
+    print0(data_path)
+    print0(f"Process {job.rank} of {job.world_size}")
+
+    checkpointer = Checkpointer(
+        os.path.join(os.path.dirname(model_path), "snapshots"), keep_last, keep_best
+    )
+    state = checkpointer.load_latest() if resume else None
+    if state is not None and state.get("vocab") is not None:
+        vocab = state["vocab"]
+    else:
+        print0("Building vocabulary")
+        vocab = (
+            build_vocab(data_path, min_freq, vocab_size, vocab_workers)
+            if main
+            else None
+        )
+        vocab = broadcast_object(vocab)
+    print0(f"Vocabulary of {len(vocab)} tokens")
 
-    print("Loading data")
+    print0("Composing model")
+    settings = ModelSettings() if settings is None else settings
+    context = settings.context
+    model = Transformer(vocab, **settings.architecture())
+
+    print0("Loading data")
+    train_data = StreamingDataset.from_data_path(
+        data_path, "train", shuffle=True, vocab=vocab
+    )
+    val_data = StreamingDataset.from_data_path(data_path, "val", vocab=vocab)
+    print0(f"{len(train_data)} training and {len(val_data)} validation samples")
+
+    device = get_device()
+    print0(f"Setting up model and sending to {device} device")
+    model = model.to(device)
+    if job.is_distributed:
+        model = DistributedDataParallel(
+            model,
+            device_ids=[torch.cuda.current_device()] if device == "cuda" else None,
+        )
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr)
+    scaler = torch.amp.GradScaler(device_type(), enabled=precision == "fp16")
+    print0(f"Training in {precision} with {accumulate} accumulation steps")
 
-    print(f"Setting up model and sending to {device} device")
+    start_epoch, skip, step, trained = 0, 0, 0, 0
+    if state is not None:
+        print0(f"Resuming from {state['path']}")
+        restore_state(state, model, optimizer, scaler, job.rank)
+        start_epoch, skip = state["epoch"], state["batch"]
+        step, trained = state["step"], state.get("tokens", 0)
 
     now = pendulum.now()
     to_time = now.add(hours=hours, minutes=minutes)
-    print(f"Start training with limit of {to_time.diff(now).in_words()}")
+    print0(f"Start training with limit of {to_time.diff(now).in_words()}")
+    scheduler = Scheduler(
+        to_time.diff(now).in_seconds(), max_steps, max_tokens, margin, requeue
+    ).start(step, trained)
+    last_checkpoint, stopped = time.time(), False
+    metrics = MetricsLogger(
+        logfile, rank=job.rank, per_rank=log_per_rank, append=state is not None
+    )
+    trace = profiler.torch_profile("train") if profiler is not None else None
+    if trace is not None:
+        trace.start()
 
-    with open(logfile, "w") as f:
-        f.write("time,train_loss,train_ppl,val_loss,val_ppl\n")
+    def checkpoint(epoch: int, batch: int, val_loss: float = None) -> None:
+        """Saves the state after batch batches of epoch on rank 0."""
+        nonlocal last_checkpoint
+        state = training_state(
+            model,
+            optimizer,
+            scaler,
+            epoch,
+            batch,
+            scheduler.steps,
+            scheduler.tokens,
+            vocab,
+        )
+        if main:
+            path = checkpointer.save(state, scheduler.steps, val_loss)
+            print0(f"Saving checkpoint at {path}")
+        # Only rank 0 writes, every process reserves its time before the deadline.
+        (save_seconds,) = all_reduce(checkpointer.write_seconds, op="max")
+        scheduler.record(save=save_seconds)
+        last_checkpoint = time.time()
+
+    def on_step(batch: int, tokens: int, loss: torch.Tensor) -> bool:
+        """Counts and logs the step, saves a checkpoint when due and decides whether to stop."""
+        nonlocal stopped
+        due = time.time() - last_checkpoint >= checkpoint_minutes * 60
+        # One collective for all processes to agree on the tokens, the checkpoint and stopping.
+        tokens, due, stop = all_reduce(tokens, float(due), float(not scheduler.fits()))
+        scheduler.step(int(tokens))
+        if trace is not None:
+            trace.step()
+        if log_every and scheduler.steps % log_every == 0:
+            loss = loss.item()
+            metrics.log(
+                "step",
+                epoch=epoch,
+                step=scheduler.steps,
+                train_loss=loss,
+                train_ppl=math.exp(loss),
+                tokens=int(tokens),
+                tokens_per_s=tokens / max(scheduler.last_seconds, 1e-9),
+                samples_per_s=X_train.samples_per_second,
+                data_wait=X_train.wait,
+                **memory_stats(),
+            )
+        stopped = stop > 0 or scheduler.exhausted
+        if due > 0 or stopped:
+            checkpoint(epoch, batch)
+        return stopped
 
-    for epoch in range(sys.maxsize):
-        if pendulum.now() >= to_time:
+    for epoch in range(start_epoch, sys.maxsize):
+        # Clocks differ between nodes, all processes stop in the same epoch.
+        if scheduler.exhausted or any_process(not scheduler.fits()):
             break
 
-        X_train = [1]
+        train_data.set_epoch(epoch)
+        X_train = Throughput(
+            make_batches(
+                train_data,
+                batching=batching,
+                batch_size=batch_size,
+                context=context,
+                num_workers=num_workers,
+            )
+        )
+        padding = PaddingStats()
+        # Only padded batching has a number of batches known up front.
+        target = math.ceil(len(train_data) / batch_size) if batching == "pad" else None
         progress = (
-            pkbar.Kbar(target=len(X_train), width=25) if device == "cpu" else None
+            pkbar.Kbar(target=target, width=25) if device == "cpu" and main else None
         )
 
         start_time = time.time()
 
-        print(progress)
+        train_loss, tokens = train_epoch(
+            model,
+            optimizer,
+            scaler,
+            X_train,
+            precision=precision,
+            accumulate=accumulate,
+            padding=padding,
+            progress=progress,
+            skip=skip if epoch == start_epoch else 0,
+            on_step=on_step,
+        )
+        if stopped:
+            print0(f"Stopped training after {scheduler.steps} steps")
+            break
+        # Evaluating must fit as well, otherwise the epoch end is saved without it.
+        if any_process(not scheduler.fits(scheduler.eval_seconds)):
+            checkpoint(epoch + 1, 0)
+            break
 
-        train_loss = 0
-        valid_loss = 0
+        eval_start = time.time()
+        valid_loss = evaluate(
+            unwrap(model),
+            make_batches(
+                val_data, batching=batching, batch_size=batch_size, context=context
+            ),
+            precision=precision,
+        )
         end_time = time.time()
+        scheduler.record(evaluate=end_time - eval_start)
         epoch_mins, epoch_secs = epoch_time(start_time, end_time)
+        tokens_per_s = tokens / max(end_time - start_time, 1e-9)
 
-        print()
-        print(f"Epoch: {epoch:02} | Time: {epoch_mins}m {epoch_secs}s")
-        print(
+        print0()
+        print0(f"Epoch: {epoch:02} | Time: {epoch_mins}m {epoch_secs}s")
+        print0(
+            f"\tTokens/s: {tokens_per_s:.1f} | "
+            f"Samples/s: {X_train.samples_per_second:.1f} | "
+            f"Data wait: {X_train.wait:.1f}s | "
+            f"Padding efficiency: {padding.efficiency:.1%}"
+        )
+        print0(
             f"\tTrain Loss: {train_loss:.3f} | Train PPL: {math.exp(train_loss):7.3f}"
         )
-        print(
+        print0(
             f"\t Val. Loss: {valid_loss:.3f} |  Val. PPL: {math.exp(valid_loss):7.3f}"
         )
-        print(f"Time left of training: {to_time.diff(pendulum.now()).in_words()}")
-        print()
-
-        if epoch % 10 == 0:
-            filepath = os.path.join(
-                os.path.dirname(model_path),
-                "snapshots",
-                f"model_epoch_{epoch}.pt",
-            )
-            print(f"Saving snapshot at {filepath}")
+        print0(f"Time left of training: {to_time.diff(pendulum.now()).in_words()}")
+        print0()
 
-            sample_filepath = os.path.join(
-                os.path.dirname(model_path),
-                "snapshots",
-                f"generated_sample_epoch_{epoch}.mid",
-            )
+        checkpoint(epoch + 1, 0, valid_loss)
+        scheduler.resume_clock()
 
-            print("Generating sample.")
+        metrics.log(
+            "epoch",
+            epoch=epoch,
+            step=scheduler.steps,
+            train_loss=train_loss,
+            train_ppl=math.exp(train_loss),
+            val_loss=valid_loss,
+            val_ppl=math.exp(valid_loss),
+            tokens=tokens,
+            tokens_per_s=tokens_per_s,
+            samples_per_s=X_train.samples_per_second,
+            data_wait=X_train.wait,
+            padding_efficiency=padding.efficiency,
+            **memory_stats(),
+        )
 
-            print(f"Saved sample to {sample_filepath}")
+    if trace is not None:
+        trace.stop()
+    checkpointer.close()
+    scheduler.close()
+    metrics.close()
+    if main:
+        print(f"Saving model at {model_path}")
+        save_model(unwrap(model), model_path)
+        vocab.save(vocab_path(model_path))
+        settings.save(model_path)
+        scheduler.requeue_job()
+    cleanup_distributed()
+    return scheduler.exhausted
 
-        with open(logfile, "a") as f:
-            f.write(
-                f"{pendulum.now()},{train_loss},{math.exp(train_loss)},{valid_loss},{math.exp(valid_loss)}\n"
-            )
+
+def training_state(
+    model,
+    optimizer,
+    scaler,
+    epoch: int,
+    batch: int,
+    step: int,
+    tokens: int = 0,
+    vocab=None,
+) -> dict:
+    """
+    State needed to resume training. Collective, call it on all processes.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        The model.
+    optimizer: torch.optim.Optimizer
+        The optimizer.
+    scaler: torch.amp.GradScaler
+        The loss scaler.
+    epoch: int
+        Epoch to resume in.
+    batch: int
+        Number of batches of the epoch that are done.
+    step: int
+        Number of optimizer steps taken.
+    tokens: int
+        Number of tokens trained.
+    vocab: Vocab
+        Vocabulary of the model.
+
+    Returns
+    -------
+    state: dict
+        The state. rng holds the random number generator states of every process.
+    """
+    return {
+        "model": unwrap(model).state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "scaler": scaler.state_dict(),
+        "epoch": epoch,
+        "batch": batch,
+        "step": step,
+        "tokens": tokens,
+        "vocab": vocab,
+        "rng": gather_objects(rng_state()),
+    }
+
+
+def restore_state(state: dict, model, optimizer, scaler, rank: int = 0) -> None:
+    """
+    Restores a state returned by training_state.
+
+    Parameters
+    ----------
+    state: dict
+        The state.
+    model: torch.nn.Module
+        The model.
+    optimizer: torch.optim.Optimizer
+        The optimizer.
+    scaler: torch.amp.GradScaler
+        The loss scaler.
+    rank: int
+        Rank of this process. Selects the random number generator state.
+        Processes without a saved state use the state of rank 0.
+    """
+    unwrap(model).load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    scaler.load_state_dict(state["scaler"])
+    rngs = state["rng"]
+    set_rng_state(rngs[rank] if rank < len(rngs) else rngs[0])
+
+
+def device_type() -> str:
+    """
+    Returns
+    -------
+    device_type: str
+        "cuda" or "cpu", the device type of get_device() as used by torch.autocast.
+    """
+    return "cuda" if get_device().startswith("cuda") else "cpu"
+
+
+def autocast(precision: str = "fp32"):
+    """
+    Parameters
+    ----------
+    precision: str
+        "fp32", "bf16" or "fp16".
+
+    Returns
+    -------
+    autocast: torch.autocast
+        Autocast context for the precision on get_device(). Disabled for fp32.
+    """
+    return torch.autocast(
+        device_type(), dtype=PRECISIONS[precision], enabled=precision != "fp32"
+    )
+
+
+def lm_loss(logits: torch.Tensor, batch: dict) -> tuple:
+    """
+    Next token prediction loss. Padding and targets from another sequence are ignored.
+
+    Ignored targets are masked instead of dropped, so the shapes do not depend
+    on the data and nothing is copied to the host.
+
+    Parameters
+    ----------
+    logits: torch.Tensor
+        Logits of shape (batch, length, vocab_size).
+    batch: dict
+        Batch the logits were computed for, see datasets.batching.
+
+    Returns
+    -------
+    loss: torch.Tensor
+        Mean cross entropy over the predicted tokens.
+    tokens: torch.Tensor
+        Number of predicted tokens, as tensor on the device of the logits.
+    """
+    documents = batch["documents"]
+    valid = (documents[:, 1:] >= 0) & (documents[:, 1:] == documents[:, :-1])
+    targets = batch["tokens"][:, 1:].masked_fill(~valid, IGNORE_INDEX)
+    total = F.cross_entropy(
+        logits[:, :-1].flatten(0, 1).float(),
+        targets.flatten(),
+        ignore_index=IGNORE_INDEX,
+        reduction="sum",
+    )
+    tokens = valid.sum()
+    return total / tokens.clamp(min=1), tokens
+
+
+def train_epoch(
+    model,
+    optimizer,
+    scaler,
+    batches,
+    precision: str = "fp32",
+    accumulate: int = 1,
+    clip: float = 1.0,
+    padding: PaddingStats = None,
+    progress=None,
+    skip: int = 0,
+    on_step: Callable = None,
+) -> tuple:
+    """
+    Trains the model for one pass over batches.
+
+    When distributed, gradients are only synchronized on the last batch of an
+    optimizer step. All processes take the same number of optimizer steps, the
+    surplus batches of processes with more data are dropped.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        The model.
+    optimizer: torch.optim.Optimizer
+        The optimizer.
+    scaler: torch.amp.GradScaler
+        Loss scaler. Only enabled for fp16.
+    batches: Iterable
+        Batches of this process, see datasets.batching.
+    precision: str
+        "fp32", "bf16" or "fp16".
+    accumulate: int
+        Number of batches per optimizer step.
+    clip: float
+        Maximum gradient norm.
+    padding: PaddingStats
+        Updated with every batch if given.
+    progress: pkbar.Kbar
+        Progress bar updated with every batch if given.
+    skip: int
+        Number of batches to skip, which were trained on before a resume.
+    on_step: Callable
+        Called after every optimizer step with the number of batches done,
+        including the skipped ones, the tokens of the step on this process and
+        the mean loss of the step as tensor. The epoch ends early if it returns True.
+
+    Returns
+    -------
+    loss: float
+        Mean loss per predicted token over all processes.
+    tokens: int
+        Number of predicted tokens over all processes.
+    """
+    device = get_device()
+    model.train()
+    optimizer.zero_grad(set_to_none=True)
+    # Kept on the device, so there is no synchronization per batch.
+    total_loss = torch.zeros((), device=device)
+    total_tokens = torch.zeros((), dtype=torch.long, device=device)
+    count = 0
+    batches = islice(batches, skip, None)
+
+    while True:
+        with record_function("data"):
+            window = list(islice(batches, accumulate))
+        size = int(all_reduce(len(window), op="min")[0])
+        step_tokens = torch.zeros((), dtype=torch.long, device=device)
+        step_loss = torch.zeros((), device=device)
+
+        for i, batch in enumerate(window[:size]):
+            if padding is not None:
+                padding.update(batch)
+            batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+
+            sync = i == size - 1 or not hasattr(model, "no_sync")
+            with nullcontext() if sync else model.no_sync():
+                with record_function("forward"):
+                    with autocast(precision):
+                        logits = model(
+                            batch["tokens"], batch["documents"], batch["positions"]
+                        )
+                    loss, tokens = lm_loss(logits, batch)
+                with record_function("backward"):
+                    scaler.scale(loss / size).backward()
+
+            total_loss += loss.detach() * tokens
+            total_tokens += tokens
+            step_tokens += tokens
+            step_loss += loss.detach() * tokens
+            count += 1
+
+        if size > 0:
+            with record_function("optimizer"):
+                optimizer_step(model, optimizer, scaler, clip)
+            step_loss = step_loss / step_tokens.clamp(min=1)
+            if progress is not None:
+                # Progress bars are only shown on the CPU, where item() does not wait for a device.
+                progress.update(count, values=[("loss", step_loss.item())])
+            # The scheduler needs the tokens of every step, one synchronization per step.
+            if on_step is not None and on_step(
+                skip + count, int(step_tokens), step_loss
+            ):
+                break
+        if size < accumulate:
+            break
+
+    total_loss, total_tokens = all_reduce(total_loss.item(), total_tokens.item())
+    return total_loss / max(total_tokens, 1), int(total_tokens)
+
+
+def optimizer_step(model, optimizer, scaler, clip: float = 1.0) -> None:
+    """
+    Clips the gradients, steps the optimizer and clears the gradients.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        The model.
+    optimizer: torch.optim.Optimizer
+        The optimizer.
+    scaler: torch.amp.GradScaler
+        Loss scaler.
+    clip: float
+        Maximum gradient norm.
+    """
+    scaler.unscale_(optimizer)
+    torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
+    scaler.step(optimizer)
+    scaler.update()
+    optimizer.zero_grad(set_to_none=True)
+
+
+@torch.no_grad()
+def evaluate(model, batches, precision: str = "fp32") -> float:
+    """
+    Parameters
+    ----------
+    model: torch.nn.Module
+        The model.
+    batches: Iterable
+        Batches, see datasets.batching.
+    precision: str
+        "fp32", "bf16" or "fp16".
+
+    Returns
+    -------
+    loss: float
+        Mean loss per predicted token over all processes.
+    """
+    device = get_device()
+    model.eval()
+    total_loss = torch.zeros((), device=device)
+    total_tokens = torch.zeros((), dtype=torch.long, device=device)
+    for batch in batches:
+        batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+        with autocast(precision):
+            logits = model(batch["tokens"], batch["documents"], batch["positions"])
+        loss, tokens = lm_loss(logits, batch)
+        total_loss += loss * tokens
+        total_tokens += tokens
+    total_loss, total_tokens = all_reduce(total_loss.item(), total_tokens.item())
+    return total_loss / max(total_tokens, 1)
+
+
+def save_model(model, filepath: str) -> None:
+    """
+    Saves the weights of the model.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        The model.
+    filepath: str
+        Path to save to.
+    """
+    torch.save(model.state_dict(), filepath)
 
 
 def epoch_time(start_time: int, end_time: int):
@@ -1,20 +1,515 @@
 """
 Transformer
+===========
+Decoder only transformer with a key/value cache for generation.
+
+Two options trade compute for memory during training:
+
+* attention="sdpa" uses torch.nn.functional.scaled_dot_product_attention,
+  which does not keep the attention weights of shape (context, context) where
+  a memory efficient kernel is available.
+* checkpointing=True recomputes the activations of every block in the
+  backward pass, so only the inputs of the blocks are kept.
+
+See model.memory to estimate the memory of a configuration before training.
 """
 
+import math
+from functools import lru_cache
+from typing import NamedTuple, Sequence
+
+import numpy as np
 import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+from {{cookiecutter.package_name}}.datasets import document_mask
+from {{cookiecutter.package_name}}.model.settings import ModelSettings
+
+
+@lru_cache(maxsize=None)
+def get_device() -> str:
+    """
+    Detects the device on first use instead of on import, which initializes CUDA.
+
+    Returns
+    -------
+    device: str
+        "cuda" if a GPU is available, else "cpu".
+    """
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+class KVCache:
+    """
+    Keys and values of the past tokens of a fixed number of sequences, one slot per sequence.
+
+    With the cache, a forward pass only computes the new tokens of a sequence
+    and attends to the cached keys and values of the earlier ones. Slots are
+    independent, so finished sequences can be replaced while others continue.
+    The lengths of the slots are kept on the host, so a step does not wait for
+    the device to find out how many keys to attend to.
+    """
+
+    def __init__(self, model, slots: int, dtype: torch.dtype = None):
+        """
+        Initialize the KVCache class.
+
+        Parameters
+        ----------
+        model: TransformerModel
+            Model the cache is used with.
+        slots: int
+            Number of sequences.
+        dtype: torch.dtype
+            Type of the cached keys and values. Defaults to the type of the model.
+        """
+        attention = model.blocks[0].attention
+        dim = model.token_embedding.embedding_dim
+        weight = model.token_embedding.weight
+        shape = (slots, attention.heads, model.context, dim // attention.heads)
+        dtype = weight.dtype if dtype is None else dtype
+        self.keys = [
+            torch.zeros(shape, dtype=dtype, device=weight.device) for _ in model.blocks
+        ]
+        self.values = [torch.zeros_like(k) for k in self.keys]
+        self.lengths = np.zeros(slots, dtype=np.int64)
+
+    def reset(self, rows: Sequence[int]) -> None:
+        """
+        Empties slots for new sequences.
+
+        Parameters
+        ----------
+        rows: Sequence[int]
+            Slots to empty.
+        """
+        self.lengths[np.asarray(rows, dtype=np.int64)] = 0
+
+    def layer(
+        self, layer: int, rows: torch.Tensor, positions: torch.Tensor, end: int
+    ) -> "LayerCache":
+        """
+        Parameters
+        ----------
+        layer: int
+            Index of a transformer block.
+        rows: torch.Tensor
+            Slots of the sequences in the batch.
+        positions: torch.Tensor
+            Positions of the new tokens of shape (batch, length).
+        end: int
+            Length of the longest sequence of the batch after the new tokens.
+
+        Returns
+        -------
+        cache: LayerCache
+            Cache of the block for the batch.
+        """
+        return LayerCache(self, layer, rows, positions, end)
+
+
+class LayerCache(NamedTuple):
+    """
+    Part of a KVCache used by one transformer block in one forward pass.
+
+    Parameters
+    ----------
+    cache: KVCache
+        The cache.
+    layer: int
+        Index of the block.
+    rows: torch.Tensor
+        Slots of the sequences in the batch.
+    positions: torch.Tensor
+        Positions of the new tokens of shape (batch, length).
+    end: int
+        Length of the longest sequence of the batch after the new tokens.
+    """
+
+    cache: KVCache
+    layer: int
+    rows: torch.Tensor
+    positions: torch.Tensor
+    end: int
+
+    def update(self, k: torch.Tensor, v: torch.Tensor) -> tuple:
+        """
+        Stores the keys and values of the new tokens.
+
+        Parameters
+        ----------
+        k: torch.Tensor
+            Keys of the new tokens of shape (batch, heads, length, head dim).
+        v: torch.Tensor
+            Values of the new tokens, shaped like k.
+
+        Returns
+        -------
+        k: torch.Tensor
+            Keys of all tokens of the sequences up to the longest one.
+        v: torch.Tensor
+            Values of all tokens, shaped like k.
+        mask: torch.Tensor
+            Boolean tensor of shape (batch, length, keys). True where a new token may attend to a key.
+        """
+        keys, values = self.cache.keys[self.layer], self.cache.values[self.layer]
+        index = (self.rows[:, None], slice(None), self.positions)
+        keys[index] = k.transpose(1, 2).to(keys.dtype)
+        values[index] = v.transpose(1, 2).to(values.dtype)
+
+        end = self.end
+        mask = torch.arange(end, device=k.device) <= self.positions[:, :, None]
+        return (
+            keys[self.rows, :, :end].to(k.dtype),
+            values[self.rows, :, :end].to(v.dtype),
+            mask,
+        )
+
+
+class CausalSelfAttention(nn.Module):
+    """
+    Multi head self attention.
+    """
+
+    def __init__(
+        self, dim: int, heads: int, dropout: float = 0.0, attention: str = "math"
+    ):
+        """
+        Initialize the CausalSelfAttention class.
+
+        Parameters
+        ----------
+        dim: int
+            Model dimension.
+        heads: int
+            Number of attention heads. Must divide dim.
+        dropout: float
+            Dropout on the attention weights and output.
+        attention: str
+            "math" or "sdpa", see model.settings.
+        """
+        super().__init__()
+        self.heads = heads
+        self.attention = attention
+        self.qkv = nn.Linear(dim, 3 * dim)
+        self.proj = nn.Linear(dim, dim)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(
+        self, x: torch.Tensor, mask: torch.Tensor, cache: LayerCache = None
+    ) -> torch.Tensor:
+        """
+        Parameters
+        ----------
+        x: torch.Tensor
+            Input of shape (batch, length, dim).
+        mask: torch.Tensor
+            Boolean tensor of shape (batch, length, length). True where query i may attend to key j.
+            Ignored with a cache.
+        cache: LayerCache
+            If given, x are new tokens that attend to the cached ones as well.
+
+        Returns
+        -------
+        y: torch.Tensor
+            Output of shape (batch, length, dim).
+        """
+        batch, length, dim = x.shape
+        q, k, v = (
+            self.qkv(x)
+            .view(batch, length, 3, self.heads, dim // self.heads)
+            .permute(2, 0, 3, 1, 4)
+        )
+        if cache is not None:
+            k, v, mask = cache.update(k, v)
+
+        if self.attention == "sdpa":
+            y = F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=mask.unsqueeze(1),
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+        else:
+            scores = (q @ k.transpose(-2, -1)) / math.sqrt(q.shape[-1])
+            scores = scores.masked_fill(~mask.unsqueeze(1), float("-inf"))
+            weights = self.dropout(torch.softmax(scores.float(), dim=-1).to(q.dtype))
+            y = weights @ v
+
+        y = y.transpose(1, 2).reshape(batch, length, dim)
+        return self.dropout(self.proj(y))
+
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
+class Block(nn.Module):
+    """
+    Pre norm transformer block.
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        heads: int,
+        dropout: float = 0.0,
+        mlp_ratio: int = 4,
+        attention: str = "math",
+    ):
+        """
+        Initialize the Block class.
+
+        Parameters
+        ----------
+        dim: int
+            Model dimension.
+        heads: int
+            Number of attention heads.
+        dropout: float
+            Dropout rate.
+        mlp_ratio: int
+            Hidden dimension of the feed forward layers as multiple of dim.
+        attention: str
+            "math" or "sdpa", see model.settings.
+        """
+        super().__init__()
+        self.ln1 = nn.LayerNorm(dim)
+        self.attention = CausalSelfAttention(dim, heads, dropout, attention)
+        self.ln2 = nn.LayerNorm(dim)
+        self.mlp = nn.Sequential(
+            nn.Linear(dim, mlp_ratio * dim),
+            nn.GELU(),
+            nn.Linear(mlp_ratio * dim, dim),
+            nn.Dropout(dropout),
+        )
+
+    def forward(
+        self, x: torch.Tensor, mask: torch.Tensor, cache: LayerCache = None
+    ) -> torch.Tensor:
+        """
+        Parameters
+        ----------
+        x: torch.Tensor
+            Input of shape (batch, length, dim).
+        mask: torch.Tensor
+            Attention mask, see CausalSelfAttention.
+        cache: LayerCache
+            Cached keys and values, see CausalSelfAttention.
 
+        Returns
+        -------
+        y: torch.Tensor
+            Output of shape (batch, length, dim).
+        """
+        x = x + self.attention(self.ln1(x), mask, cache)
+        return x + self.mlp(self.ln2(x))
 
-def Transformer(vocab):
+
+class TransformerModel(nn.Module):
+    """
+    Decoder only transformer language model over event tokens.
+    """
+
+    def __init__(
+        self,
+        vocab_size: int,
+        context: int = 512,
+        layers: int = 4,
+        heads: int = 8,
+        dim: int = 256,
+        dropout: float = 0.1,
+        mlp_ratio: int = 4,
+        checkpointing: bool = False,
+        attention: str = "math",
+    ):
+        """
+        Initialize the TransformerModel class. The architecture is usually
+        taken from a ModelSettings, see model.settings.
+
+        Parameters
+        ----------
+        vocab_size: int
+            Number of tokens.
+        context: int
+            Maximum sequence length.
+        layers: int
+            Number of transformer blocks.
+        heads: int
+            Number of attention heads.
+        dim: int
+            Model dimension.
+        dropout: float
+            Dropout rate.
+        mlp_ratio: int
+            Hidden dimension of the feed forward layers as multiple of dim.
+        checkpointing: bool
+            If True, the activations of the blocks are recomputed in the backward pass.
+        attention: str
+            "math" or "sdpa", see model.settings.
+        """
+        super().__init__()
+        self.context = context
+        self.checkpointing = checkpointing
+        self.token_embedding = nn.Embedding(vocab_size, dim)
+        self.position_embedding = nn.Embedding(context, dim)
+        self.dropout = nn.Dropout(dropout)
+        self.blocks = nn.ModuleList(
+            Block(dim, heads, dropout, mlp_ratio, attention) for _ in range(layers)
+        )
+        self.ln = nn.LayerNorm(dim)
+        self.head = nn.Linear(dim, vocab_size, bias=False)
+        self.head.weight = self.token_embedding.weight
+        self.apply(self._init_weights)
+
+    @staticmethod
+    def _init_weights(module: nn.Module) -> None:
+        """
+        Small normal initialization, so the tied output layer starts with small logits.
+
+        Parameters
+        ----------
+        module: nn.Module
+            Module to initialize.
+        """
+        if isinstance(module, (nn.Linear, nn.Embedding)):
+            nn.init.normal_(module.weight, std=0.02)
+        if isinstance(module, nn.Linear) and module.bias is not None:
+            nn.init.zeros_(module.bias)
+
+    def forward(
+        self,
+        tokens: torch.Tensor,
+        documents: torch.Tensor = None,
+        positions: torch.Tensor = None,
+        cache: KVCache = None,
+        rows: Sequence[int] = None,
+    ) -> torch.Tensor:
+        """
+        Parameters
+        ----------
+        tokens: torch.Tensor
+            Tokens of shape (batch, length).
+        documents: torch.Tensor
+            Sequence of every token, see datasets.batching. Tokens only attend within
+            their sequence. Defaults to a single sequence per row. Ignored with a cache.
+        positions: torch.Tensor
+            Position of every token. Defaults to 0, 1, 2, ... Ignored with a cache.
+        cache: KVCache
+            If given, tokens continue the sequences in the cache, which are extended by them.
+            All rows of a batch then have the same number of new tokens.
+        rows: Sequence[int]
+            Slots of the cache the rows of tokens continue. Defaults to 0, 1, 2, ...
+            Pass a list or a tensor on the cpu, a tensor on the device is copied back first.
+
+        Returns
+        -------
+        logits: torch.Tensor
+            Next token logits of shape (batch, length, vocab_size).
+        """
+        batch, length = tokens.shape
+        if cache is not None:
+            slots = (
+                np.arange(batch)
+                if rows is None
+                else np.asarray(torch.as_tensor(rows).cpu())
+            )
+            start = cache.lengths[slots]
+            end = int(start.max()) + length
+            if end > self.context:
+                raise ValueError(
+                    f"Sequences are longer than the context of {self.context}"
+                )
+            positions = torch.from_numpy(start[:, None] + np.arange(length))
+            positions = positions.to(tokens.device)
+            rows = torch.from_numpy(slots).to(tokens.device)
+            mask = None
+        else:
+            if documents is None:
+                documents = torch.zeros_like(tokens)
+            if positions is None:
+                positions = torch.arange(length, device=tokens.device).expand_as(tokens)
+            mask = document_mask(documents)
+
+        x = self.dropout(
+            self.token_embedding(tokens) + self.position_embedding(positions)
+        )
+        recompute = self.checkpointing and self.training and torch.is_grad_enabled()
+        for i, block in enumerate(self.blocks):
+            if cache is not None:
+                x = block(x, mask, cache.layer(i, rows, positions, end))
+            elif recompute:
+                x = checkpoint(block, x, mask, use_reentrant=False)
+            else:
+                x = block(x, mask)
+        if cache is not None:
+            cache.lengths[slots] += length
+        return self.head(self.ln(x))
+
+
+def Transformer(vocab, **kwargs) -> TransformerModel:
     """
     Creates a Transformer model with the given vocabulary size.
 
     Parameters
     ----------
     vocab:
-        The vocabulary to use for the model.
+        The vocabulary to use for the model. Either its size or an object with a length.
+    kwargs:
+        Architecture, see TransformerModel.
+
+    Returns
+    -------
+    model: TransformerModel
+        The model.
+    """
+    vocab_size = vocab if isinstance(vocab, int) else len(vocab)
+    return TransformerModel(vocab_size, **kwargs)
+
+
+def load_model(model_path: str, heads: int = None, map_location=None, **kwargs):
+    """
+    Loads weights saved by train and rebuilds the model around them.
+
+    The architecture is taken from the settings saved with the model, see
+    ModelSettings.of_model. Models saved without them are rebuilt from the
+    shapes of the weights.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the weights.
+    heads: int
+        Only for models saved without settings. Number of attention heads, which
+        the weights do not determine. Defaults to 8.
+    map_location
+        Passed on to torch.load. Defaults to get_device().
+    kwargs
+        Options of TransformerModel replacing the saved ones, e.g. attention.
 
+    Returns
+    -------
+    model: TransformerModel
+        The model on get_device() in evaluation mode.
     """
-    ...
+    state = torch.load(model_path, map_location=map_location or get_device())
+    vocab_size, dim = state["token_embedding.weight"].shape
+    settings = ModelSettings.of_model(model_path)
+    if settings is not None:
+        if heads is not None and heads != settings.heads:
+            raise ValueError(
+                f"{model_path} was trained with {settings.heads} heads, not {heads}"
+            )
+        model = Transformer(vocab_size, **{**settings.architecture(), **kwargs})
+    else:
+        layers = len({key.split(".")[1] for key in state if key.startswith("blocks.")})
+        model = Transformer(
+            vocab_size,
+            context=state["position_embedding.weight"].shape[0],
+            layers=layers,
+            heads=heads or 8,
+            dim=dim,
+            mlp_ratio=state["blocks.0.mlp.0.weight"].shape[0] // dim if layers else 4,
+            **kwargs,
+        )
+    model.load_state_dict(state)
+    return model.to(get_device()).eval()
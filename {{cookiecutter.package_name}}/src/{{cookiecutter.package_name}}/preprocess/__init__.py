@@ -6,17 +6,67 @@ This includes the Loader. A class for loading files.
 
 This submodule contains functions and classes from the following files:
 
+* indexer.py
 * loader.py
 * dataStreamer.py
+* parallel.py
+* partition.py
+* manifest.py
+* shards.py
+* synthesize.py
+* transforms.py
 
 """
 
+from {{cookiecutter.package_name}}.preprocess.indexer import FileIndex, scan
 from {{cookiecutter.package_name}}.preprocess.loader import Loader
+from {{cookiecutter.package_name}}.preprocess.transforms import (
+    PACKS,
+    Filter,
+    Map,
+    Pipeline,
+    Transform,
+    get_pack,
+    register_pack,
+)
+from {{cookiecutter.package_name}}.preprocess.parallel import available_cpus, parallel_map
+from {{cookiecutter.package_name}}.preprocess.manifest import Manifest
+from {{cookiecutter.package_name}}.preprocess.shards import ShardReader, ShardWriter, merge_shards
+from {{cookiecutter.package_name}}.preprocess.partition import Partition, merge_partitions
 from {{cookiecutter.package_name}}.preprocess.datastreamer import DataStreamer
 from {{cookiecutter.package_name}}.preprocess.datastreamer import split
+from {{cookiecutter.package_name}}.preprocess.datastreamer import assign_split
+from {{cookiecutter.package_name}}.preprocess.datastreamer import split_of
+from {{cookiecutter.package_name}}.preprocess.synthesize import (
+    FORMATS,
+    synthesize,
+    synthetic_seed,
+)
 
 __all__ = [
     "DataStreamer",
     "split",
+    "assign_split",
+    "split_of",
     "Loader",
+    "available_cpus",
+    "parallel_map",
+    "Manifest",
+    "FileIndex",
+    "scan",
+    "ShardReader",
+    "ShardWriter",
+    "merge_shards",
+    "Partition",
+    "merge_partitions",
+    "FORMATS",
+    "synthesize",
+    "synthetic_seed",
+    "PACKS",
+    "Filter",
+    "Map",
+    "Pipeline",
+    "Transform",
+    "get_pack",
+    "register_pack",
 ]
@@ -2,14 +2,24 @@
 Datastreamer
 """
 
+import hashlib
 import os
-from glob import glob
+import re
 from abc import ABC, abstractmethod
+from functools import partial
 
 import math
 
 
 from {{cookiecutter.package_name}}.preprocess import Loader
+from {{cookiecutter.package_name}}.preprocess.indexer import FileIndex, scan
+from {{cookiecutter.package_name}}.preprocess.manifest import (
+    Manifest,
+    file_hash,
+    fingerprint,
+)
+from {{cookiecutter.package_name}}.preprocess.parallel import parallel_map
+from {{cookiecutter.package_name}}.preprocess.transforms import as_pipeline
 import sys
 
 
@@ -43,6 +53,26 @@ class DataStreamer(ABC):
         if not os.path.exists(os.path.join(self.data_path, self.target_folder)):
             os.mkdir(os.path.join(self.data_path, self.target_folder))
 
+    @property
+    def source_folder(self) -> str:
+        """
+        Returns
+        ----------
+        source_folder: str
+            Name of folder with the raw data. The default is rawdata.
+        """
+        return "rawdata"
+
+    @property
+    def manifest_path(self) -> str:
+        """
+        Returns
+        ----------
+        manifest_path: str
+            Path to the manifest of preprocessed files.
+        """
+        return os.path.join(self.data_path, "manifest.json")
+
     @property
     @abstractmethod
     def target_folder(self) -> str:
@@ -66,37 +96,149 @@ class DataStreamer(ABC):
         ...
 
     @abstractmethod
-    def preprocess(self, transforms=[]) -> None:
+    def preprocess(
+        self,
+        transforms=[],
+        workers=1,
+        chunksize=16,
+        ordered=True,
+        incremental=True,
+        sink=None,
+        readahead=0,
+        profiler=None,
+        partition=None,
+    ) -> list:
         """
         Streams data.
 
+        With more than one worker the files are transformed in a pool of
+        processes. Loading still happens in this process, so transform should
+        not rely on state it changes on self.
+
+        With incremental preprocessing only files that are new, changed or were
+        transformed with a different pipeline are streamed. Outputs of raw files
+        that were removed are deleted. See Manifest.
+
+        With a sink, transform returns the tokens of a file instead of writing
+        them and the sink packs them, see ShardWriter. The sink is written from
+        scratch, so every file is streamed and the manifest is left untouched.
+
+        With a partition only the raw files of the partition are streamed, and
+        the manifest is kept in the folder of the partition, see preprocess.partition.
+
         Parameters
         ----------
-        transforms : list
-            List of transforms to be applied to the data. The default is no transforms.
+        transforms : Pipeline or list
+            Pipeline or list of transforms to be applied to the data. The default is no transforms.
+        workers : int
+            Number of worker processes transforming files. The default is 1.
+        chunksize : int
+            Number of files sent to a worker at a time. The default is 16.
+        ordered : bool
+            Whether files are completed in the order they are loaded. The default is True.
+        incremental : bool
+            Whether to skip files that are up to date according to the manifest. The default is True.
+        sink : ShardWriter
+            Object with a write(tokens, name) method receiving the output of transform. The default is no sink.
+        readahead : int
+            Number of files the Loader loads ahead while files are transformed. The default is 0.
+        profiler : Profiler
+            If given, a sample of the files is profiled in the workers, see profiling.Profiler.sample.
+        partition : Partition
+            If given, only this partition of the files is streamed. The default is all files.
+
+        Returns
+        -------
+        failures : list
+            List of (filename, traceback) tuples for files that failed to transform.
         """
-        loader = self.Loader(
-            os.path.join(self.data_path, self.target_folder), shuffle=self.shuffle
-        )
+        source_path = os.path.join(self.data_path, self.source_folder)
+        loader = self.Loader(source_path, shuffle=self.shuffle, readahead=readahead)
+
+        manifest = Manifest(self.manifest_path, self.data_path)
+        if partition is not None:
+            loader.data = [
+                f
+                for f in loader.data
+                if partition.contains(os.path.relpath(f, source_path))
+            ]
+            merged = manifest
+            folder = partition.folder(self.data_path)
+            os.makedirs(folder, exist_ok=True)
+            manifest = Manifest(os.path.join(folder, "manifest.json"), self.data_path)
+            if not os.path.exists(manifest.path):
+                # The first partitioned run starts from the entries of an earlier single run.
+                manifest.entries = {
+                    key: entry
+                    for key, entry in merged.entries.items()
+                    if partition.contains(
+                        os.path.relpath(os.path.join(self.data_path, key), source_path)
+                    )
+                }
+        transforms = as_pipeline(transforms)
+        pipeline = fingerprint(type(self).transform, transforms)
+
+        if sink is None:
+            removed = manifest.collect_garbage(loader.data)
+            if removed:
+                print(f"Removed outputs of {len(removed)} deleted files")
+
+        if incremental and sink is None:
+            skipped = len(loader.data)
+            loader.data = [
+                f for f in loader.data if not manifest.is_current(f, pipeline)
+            ]
+            skipped -= len(loader.data)
+            print(f"Skipping {skipped} up to date files")
 
         n = 0
-        filenames = loader.filenames
+        filenames = loader.data
+        failures = []
 
         sys.stdout.write("Streaming. {}/{} Done  \r".format(n, len(filenames)))
         sys.stdout.flush()
 
-        for content, filename in zip(loader, filenames):
-
-            content = self.transform(content, filename, transforms)
+        func = partial(_transform_item, self, transforms, digest=sink is None)
+        if profiler is not None:
+            func = profiler.sample("preprocess.transform", func)
 
-            n += 1
-            sys.stdout.write("Streaming. {}/{} Done  \r".format(n, len(filenames)))
-            sys.stdout.flush()
+        results = parallel_map(
+            func,
+            zip(loader.stream(), filenames),
+            workers=workers,
+            chunksize=chunksize,
+            ordered=ordered,
+        )
+        try:
+            for result in results:
+                filename = filenames[result.index]
+                if result.error is not None:
+                    failures.append((filename, result.error))
+                elif sink is not None:
+                    sink.write(result.value, os.path.relpath(filename, source_path))
+                else:
+                    outputs, digest = result.value
+                    manifest.record(filename, pipeline, outputs, digest)
+
+                n += 1
+                sys.stdout.write(
+                    "Streaming. {}/{} Done. {} Failed  \r".format(
+                        n, len(filenames), len(failures)
+                    )
+                )
+                sys.stdout.flush()
+        finally:
+            manifest.save()
 
         print("")
 
+        for filename, error in failures:
+            print(f"Failed to transform {filename}\n{error}")
+
+        return failures
+
     @abstractmethod
-    def transform(self, content, filename, transforms) -> None:
+    def transform(self, content, filename, transforms):
         """
         Transforms data and saves to disk
 
@@ -106,12 +248,45 @@ class DataStreamer(ABC):
             content to be transformed.
         filename: str
             Name of file without extension
-        transforms : list
-            List of transforms to be applied
+        transforms : Pipeline
+            Pipeline to be applied, e.g. with transforms.stream(events)
+
+        Returns
+        -------
+        outputs: str or list or array_like
+            Path or list of paths written. Recorded in the manifest so stale and orphaned outputs can be removed.
+            When preprocessing into a sink, the tokens to write instead.
         """
         ...
 
 
+def _transform_item(streamer, transforms, item, digest=False):
+    """
+    Transforms a single (content, filename) item with the given streamer.
+    Module level so it can be sent to worker processes.
+
+    Parameters
+    ----------
+    streamer : DataStreamer
+        Streamer whose transform is applied.
+    transforms : Pipeline
+        Pipeline to be applied.
+    item : tuple
+        Tuple of content and filename.
+    digest : bool
+        If True, the file is hashed for the manifest as well, so the hashing is
+        spread over the workers instead of done by the main process.
+
+    Returns
+    -------
+    outputs
+        The outputs of transform. With digest, a tuple of the outputs and the file_hash of filename.
+    """
+    content, filename = item
+    outputs = streamer.transform(content, filename, transforms)
+    return (outputs, file_hash(filename)) if digest else outputs
+
+
 def savecontentlist(contentlist, filename) -> None:
     """
     Saves a list of content to a csv file
@@ -128,7 +303,100 @@ def savecontentlist(contentlist, filename) -> None:
             f.write("{}.csv\n".format(item[:-4]))
 
 
-def split(data_path, train=0.8, val=0.1, test=0.1) -> None:
+def assign_split(key, train=0.8, val=0.1, salt="") -> str:
+    """
+    Assigns a key to a split by a stable hash of the key.
+
+    The assignment only depends on the key, so it is the same on every node,
+    independent of walk order and unaffected by adding other files.
+
+    Parameters
+    ----------
+    key : str
+        Key to assign, e.g. the path of a file relative to the data folder.
+    train : float
+        Percentage of keys assigned to training. The default is 0.8.
+    val : float
+        Percentage of keys assigned to validation. The default is 0.1.
+    salt : str
+        Salt mixed into the hash to draw a different split. The default is no salt.
+
+    Returns
+    -------
+    split : str
+        One of "train", "val" or "test".
+    """
+    digest = hashlib.blake2b(f"{salt}{key}".encode(), digest_size=8).digest()
+    u = int.from_bytes(digest, "big") / 2**64
+
+    if u < train:
+        return "train"
+    if u < train + val:
+        return "val"
+    return "test"
+
+
+def split_of(relpath, train=0.8, val=0.1, salt="", group=None) -> str:
+    """
+    Split of a file, as assigned by split with method "hash".
+
+    Parameters
+    ----------
+    relpath : str
+        Path of the file relative to its data folder.
+    train : float
+        Percentage of keys assigned to training. The default is 0.8.
+    val : float
+        Percentage of keys assigned to validation. The default is 0.1.
+    salt : str
+        Salt for drawing a different split. The default is no salt.
+    group : callable or str
+        Function or regex mapping relpath to a group key, see split. The default is to split by file.
+
+    Returns
+    -------
+    split : str
+        One of "train", "val" or "test".
+    """
+    return assign_split(_group_key(relpath, group), train, val, salt)
+
+
+def _group_key(relpath, group) -> str:
+    """
+    Parameters
+    ----------
+    relpath : str
+        Path of a file relative to the cleaned data folder.
+    group : callable or str or None
+        Function mapping relpath to a key, or a regex whose first group (or whole match) is the key.
+
+    Returns
+    -------
+    key : str
+        Key that decides the split of relpath.
+    """
+    if group is None:
+        return relpath
+    if callable(group):
+        return group(relpath)
+
+    match = re.search(group, relpath)
+    if match is None:
+        return relpath
+    return match.group(1) if match.groups() else match.group(0)
+
+
+def split(
+    data_path,
+    train=0.8,
+    val=0.1,
+    test=0.1,
+    folder="cleandata",
+    method="hash",
+    group=None,
+    salt="",
+    partition=None,
+) -> None:
     """
     Parameters
     ----------
@@ -140,27 +408,71 @@ def split(data_path, train=0.8, val=0.1, test=0.1) -> None:
         Percentage of data to be used for validation. The default is 0.1.
     test : float
         Percentage of data to be used for testing. The default is 0.1.
+    folder : str
+        Name of the folder with the cleaned data. The default is cleandata.
+    method : str
+        "hash" streams every file to the split given by assign_split. "position"
+        cuts the list of files by position. The default is "hash".
+    group : callable or str
+        Only used by "hash". Function or regex mapping the relative path of a file
+        to a group key. Files with the same key end up in the same split.
+        The default is to split by file.
+    salt : str
+        Only used by "hash". Salt for drawing a different split. The default is no salt.
+    partition : Partition
+        Only used by "hash". If given, only the cleaned files recorded in the manifest
+        of the partition are split, and the lists are written to its folder for
+        merge_partitions. The default is all files.
 
     Returns
     -------
     None
     """
 
-    filenames = [
-        y
-        for x in os.walk(os.path.join(data_path, "clean_data"))
-        for y in glob(os.path.join(x[0], "*.csv"))
-    ]
     if train + val + test != 1:
         raise Exception("Set portions don't add up to 1")
 
+    if method == "hash":
+        clean_path = os.path.join(data_path, folder)
+        target, filenames = data_path, scan(clean_path, "*.csv")
+        if partition is not None:
+            if os.path.exists(os.path.join(partition.shards(data_path), "index.npy")):
+                raise ValueError(
+                    f"Partition {partition.name} is packed into shards, which store the split"
+                )
+            # Listing the outputs of the partition avoids walking the whole cleaned folder.
+            target = partition.folder(data_path)
+            filenames = partition.outputs(data_path, "*.csv")
+        paths = {
+            name: os.path.join(target, f"{name}.txt")
+            for name in ("train", "val", "test")
+        }
+        files = {name: open(f"{path}.tmp", "w") for name, path in paths.items()}
+        try:
+            for filename in filenames:
+                relpath = os.path.relpath(filename, clean_path)
+                files[split_of(relpath, train, val, salt, group)].write(f"{filename}\n")
+        finally:
+            for f in files.values():
+                f.close()
+        for path in paths.values():
+            os.replace(f"{path}.tmp", path)
+        return
+
+    if method != "position":
+        raise ValueError(f"Unknown split method {method}")
+    if partition is not None:
+        raise ValueError("Partitions can only be split with method hash")
+
+    filenames = FileIndex(os.path.join(data_path, folder), "*.csv").files
+
     train_portion = math.floor(train * len(filenames))
     val_portion = math.floor(val * len(filenames))
     test_portion = math.floor(test * len(filenames))
 
     train = filenames[:train_portion]
     val = filenames[train_portion : train_portion + val_portion]  # noqa
-    test = filenames[-test_portion:]
+    test = filenames[len(filenames) - test_portion :]  # noqa
 
     savecontentlist(train, os.path.join(data_path, "train.txt"))
     savecontentlist(val, os.path.join(data_path, "val.txt"))
@@ -0,0 +1,223 @@
+"""
+Indexer
+=======
+Single pass file indexing with os.scandir and an on-disk index cache.
+"""
+
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatch
+from typing import Iterator, Optional, Tuple
+
+
+def _scandir(path: str, pattern: str) -> Tuple[int, list, list]:
+    """
+    Lists a single directory.
+
+    Parameters
+    ----------
+    path: str
+        Directory to list.
+    pattern: str
+        Glob pattern files must match, e.g. "*.mid". Hidden files never match, like with glob.
+
+    Returns
+    -------
+    mtime: int
+        Modification time of the directory in nanoseconds.
+    files: list
+        Sorted paths of matching files.
+    dirs: list
+        Sorted paths of subdirectories.
+    """
+    files, dirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif not entry.name.startswith(".") and fnmatch(entry.name, pattern):
+                files.append(entry.path)
+    return os.stat(path).st_mtime_ns, sorted(files), sorted(dirs)
+
+
+def walk(folder: str, pattern: str = "*", workers: int = 1) -> Iterator[tuple]:
+    """
+    Walks folder once, listing every directory a single time.
+
+    With more than one worker directories are listed on a thread pool, which
+    hides the metadata latency of network filesystems. Directories are then
+    yielded in the order they finish instead of depth first.
+
+    Parameters
+    ----------
+    folder: str
+        Folder to walk.
+    pattern: str
+        Glob pattern files must match.
+    workers: int
+        Number of threads listing directories.
+
+    Yields
+    ------
+    directory: tuple
+        Tuple of the directory path, its mtime in nanoseconds and its matching files.
+    """
+    if workers <= 1:
+        stack = [folder]
+        while stack:
+            path = stack.pop()
+            mtime, files, dirs = _scandir(path, pattern)
+            yield path, mtime, files
+            stack.extend(reversed(dirs))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scandir, folder, pattern): folder}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                mtime, files, dirs = future.result()
+                for directory in dirs:
+                    pending[executor.submit(_scandir, directory, pattern)] = directory
+                yield path, mtime, files
+
+
+def scan(folder: str, pattern: str = "*", workers: int = 1) -> Iterator[str]:
+    """
+    Streams the paths of all files in folder matching pattern.
+
+    Parameters
+    ----------
+    folder: str
+        Folder to search.
+    pattern: str
+        Glob pattern files must match.
+    workers: int
+        Number of threads listing directories.
+
+    Yields
+    ------
+    filename: str
+        Path to a matching file.
+    """
+    for _, _, files in walk(folder, pattern, workers):
+        yield from files
+
+
+class FileIndex:
+    """
+    Cached list of the files in a folder matching a pattern.
+
+    The index stores the mtime of every directory it listed. Adding, removing
+    or renaming a file changes the mtime of its directory, so the index can be
+    validated with one stat per directory instead of listing the whole tree.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        pattern: str = "*",
+        path: Optional[str] = None,
+        workers: int = 1,
+    ):
+        """
+        Initialize the FileIndex class.
+
+        Parameters
+        ----------
+        folder: str
+            Folder to index.
+        pattern: str
+            Glob pattern files must match.
+        path: str
+            Path to the index file. Defaults to <folder>.index.json next to folder,
+            so writing it does not change the indexed tree.
+        workers: int
+            Number of threads listing directories when the index is rebuilt.
+        """
+        self.folder = os.path.normpath(folder)
+        self.pattern = pattern
+        self.path = path or f"{self.folder}.index.json"
+        self.workers = workers
+
+    def load(self) -> Optional[dict]:
+        """
+        Returns
+        -------
+        index: dict or None
+            The saved index, or None if it is missing or for another pattern.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            index = json.load(f)
+        if index.get("pattern") != self.pattern:
+            return None
+        return index
+
+    def is_current(self, index: dict) -> bool:
+        """
+        Whether no directory changed since index was built.
+
+        Parameters
+        ----------
+        index: dict
+            A loaded index.
+
+        Returns
+        -------
+        current: bool
+            True if the index can be reused.
+        """
+        try:
+            return all(
+                os.stat(os.path.join(self.folder, d)).st_mtime_ns == mtime
+                for d, mtime in index["dirs"].items()
+            )
+        except FileNotFoundError:
+            return False
+
+    def build(self) -> list:
+        """
+        Walks the folder and saves the index. If the index cannot be written,
+        e.g. on a read only filesystem, the result is returned without caching.
+
+        Returns
+        -------
+        files: list
+            Paths of all matching files.
+        """
+        dirs, files = {}, []
+        for path, mtime, found in walk(self.folder, self.pattern, self.workers):
+            dirs[os.path.relpath(path, self.folder)] = mtime
+            files.extend(found)
+
+        index = {
+            "pattern": self.pattern,
+            "dirs": dirs,
+            "files": [os.path.relpath(f, self.folder) for f in files],
+        }
+        try:
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+        return files
+
+    @property
+    def files(self) -> list:
+        """
+        Returns
+        -------
+        files: list
+            Paths of all matching files, from the saved index if it is still current.
+        """
+        index = self.load()
+        if index is None or not self.is_current(index):
+            return self.build()
+        return [os.path.join(self.folder, f) for f in index["files"]]
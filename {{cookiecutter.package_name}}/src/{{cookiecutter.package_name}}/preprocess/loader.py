@@ -4,8 +4,11 @@ Loader class for the datastreamer class.
 import os
 import random
 
-from glob import glob
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from {{cookiecutter.package_name}}.preprocess.indexer import FileIndex, scan
 
 
 class Loader(ABC):
@@ -13,7 +16,16 @@ class Loader(ABC):
     Class for loading and streaming files.
     """
 
-    def __init__(self, folder, shuffle=False):
+    def __init__(
+        self,
+        folder,
+        shuffle=False,
+        cache=True,
+        scan_workers=1,
+        readahead=0,
+        readahead_bytes=256 * 2**20,
+        readahead_workers=4,
+    ):
         """
         Initialize the Loader class.
 
@@ -23,11 +35,26 @@ class Loader(ABC):
             Path to folder containing files.
         shuffle: bool
             If True, shuffle files before loading.
+        cache: bool
+            If True, reuse the file index saved next to folder until the tree changes.
+        scan_workers: int
+            Number of threads listing directories when indexing folder.
+        readahead: int
+            Number of files stream loads ahead on a thread pool. 0 disables read-ahead.
+        readahead_bytes: int
+            Maximum size on disk of the files loaded ahead. At least one file is always loaded.
+        readahead_workers: int
+            Number of threads loading files ahead.
         """
 
         if not os.path.exists(folder):
             raise FileNotFoundError(f"Folder {folder} does not exist")
         self.folder = folder
+        self.cache = cache
+        self.scan_workers = scan_workers
+        self.readahead = readahead
+        self.readahead_bytes = readahead_bytes
+        self.readahead_workers = readahead_workers
 
         if shuffle:
             self.data = self.shuffled_files
@@ -41,6 +68,64 @@ class Loader(ABC):
         """
         ...
 
+    def load(self, filename):
+        """
+        Loads a single file. Implement to enable read-ahead in stream.
+
+        Parameters
+        ----------
+        filename: str
+            Path to the file.
+
+        Returns
+        -------
+        content
+            Content of the file, as yielded by __iter__.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not implement load")
+
+    def stream(self):
+        """
+        Iterate over the content of the files in self.data.
+
+        With read-ahead the next files are loaded on a thread pool while the
+        current one is processed, so disk and network filesystem latency
+        overlaps with the work on the content. Content is yielded in order.
+        Loaders that do not implement load are iterated without read-ahead.
+
+        Yields
+        ------
+        content
+            Content of the next file.
+        """
+        if self.readahead <= 0 or type(self).load is Loader.load:
+            yield from self
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self.readahead_workers)
+        pending = deque()
+        held = 0
+        filenames = iter(self.data)
+        filename = next(filenames, None)
+        try:
+            while True:
+                while filename is not None and len(pending) < self.readahead:
+                    size = os.path.getsize(filename)
+                    if pending and held + size > self.readahead_bytes:
+                        break
+                    pending.append((executor.submit(self.load, filename), size))
+                    held += size
+                    filename = next(filenames, None)
+
+                if not pending:
+                    return
+
+                future, size = pending.popleft()
+                held -= size
+                yield future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
     @property
     @abstractmethod
     def extension(self):
@@ -63,13 +148,12 @@ class Loader(ABC):
         list
             List of filenames in self.folder.
         """
-        result = [
-            y
-            for x in os.walk(self.folder)
-            for y in glob(os.path.join(x[0], self.extension))
-        ]
+        if self.cache:
+            return FileIndex(
+                self.folder, self.extension, workers=self.scan_workers
+            ).files
 
-        return result
+        return list(scan(self.folder, self.extension, workers=self.scan_workers))
 
     @property
     def shuffled_files(self):
@@ -0,0 +1,247 @@
+"""
+Manifest
+========
+Bookkeeping of preprocessed files, so reruns only transform what changed.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+
+
+def file_hash(filename: str, blocksize: int = 1 << 20) -> str:
+    """
+    Content hash of a file.
+
+    Parameters
+    ----------
+    filename: str
+        Path to the file.
+    blocksize: int
+        Number of bytes read at a time.
+
+    Returns
+    -------
+    digest: str
+        Hex digest of the file content.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _describe(obj) -> str:
+    """
+    Stable text description of an object used for fingerprinting.
+
+    Functions and classes are described by their qualified name and source code,
+    so editing a transform invalidates its outputs.
+
+    Parameters
+    ----------
+    obj
+        Object to describe.
+
+    Returns
+    -------
+    description: str
+        Description of obj.
+    """
+    if isinstance(obj, (list, tuple)):
+        return "[" + ",".join(_describe(item) for item in obj) + "]"
+    if isinstance(obj, dict):
+        return (
+            "{" + ",".join(f"{k}:{_describe(v)}" for k, v in sorted(obj.items())) + "}"
+        )
+    if inspect.isfunction(obj) or inspect.ismethod(obj) or inspect.isclass(obj):
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            source = ""
+        return f"{obj.__module__}.{obj.__qualname__}:{source}"
+    if hasattr(obj, "__dict__"):
+        return _describe(type(obj)) + _describe(vars(obj))
+    return repr(obj)
+
+
+def fingerprint(*objects) -> str:
+    """
+    Fingerprint of a transform pipeline.
+
+    Parameters
+    ----------
+    objects
+        Objects that determine the output, e.g. the transform method and the list of transforms.
+
+    Returns
+    -------
+    digest: str
+        Hex digest that changes whenever one of the objects changes.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for obj in objects:
+        h.update(_describe(obj).encode())
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    Records which outputs were built from which source file and transform pipeline.
+
+    Entries are keyed by the source path relative to root and hold the size,
+    mtime and content hash of the source, the pipeline fingerprint and the outputs.
+    """
+
+    def __init__(self, path: str, root: str):
+        """
+        Initialize the Manifest class. Loads the manifest if it exists.
+
+        Parameters
+        ----------
+        path: str
+            Path to the manifest file.
+        root: str
+            Folder that source and output paths are stored relative to.
+        """
+        self.path = path
+        self.root = root
+        self.entries = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def key(self, filename: str) -> str:
+        """
+        Parameters
+        ----------
+        filename: str
+            Path to a file.
+
+        Returns
+        -------
+        key: str
+            Path of filename relative to root.
+        """
+        return os.path.relpath(filename, self.root)
+
+    def is_current(self, source: str, fingerprint: str) -> bool:
+        """
+        Whether the outputs of source are up to date.
+
+        Size and mtime are checked first. The content is only hashed if they
+        changed, so touching a file does not trigger a rebuild.
+
+        Parameters
+        ----------
+        source: str
+            Path to the source file.
+        fingerprint: str
+            Fingerprint of the current transform pipeline.
+
+        Returns
+        -------
+        current: bool
+            True if source does not need to be transformed again.
+        """
+        entry = self.entries.get(self.key(source))
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return False
+
+        if not all(
+            os.path.exists(os.path.join(self.root, o)) for o in entry["outputs"]
+        ):
+            return False
+
+        stat = os.stat(source)
+        if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime"]:
+            return True
+
+        if stat.st_size != entry["size"] or file_hash(source) != entry["hash"]:
+            return False
+
+        entry["mtime"] = stat.st_mtime_ns
+        return True
+
+    def record(
+        self, source: str, fingerprint: str, outputs=None, digest: str = None
+    ) -> None:
+        """
+        Records that source was transformed into outputs.
+        Outputs of a previous build that are no longer produced are removed.
+
+        Parameters
+        ----------
+        source: str
+            Path to the source file.
+        fingerprint: str
+            Fingerprint of the transform pipeline used.
+        outputs: str or list
+            Path or list of paths written by the transform.
+        digest: str
+            file_hash of source, if it was already computed, e.g. in a worker process.
+        """
+        if outputs is None:
+            outputs = []
+        elif isinstance(outputs, (str, os.PathLike)):
+            outputs = [outputs]
+        outputs = [self.key(o) for o in outputs]
+
+        key = self.key(source)
+        previous = self.entries.get(key, {}).get("outputs", [])
+        self._remove([o for o in previous if o not in outputs])
+
+        stat = os.stat(source)
+        self.entries[key] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": file_hash(source) if digest is None else digest,
+            "fingerprint": fingerprint,
+            "outputs": outputs,
+        }
+
+    def collect_garbage(self, sources: list) -> list:
+        """
+        Removes entries and outputs of source files that no longer exist.
+
+        Parameters
+        ----------
+        sources: list
+            Paths to all current source files.
+
+        Returns
+        -------
+        removed: list
+            Keys of the removed entries.
+        """
+        keep = {self.key(s) for s in sources}
+        removed = [key for key in self.entries if key not in keep]
+        for key in removed:
+            self._remove(self.entries.pop(key)["outputs"])
+        return removed
+
+    def _remove(self, outputs: list) -> None:
+        """
+        Deletes output files if they exist.
+
+        Parameters
+        ----------
+        outputs: list
+            Output paths relative to root.
+        """
+        for output in outputs:
+            path = os.path.join(self.root, output)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def save(self) -> None:
+        """
+        Writes the manifest atomically, so an interrupted run never leaves a corrupt file.
+        """
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
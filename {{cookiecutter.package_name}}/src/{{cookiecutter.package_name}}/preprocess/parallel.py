@@ -0,0 +1,188 @@
+"""
+Parallel
+========
+Helpers for fanning work out to a pool of worker processes.
+"""
+
+import os
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional
+
+
+class TaskResult(NamedTuple):
+    """
+    Outcome of applying a function to a single item.
+
+    Parameters
+    ----------
+    index: int
+        Position of the item in the input iterable.
+    value: Any
+        Return value of the function. None if the call failed.
+    error: str or None
+        Formatted traceback if the call failed, otherwise None.
+    """
+
+    index: int
+    value: Any
+    error: Optional[str]
+
+
+def available_cpus() -> int:
+    """
+    Number of CPUs this process is allowed to use.
+
+    SLURM_CPUS_PER_TASK takes precedence, then the CPU affinity mask of the
+    process and finally the total number of CPUs on the machine.
+
+    Returns
+    -------
+    cpus: int
+        Number of usable CPUs. Always at least 1.
+    """
+    slurm_cpus = os.environ.get("SLURM_CPUS_PER_TASK")
+    if slurm_cpus and slurm_cpus.isdigit():
+        return max(1, int(slurm_cpus))
+
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+
+    return max(1, os.cpu_count() or 1)
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    """
+    Splits an iterable into lists of at most size items.
+
+    Parameters
+    ----------
+    iterable: Iterable
+        Items to split.
+    size: int
+        Maximum number of items per chunk.
+
+    Yields
+    ------
+    chunk: list
+        The next chunk of items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _apply_chunk(func: Callable, start: int, chunk: list) -> list:
+    """
+    Applies func to every item of a chunk, capturing failures per item.
+
+    Parameters
+    ----------
+    func: Callable
+        Function to apply.
+    start: int
+        Index of the first item of the chunk in the full input.
+    chunk: list
+        Items to apply func to.
+
+    Returns
+    -------
+    results: list
+        A TaskResult for every item in chunk.
+    """
+    results = []
+    for offset, item in enumerate(chunk):
+        try:
+            results.append(TaskResult(start + offset, func(item), None))
+        except Exception:
+            results.append(TaskResult(start + offset, None, traceback.format_exc()))
+    return results
+
+
+def parallel_map(
+    func: Callable,
+    iterable: Iterable,
+    workers: int = 1,
+    chunksize: int = 16,
+    window: Optional[int] = None,
+    ordered: bool = True,
+) -> Iterator[TaskResult]:
+    """
+    Applies func to every item of iterable using a pool of processes.
+
+    Items are sent to the workers in chunks and at most window chunks are in
+    flight at once, so the iterable is consumed lazily and memory stays bounded.
+    An exception raised by func is reported in the TaskResult of that item
+    and does not stop the other items from being processed.
+
+    Parameters
+    ----------
+    func: Callable
+        Function taking a single item. Must be picklable when workers > 1.
+    iterable: Iterable
+        Items to process.
+    workers: int
+        Number of worker processes. With 1 everything runs in this process.
+    chunksize: int
+        Number of items sent to a worker at a time.
+    window: int
+        Maximum number of chunks in flight. Defaults to twice the number of workers.
+    ordered: bool
+        If True results are yielded in input order, otherwise as they complete.
+
+    Yields
+    ------
+    result: TaskResult
+        Outcome for each item.
+    """
+    chunks = chunked(iterable, chunksize)
+
+    if workers <= 1:
+        start = 0
+        for chunk in chunks:
+            yield from _apply_chunk(func, start, chunk)
+            start += len(chunk)
+        return
+
+    window = window or 2 * workers
+    start = 0
+    pending = deque()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        def submit() -> bool:
+            """Submits the next chunk. Returns False when the input is exhausted."""
+            nonlocal start
+            chunk = next(chunks, None)
+            if chunk is None:
+                return False
+            future = executor.submit(_apply_chunk, func, start, chunk)
+            pending.append((future, start, len(chunk)))
+            start += len(chunk)
+            return True
+
+        while len(pending) < window and submit():
+            pass
+
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                finished, _ = wait([p[0] for p in pending], return_when=FIRST_COMPLETED)
+                done = [p for p in pending if p[0] in finished]
+                for task in done:
+                    pending.remove(task)
+
+            for future, first, size in done:
+                try:
+                    yield from future.result()
+                except Exception:
+                    error = traceback.format_exc()
+                    for index in range(first, first + size):
+                        yield TaskResult(index, None, error)
+                submit()
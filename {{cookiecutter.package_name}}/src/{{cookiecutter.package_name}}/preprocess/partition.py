@@ -0,0 +1,307 @@
+"""
+Partition
+=========
+Preprocessing spread over the tasks of a SLURM job array.
+
+Every task preprocesses one partition of the raw files. A file belongs to a
+partition by a stable hash of its path, so the partition does not depend on
+the order files are listed in and adding files does not move the others.
+
+A task keeps its manifest and split lists in its own folder, parts/<index>-of-<count>
+of the data folder, so tasks never write the same file. merge_partitions
+combines them into the manifest, split lists and shards of a single run.
+Partitions packed into shards store the split in their shards and have no
+split lists, see ShardWriter.
+
+The flow can be tried locally by setting the variables of an array task::
+
+    SLURM_ARRAY_TASK_ID=0 SLURM_ARRAY_TASK_COUNT=2 {{cookiecutter.package_name}} preprocess --shard slurm
+    SLURM_ARRAY_TASK_ID=1 SLURM_ARRAY_TASK_COUNT=2 {{cookiecutter.package_name}} preprocess --shard slurm
+    {{cookiecutter.package_name}} merge
+"""
+
+import hashlib
+import os
+import re
+from fnmatch import fnmatch
+from glob import escape as glob_escape
+from glob import glob
+from typing import Mapping, NamedTuple
+
+from {{cookiecutter.package_name}}.preprocess.manifest import Manifest
+from {{cookiecutter.package_name}}.preprocess.shards import merge_shards
+
+PARTS_FOLDER = "parts"
+SPLITS = ("train", "val", "test")
+
+
+class Partition(NamedTuple):
+    """
+    Partition index of count partitions, e.g. the task of a job array.
+    """
+
+    index: int
+    count: int
+
+    @classmethod
+    def parse(cls, text: str, environ: Mapping = os.environ) -> "Partition":
+        """
+        Parameters
+        ----------
+        text: str
+            "i/n" for partition i of n, counted from 0, or "slurm" for the task of the job array.
+        environ: Mapping
+            Environment read for "slurm".
+
+        Returns
+        -------
+        partition: Partition
+            The partition.
+        """
+        if text.strip().lower() == "slurm":
+            return cls.from_slurm(environ)
+        match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", text)
+        if match is None:
+            raise ValueError(f"Expected a partition like 3/16 or 'slurm', got {text!r}")
+        return cls.checked(int(match.group(1)), int(match.group(2)))
+
+    @classmethod
+    def from_slurm(cls, environ: Mapping = os.environ) -> "Partition":
+        """
+        Partition of the task of a SLURM job array. Task ids are counted from
+        SLURM_ARRAY_TASK_MIN, so --array=1-16 works as well as --array=0-15.
+
+        Parameters
+        ----------
+        environ: Mapping
+            Environment with SLURM_ARRAY_TASK_ID and SLURM_ARRAY_TASK_COUNT.
+
+        Returns
+        -------
+        partition: Partition
+            The partition of the task.
+        """
+        if (
+            "SLURM_ARRAY_TASK_ID" not in environ
+            or "SLURM_ARRAY_TASK_COUNT" not in environ
+        ):
+            raise ValueError(
+                "SLURM_ARRAY_TASK_ID and SLURM_ARRAY_TASK_COUNT are not set, "
+                "start the job with sbatch --array"
+            )
+        index = int(environ["SLURM_ARRAY_TASK_ID"]) - int(
+            environ.get("SLURM_ARRAY_TASK_MIN", 0)
+        )
+        return cls.checked(index, int(environ["SLURM_ARRAY_TASK_COUNT"]))
+
+    @classmethod
+    def checked(cls, index: int, count: int) -> "Partition":
+        """
+        Parameters
+        ----------
+        index: int
+            Index of the partition, from 0 to count - 1.
+        count: int
+            Number of partitions.
+
+        Returns
+        -------
+        partition: Partition
+            The partition. Raises ValueError if index is out of range.
+        """
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(
+                f"Partition {index} of {count} is out of range. Job arrays need "
+                "consecutive task ids without a step"
+            )
+        return cls(index, count)
+
+    @property
+    def name(self) -> str:
+        """Name of the folder of the partition, e.g. 00003-of-00016."""
+        return f"{self.index:05d}-of-{self.count:05d}"
+
+    def folder(self, data_path: str) -> str:
+        """
+        Parameters
+        ----------
+        data_path: str
+            Path to the data folder.
+
+        Returns
+        -------
+        folder: str
+            Folder of the manifest and split lists of the partition.
+        """
+        return os.path.join(data_path, PARTS_FOLDER, self.name)
+
+    def contains(self, key: str) -> bool:
+        """
+        Parameters
+        ----------
+        key: str
+            Path of a raw file relative to the raw data folder.
+
+        Returns
+        -------
+        contains: bool
+            True if the file belongs to this partition.
+        """
+        # Personalized, so the partition is independent of the split drawn by assign_split.
+        digest = hashlib.blake2b(
+            key.encode(), digest_size=8, person=b"partition"
+        ).digest()
+        return int.from_bytes(digest, "big") % self.count == self.index
+
+    def shards(self, data_path: str) -> str:
+        """
+        Parameters
+        ----------
+        data_path: str
+            Path to the data folder.
+
+        Returns
+        -------
+        folder: str
+            Folder of the shards of the partition.
+        """
+        return os.path.join(self.folder(data_path), "shards")
+
+    def finished(self, data_path: str, shards: bool = False) -> bool:
+        """
+        Parameters
+        ----------
+        data_path: str
+            Path to the data folder.
+        shards: bool
+            If True, the partition was packed into shards.
+
+        Returns
+        -------
+        finished: bool
+            True if the partition wrote its shards index, or its split lists.
+        """
+        if shards:
+            return os.path.exists(os.path.join(self.shards(data_path), "index.npy"))
+        return all(
+            os.path.exists(os.path.join(self.folder(data_path), f"{s}.txt"))
+            for s in SPLITS
+        )
+
+    def outputs(self, data_path: str, pattern: str = "*") -> list:
+        """
+        Parameters
+        ----------
+        data_path: str
+            Path to the data folder.
+        pattern: str
+            Glob pattern the file names of outputs must match.
+
+        Returns
+        -------
+        outputs: list
+            Sorted paths of the outputs recorded in the manifest of the partition.
+        """
+        manifest = Manifest(
+            os.path.join(self.folder(data_path), "manifest.json"), data_path
+        )
+        return sorted(
+            os.path.join(data_path, output)
+            for entry in manifest.entries.values()
+            for output in entry["outputs"]
+            if fnmatch(os.path.basename(output), pattern)
+        )
+
+
+def find_partitions(data_path: str, shards: bool = False) -> list:
+    """
+    Parameters
+    ----------
+    data_path: str
+        Path to the data folder.
+    shards: bool
+        If True, the partitions are expected to be packed into shards.
+
+    Returns
+    -------
+    partitions: list
+        Partitions with a folder, sorted. Raises if they are not all partitions of
+        the same count or some did not write their split lists, or shards, yet.
+    """
+    root = os.path.join(data_path, PARTS_FOLDER)
+    names = sorted(os.listdir(root)) if os.path.isdir(root) else []
+    partitions = [
+        Partition(int(match.group(1)), int(match.group(2)))
+        for match in (re.fullmatch(r"(\d+)-of-(\d+)", name) for name in names)
+        if match is not None
+    ]
+    if not partitions:
+        raise FileNotFoundError(f"No partitions found in {root}")
+    counts = {p.count for p in partitions}
+    if len(counts) > 1:
+        raise ValueError(
+            f"Partitions of different counts {sorted(counts)} in {root}, remove the stale ones"
+        )
+    count = counts.pop()
+    finished = {p.index for p in partitions if p.finished(data_path, shards)}
+    missing = sorted(set(range(count)) - finished)
+    if missing:
+        raise FileNotFoundError(
+            f"Partitions {missing} of {count} did not finish, rerun their array tasks"
+        )
+    return [Partition(index, count) for index in range(count)]
+
+
+def merge_partitions(data_path: str) -> int:
+    """
+    Combines the outputs of all partitions, as if the data was preprocessed in one run.
+
+    * The manifests are merged into the manifest of the data folder.
+    * The split lists are concatenated into train.txt, val.txt and test.txt.
+
+    If any partition was packed into shards, all of them must be, and only
+    the shards are merged into the shards folder, see merge_shards. They carry
+    the split of every sequence and, like a single run into shards, leave the
+    manifest and split lists alone.
+
+    The partition folders are kept, so their next runs are incremental and the
+    merge can be repeated.
+
+    Parameters
+    ----------
+    data_path: str
+        Path to the data folder.
+
+    Returns
+    -------
+    partitions: int
+        Number of merged partitions.
+    """
+    root = os.path.join(data_path, PARTS_FOLDER)
+    shards = bool(glob(os.path.join(glob_escape(root), "*", "shards", "index.npy")))
+    partitions = find_partitions(data_path, shards)
+    if shards:
+        merge_shards(
+            [p.shards(data_path) for p in partitions],
+            os.path.join(data_path, "shards"),
+        )
+        return len(partitions)
+
+    folders = [p.folder(data_path) for p in partitions]
+
+    manifest = Manifest(os.path.join(data_path, "manifest.json"), data_path)
+    manifest.entries = {}
+    for folder in folders:
+        manifest.entries.update(
+            Manifest(os.path.join(folder, "manifest.json"), data_path).entries
+        )
+    manifest.save()
+
+    for name in SPLITS:
+        path = os.path.join(data_path, f"{name}.txt")
+        with open(f"{path}.tmp", "w") as out:
+            for folder in folders:
+                with open(os.path.join(folder, f"{name}.txt")) as f:
+                    out.writelines(f)
+        os.replace(f"{path}.tmp", path)
+    return len(partitions)
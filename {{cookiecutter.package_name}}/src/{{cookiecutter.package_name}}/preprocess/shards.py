@@ -0,0 +1,297 @@
+"""
+Shards
+======
+Packed binary shards of token sequences that can be read with numpy.memmap.
+
+A shard folder contains:
+
+* shard_00000.bin, shard_00001.bin, ... raw token arrays back to back.
+* index.npy with the shard, offset, length and split of every sequence.
+* names.txt with the name of every sequence.
+* meta.json with the dtype and number of shards.
+"""
+
+import json
+import os
+import shutil
+from glob import glob
+
+import numpy as np
+
+SPLITS = ("train", "val", "test")
+UNASSIGNED = -1
+INDEX_DTYPE = np.dtype(
+    [
+        ("shard", np.int32),
+        ("offset", np.int64),
+        ("length", np.int64),
+        ("split", np.int8),
+    ]
+)
+
+
+def _upgrade_index(index: np.ndarray) -> np.ndarray:
+    """
+    Parameters
+    ----------
+    index: np.ndarray
+        Index loaded from index.npy, possibly written before splits were stored.
+
+    Returns
+    -------
+    index: np.ndarray
+        The index with INDEX_DTYPE. Sequences without a stored split are UNASSIGNED.
+    """
+    if index.dtype == INDEX_DTYPE:
+        return index
+    upgraded = np.full(len(index), UNASSIGNED, dtype=INDEX_DTYPE)
+    for name in index.dtype.names:
+        upgraded[name] = index[name]
+    return upgraded
+
+
+class ShardWriter:
+    """
+    Writes token sequences into fixed size shards. Can be used as the sink of DataStreamer.preprocess.
+    """
+
+    def __init__(self, folder, shard_tokens=2**26, dtype="int32", assign=None):
+        """
+        Initialize the ShardWriter class. Existing shards in folder are replaced.
+
+        Parameters
+        ----------
+        folder: str
+            Folder to write the shards to.
+        shard_tokens: int
+            Maximum number of tokens per shard. A longer sequence gets a shard of its own.
+        dtype: str
+            Numpy dtype of the tokens.
+        assign: callable
+            Function mapping the name of a sequence to its split, "train", "val" or
+            "test", which is stored in the index. Defaults to leaving it unassigned.
+        """
+        self.folder = folder
+        self.shard_tokens = shard_tokens
+        self.dtype = np.dtype(dtype)
+        self.assign = assign
+
+        os.makedirs(folder, exist_ok=True)
+        for filename in glob(os.path.join(folder, "shard_*.bin")):
+            os.remove(filename)
+
+        self.index = []
+        self.names = []
+        self.shard = -1
+        self.offset = 0
+        self.file = None
+
+    def __enter__(self):
+        """Returns the writer."""
+        return self
+
+    def __exit__(self, *exc):
+        """Closes the writer."""
+        self.close()
+
+    def _next_shard(self) -> None:
+        """
+        Closes the current shard and starts a new one.
+        """
+        if self.file is not None:
+            self.file.close()
+        self.shard += 1
+        self.offset = 0
+        self.file = open(os.path.join(self.folder, f"shard_{self.shard:05d}.bin"), "wb")
+
+    def write(self, tokens, name="") -> tuple:
+        """
+        Appends a sequence.
+
+        Parameters
+        ----------
+        tokens: array_like
+            1D sequence of tokens.
+        name: str
+            Name of the sequence, e.g. the path of its source file.
+
+        Returns
+        -------
+        location: tuple
+            Shard, offset and length of the written sequence.
+        """
+        tokens = np.ascontiguousarray(tokens, dtype=self.dtype).reshape(-1)
+
+        if self.file is None or (
+            self.offset > 0 and self.offset + len(tokens) > self.shard_tokens
+        ):
+            self._next_shard()
+
+        self.file.write(tokens.tobytes())
+        location = (self.shard, self.offset, len(tokens))
+        split = UNASSIGNED if self.assign is None else SPLITS.index(self.assign(name))
+        self.index.append(location + (split,))
+        self.names.append(name)
+        self.offset += len(tokens)
+        return location
+
+    def close(self) -> None:
+        """
+        Closes the last shard and writes the index. The index is written last,
+        so readers never see an index pointing past the end of a shard.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        with open(os.path.join(self.folder, "names.txt"), "w") as f:
+            f.writelines(f"{name}\n" for name in self.names)
+        with open(os.path.join(self.folder, "meta.json"), "w") as f:
+            json.dump({"dtype": self.dtype.str, "shards": self.shard + 1}, f)
+
+        tmp = os.path.join(self.folder, "index.tmp.npy")
+        np.save(tmp, np.array(self.index, dtype=INDEX_DTYPE))
+        os.replace(tmp, os.path.join(self.folder, "index.npy"))
+
+
+class ShardReader:
+    """
+    Zero copy access to the sequences of a shard folder.
+    """
+
+    def __init__(self, folder):
+        """
+        Initialize the ShardReader class.
+
+        Parameters
+        ----------
+        folder: str
+            Folder written by a ShardWriter.
+        """
+        self.folder = folder
+
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+        self.dtype = np.dtype(meta["dtype"])
+        self.index = _upgrade_index(np.load(os.path.join(folder, "index.npy")))
+        with open(os.path.join(folder, "names.txt")) as f:
+            self.names = f.read().splitlines()
+
+        self._shards = {}
+
+    def __getstate__(self):
+        """Drops the open memory maps, so readers can be sent to DataLoader workers cheaply."""
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def __len__(self) -> int:
+        """Number of sequences."""
+        return len(self.index)
+
+    def __getitem__(self, i) -> np.ndarray:
+        """
+        Parameters
+        ----------
+        i: int
+            Index of the sequence.
+
+        Returns
+        -------
+        tokens: np.ndarray
+            Read only view of the sequence in its memory mapped shard.
+        """
+        entry = self.index[i]
+        shard, offset, length = entry["shard"], entry["offset"], entry["length"]
+        return self.shard(shard)[offset : offset + length]  # noqa
+
+    def shard(self, shard) -> np.ndarray:
+        """
+        Parameters
+        ----------
+        shard: int
+            Number of the shard.
+
+        Returns
+        -------
+        tokens: np.memmap
+            Memory map of the whole shard. Opened on first use.
+        """
+        shard = int(shard)
+        if shard not in self._shards:
+            filename = os.path.join(self.folder, f"shard_{shard:05d}.bin")
+            if os.path.getsize(filename) == 0:
+                self._shards[shard] = np.empty(0, dtype=self.dtype)
+            else:
+                self._shards[shard] = np.memmap(filename, dtype=self.dtype, mode="r")
+        return self._shards[shard]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """
+        Returns
+        -------
+        lengths: np.ndarray
+            Length of every sequence.
+        """
+        return self.index["length"]
+
+
+def merge_shards(folders: list, target: str) -> int:
+    """
+    Merges shard folders into one, keeping the order of the folders.
+
+    Shard files are hard linked into target, or copied if target is on another
+    filesystem, so the folders stay intact. The index is written last, like by
+    ShardWriter.
+
+    Parameters
+    ----------
+    folders: list
+        Folders written by ShardWriters with the same dtype.
+    target: str
+        Folder of the merged shards. Existing shards in it are replaced.
+
+    Returns
+    -------
+    sequences: int
+        Number of sequences in the merged folder.
+    """
+    os.makedirs(target, exist_ok=True)
+    # Readers must not find the old index next to the new shards.
+    if os.path.exists(os.path.join(target, "index.npy")):
+        os.remove(os.path.join(target, "index.npy"))
+    for filename in glob(os.path.join(target, "shard_*.bin")):
+        os.remove(filename)
+
+    index, names, shards, dtype = [], [], 0, None
+    for folder in folders:
+        reader = ShardReader(folder)
+        if dtype is not None and reader.dtype != dtype:
+            raise ValueError(f"{folder} holds {reader.dtype} tokens, expected {dtype}")
+        dtype = reader.dtype
+        with open(os.path.join(folder, "meta.json")) as f:
+            count = json.load(f)["shards"]
+        for shard in range(count):
+            source = os.path.join(folder, f"shard_{shard:05d}.bin")
+            destination = os.path.join(target, f"shard_{shards + shard:05d}.bin")
+            try:
+                os.link(source, destination)
+            except OSError:
+                shutil.copyfile(source, destination)
+        part = reader.index.copy()
+        part["shard"] += shards
+        index.append(part)
+        names.extend(reader.names)
+        shards += count
+
+    with open(os.path.join(target, "names.txt"), "w") as f:
+        f.writelines(f"{name}\n" for name in names)
+    with open(os.path.join(target, "meta.json"), "w") as f:
+        json.dump({"dtype": (dtype or np.dtype("int32")).str, "shards": shards}, f)
+
+    tmp = os.path.join(target, "index.tmp.npy")
+    merged = np.concatenate(index) if index else np.empty(0, dtype=INDEX_DTYPE)
+    np.save(tmp, merged)
+    os.replace(tmp, os.path.join(target, "index.npy"))
+    return len(merged)
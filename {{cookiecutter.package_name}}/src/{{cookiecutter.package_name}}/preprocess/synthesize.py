@@ -0,0 +1,301 @@
+"""
+Synthesize
+==========
+Generates a synthetic raw dataset, so loading, splitting and preprocessing can
+be tested at scale without downloading a corpus.
+
+Every file is derived from the seed and its index alone, so the same dataset is
+generated with any number of workers and an interrupted run can be continued.
+The seed of a finished run is kept in rawdata/.seed, and a run with another
+seed writes all files again.
+"""
+
+import os
+import struct
+from functools import partial
+from typing import Optional
+
+import numpy as np
+
+from {{cookiecutter.package_name}}.preprocess.parallel import parallel_map
+
+FORMATS = {"midi": ".mid", "csv": ".csv"}
+SEED_FILE = ".seed"
+
+
+def synthetic_path(
+    index: int, fanout: int = 16, depth: int = 2, extension: str = ".mid"
+) -> str:
+    """
+    Parameters
+    ----------
+    index: int
+        Index of the file.
+    fanout: int
+        Number of subfolders per folder.
+    depth: int
+        Number of folder levels below rawdata. 0 puts all files into rawdata.
+    extension: str
+        Extension of the file.
+
+    Returns
+    -------
+    path: str
+        Path of the file relative to rawdata, e.g. "03/0f/song_00001234.mid".
+        Files are spread round robin over the fanout ** depth leaf folders.
+    """
+    leaf = index % fanout**depth
+    parts = []
+    for _ in range(depth):
+        leaf, digit = divmod(leaf, fanout)
+        parts.append(f"{digit:02x}")
+    return os.path.join(*reversed(parts), f"song_{index:08d}{extension}")
+
+
+def synthetic_notes(
+    index: int, seed: int = 0, notes: int = 500, sigma: float = 1.0
+) -> np.ndarray:
+    """
+    Random notes of a file.
+
+    The number of notes is log-normal around notes, so file sizes are skewed
+    like in a real corpus. Pitches follow a random walk around middle C.
+
+    Parameters
+    ----------
+    index: int
+        Index of the file.
+    seed: int
+        Seed of the dataset.
+    notes: int
+        Median number of notes per file.
+    sigma: float
+        Standard deviation of the log of the number of notes. 0 gives every file the same size.
+
+    Returns
+    -------
+    notes: np.ndarray
+        Array of shape (n, 4) with the start and duration in ticks, the pitch and
+        the velocity of every note, sorted by start.
+    """
+    rng = np.random.default_rng([seed, index])
+    n = int(np.clip(round(notes * rng.lognormal(0.0, sigma)), 1, 100 * notes))
+    start = np.cumsum(rng.geometric(1 / 120, n) - 1)
+    duration = rng.geometric(1 / 240, n)
+    pitch = np.clip(60 + np.cumsum(rng.integers(-3, 4, n)), 21, 108)
+    velocity = rng.integers(32, 128, n)
+    return np.stack([start, duration, pitch, velocity], axis=1).astype(np.int64)
+
+
+def _varlen(values: np.ndarray) -> tuple:
+    """
+    Encodes numbers below 2**28 as MIDI variable length quantities.
+
+    Returns
+    -------
+    groups: np.ndarray
+        Array of shape (n, 4) with the 7 bit groups of every number, most significant first.
+    used: np.ndarray
+        Boolean array of shape (n, 4), True for the groups that are part of the encoding.
+    """
+    groups = (values[:, None] >> np.array([21, 14, 7, 0])) & 0x7F
+    length = 1 + (values >= 2**7) + (values >= 2**14) + (values >= 2**21)
+    used = np.arange(4) >= 4 - length[:, None]
+    # Every group but the last has the continuation bit set.
+    groups[:, :3] |= 0x80
+    return groups, used
+
+
+def write_midi(filename: str, notes: np.ndarray) -> None:
+    """
+    Writes notes as a single track MIDI file.
+
+    The events are encoded with numpy, building a mido message per event would
+    dominate the time to generate millions of files. The files load with mido.
+
+    Parameters
+    ----------
+    filename: str
+        Path of the file.
+    notes: np.ndarray
+        Notes returned by synthetic_notes.
+    """
+    start, duration, pitch, velocity = notes.T
+    # Note offs sort before note ons at the same tick, so repeated pitches do not overlap.
+    times = np.concatenate([start + duration, start])
+    on = np.concatenate([np.zeros(len(notes), bool), np.ones(len(notes), bool)])
+    order = np.lexsort((on, times))
+    deltas = np.diff(times[order], prepend=0)
+
+    groups, used = _varlen(deltas)
+    events = np.concatenate(
+        [
+            groups,
+            np.where(on[order], 0x90, 0x80)[:, None],
+            np.tile(pitch, 2)[order, None],
+            np.where(on, np.tile(velocity, 2), 0)[order, None],
+        ],
+        axis=1,
+    )
+    keep = np.concatenate([used, np.ones((len(events), 3), bool)], axis=1)
+
+    tempo = b"\x00\xff\x51\x03\x07\xa1\x20"
+    end = b"\x00\xff\x2f\x00"
+    track = tempo + events[keep].astype(np.uint8).tobytes() + end
+    header = b"MThd" + struct.pack(">IHHH", 6, 0, 1, 480)
+    with open(filename, "wb") as f:
+        f.write(header + b"MTrk" + struct.pack(">I", len(track)) + track)
+
+
+def write_csv(filename: str, notes: np.ndarray) -> None:
+    """
+    Writes notes as a CSV file with a header.
+
+    Parameters
+    ----------
+    filename: str
+        Path of the file.
+    notes: np.ndarray
+        Notes returned by synthetic_notes.
+    """
+    np.savetxt(
+        filename,
+        notes,
+        fmt="%d",
+        delimiter=",",
+        header="start,duration,pitch,velocity",
+        comments="",
+    )
+
+
+def _synthesize_file(
+    folder: str,
+    fanout: int,
+    depth: int,
+    notes: int,
+    sigma: float,
+    format: str,
+    seed: int,
+    overwrite: bool,
+    index: int,
+) -> bool:
+    """
+    Writes the file with the given index.
+
+    Returns
+    -------
+    written: bool
+        False if the file already existed and was kept.
+    """
+    filename = os.path.join(
+        folder, synthetic_path(index, fanout, depth, FORMATS[format])
+    )
+    if not overwrite and os.path.exists(filename):
+        return False
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Written under a temporary name, so an interrupted run leaves no partial file.
+    tmp = f"{filename}.tmp{os.getpid()}"
+    write = write_midi if format == "midi" else write_csv
+    write(tmp, synthetic_notes(index, seed, notes, sigma))
+    os.replace(tmp, filename)
+    return True
+
+
+def synthetic_seed(data_path: str, folder: str = "rawdata") -> Optional[int]:
+    """
+    Parameters
+    ----------
+    data_path: str
+        Path to the data folder.
+    folder: str
+        Name of the raw data folder. The default is rawdata.
+
+    Returns
+    -------
+    seed: int or None
+        Seed of the last finished synthesize run into the folder. None if there was none.
+    """
+    marker = os.path.join(data_path, folder, SEED_FILE)
+    if not os.path.exists(marker):
+        return None
+    with open(marker) as f:
+        return int(f.read())
+
+
+def synthesize(
+    data_path: str,
+    files: int = 1000,
+    fanout: int = 16,
+    depth: int = 2,
+    notes: int = 500,
+    sigma: float = 1.0,
+    format: str = "midi",
+    seed: int = 0,
+    workers: int = 1,
+    chunksize: int = 256,
+    overwrite: bool = False,
+    folder: str = "rawdata",
+) -> int:
+    """
+    Generates a synthetic raw dataset in the folder DataStreamer reads from.
+
+    Parameters
+    ----------
+    data_path: str
+        Path to the data folder.
+    files: int
+        Number of files.
+    fanout: int
+        Number of subfolders per folder.
+    depth: int
+        Number of folder levels below the raw data folder.
+    notes: int
+        Median number of notes per file, see synthetic_notes.
+    sigma: float
+        Spread of the number of notes per file, see synthetic_notes.
+    format: str
+        "midi" writes MIDI files, "csv" CSV files of notes.
+    seed: int
+        Seed of the dataset. The same seed gives the same files.
+    workers: int
+        Number of worker processes writing files.
+    chunksize: int
+        Number of files sent to a worker at a time.
+    overwrite: bool
+        If True, existing files are written again. Otherwise they are kept,
+        so an interrupted run can be continued or a dataset grown, unless
+        they were written with another seed.
+    folder: str
+        Name of the raw data folder. The default is rawdata.
+
+    Returns
+    -------
+    written: int
+        Number of files written.
+    """
+    if format not in FORMATS:
+        raise ValueError(
+            f"Unknown format {format!r}, expected one of {sorted(FORMATS)}"
+        )
+    root = os.path.join(data_path, folder)
+    os.makedirs(root, exist_ok=True)
+    marker = os.path.join(root, SEED_FILE)
+    previous = synthetic_seed(data_path, folder)
+    overwrite = overwrite or (previous is not None and previous != seed)
+
+    func = partial(
+        _synthesize_file, root, fanout, depth, notes, sigma, format, seed, overwrite
+    )
+    written = 0
+    for result in parallel_map(
+        func, range(files), workers=workers, chunksize=chunksize, ordered=False
+    ):
+        if result.error is not None:
+            raise RuntimeError(
+                f"Failed to synthesize file {result.index}:\n{result.error}"
+            )
+        written += result.value
+    # Only a finished run marks its seed, an interrupted run with a new seed starts over.
+    with open(marker, "w") as f:
+        f.write(str(seed))
+    return written
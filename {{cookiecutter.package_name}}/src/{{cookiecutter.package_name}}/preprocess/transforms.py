@@ -0,0 +1,266 @@
+"""
+Transforms
+==========
+Composable transform pipelines applied by DataStreamer.transform.
+
+A Pipeline chains transforms as generator stages, so the items of a file,
+e.g. its events, flow through all transforms without intermediate lists.
+Per item transforms are called once per item. Batched transforms are called
+once per numpy batch of up to batch_size items.
+
+Transforms are sent to worker processes, so they must be picklable. Use
+module level functions, not lambdas.
+"""
+
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Iterator
+
+import numpy as np
+
+from {{cookiecutter.package_name}}.preprocess.parallel import chunked
+
+
+class Transform(ABC):
+    """
+    Base class of transforms. Subclasses implement __call__ and set batched.
+    """
+
+    batched = False
+
+    @abstractmethod
+    def __call__(self, item):
+        """
+        Parameters
+        ----------
+        item
+            A single item, or a numpy array of stacked items if batched.
+
+        Returns
+        -------
+        result
+            The transformed item, or None to drop it. If batched, an array or list of transformed items.
+        """
+        ...
+
+    def stage(self, stream: Iterable, batch_size: int) -> Iterator:
+        """
+        Applies the transform lazily to a stream of items.
+
+        Parameters
+        ----------
+        stream: Iterable
+            Items to transform.
+        batch_size: int
+            Number of items stacked into a batch for batched transforms.
+
+        Yields
+        ------
+        item
+            Transformed items.
+        """
+        if not self.batched:
+            for item in stream:
+                result = self(item)
+                if result is not None:
+                    yield result
+            return
+
+        for batch in chunked(stream, batch_size):
+            yield from self(np.stack(batch))
+
+    def __repr__(self) -> str:
+        """Name of the transform."""
+        return type(self).__name__
+
+
+class Map(Transform):
+    """
+    Transform from a function.
+    """
+
+    def __init__(self, func: Callable, batched: bool = False):
+        """
+        Initialize the Map class.
+
+        Parameters
+        ----------
+        func: Callable
+            Function taking an item, or a numpy batch of items if batched.
+        batched: bool
+            Whether func is vectorized over numpy batches.
+        """
+        self.func = func
+        self.batched = batched
+
+    def __call__(self, item):
+        """Applies func."""
+        return self.func(item)
+
+    def __repr__(self) -> str:
+        """Name of the transform."""
+        return f"Map({self.func.__name__}, batched={self.batched})"
+
+
+class Filter(Transform):
+    """
+    Keeps the items a predicate holds for.
+    """
+
+    def __init__(self, predicate: Callable):
+        """
+        Initialize the Filter class.
+
+        Parameters
+        ----------
+        predicate: Callable
+            Function taking an item and returning whether to keep it.
+        """
+        self.predicate = predicate
+
+    def __call__(self, item):
+        """Returns item if it is kept, otherwise None."""
+        return item if self.predicate(item) else None
+
+    def __repr__(self) -> str:
+        """Name of the transform."""
+        return f"Filter({self.predicate.__name__})"
+
+
+class Pipeline:
+    """
+    Chain of transforms applied as generator stages.
+    """
+
+    def __init__(self, *transforms, batch_size: int = 1024):
+        """
+        Initialize the Pipeline class.
+
+        Parameters
+        ----------
+        transforms: Transform or Callable
+            Transforms in the order they are applied. Plain functions are wrapped in Map.
+        batch_size: int
+            Number of items per batch of batched transforms.
+        """
+        self.transforms = [
+            t if isinstance(t, Transform) else Map(t) for t in transforms
+        ]
+        self.batch_size = batch_size
+
+    def stream(self, items: Iterable) -> Iterator:
+        """
+        Lazily applies all transforms to a stream of items.
+
+        Parameters
+        ----------
+        items: Iterable
+            Items to transform, e.g. the events of a file.
+
+        Returns
+        -------
+        stream: Iterator
+            The transformed items.
+        """
+        stream = iter(items)
+        for transform in self.transforms:
+            stream = transform.stage(stream, self.batch_size)
+        return stream
+
+    def __call__(self, items: Iterable) -> list:
+        """
+        Parameters
+        ----------
+        items: Iterable
+            Items to transform.
+
+        Returns
+        -------
+        items: list
+            The transformed items.
+        """
+        return list(self.stream(items))
+
+    def __iter__(self):
+        """Iterate over the transforms."""
+        return iter(self.transforms)
+
+    def __len__(self) -> int:
+        """Number of transforms."""
+        return len(self.transforms)
+
+    def __repr__(self) -> str:
+        """The transforms of the pipeline."""
+        return f"Pipeline({', '.join(map(repr, self.transforms))})"
+
+
+def as_pipeline(transforms) -> Pipeline:
+    """
+    Parameters
+    ----------
+    transforms: Pipeline or list
+        A pipeline or a list of transforms.
+
+    Returns
+    -------
+    pipeline: Pipeline
+        transforms as Pipeline.
+    """
+    if isinstance(transforms, Pipeline):
+        return transforms
+    return Pipeline(*transforms)
+
+
+PACKS = {}
+
+
+def register_pack(name: str) -> Callable:
+    """
+    Registers a function returning a Pipeline as a preprocess pack, selectable with preprocess --pack.
+
+    Parameters
+    ----------
+    name: str
+        Name of the pack.
+
+    Returns
+    -------
+    decorator: Callable
+        Decorator registering the function.
+    """
+
+    def decorator(factory: Callable) -> Callable:
+        """Registers factory under name."""
+        PACKS[name] = factory
+        return factory
+
+    return decorator
+
+
+def get_pack(name: str) -> Pipeline:
+    """
+    Parameters
+    ----------
+    name: str
+        Name of a registered pack.
+
+    Returns
+    -------
+    pipeline: Pipeline
+        The pipeline of the pack.
+    """
+    if name not in PACKS:
+        raise ValueError(f"Unknown preprocess pack {name}. Choose from {sorted(PACKS)}")
+    return PACKS[name]()
+
+
+@register_pack("standard")
+def standard() -> Pipeline:
+    """
+    The standard pack. Add the transforms every dataset should get here.
+
+    Returns
+    -------
+    pipeline: Pipeline
+        The standard pipeline.
+    """
+    return Pipeline()
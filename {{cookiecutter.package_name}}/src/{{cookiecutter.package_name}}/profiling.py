@@ -0,0 +1,292 @@
+"""
+Profiling
+=========
+Profiling of the preprocess, train and generate stages, enabled with --profile.
+
+* Every stage is timed.
+* Stages running in this process, such as generation, are profiled with cProfile.
+* In preprocessing, every n-th file is profiled with cProfile in the worker
+  processes, so a long run is only sampled.
+* Training is profiled with torch.profiler for a window of steps after skipping
+  the first ones, so a long job is not slowed down beyond the window.
+
+The folder receives a pstats file per cProfile stage, a Chrome trace per
+torch.profiler window, which can be opened in chrome://tracing or Perfetto,
+and summary.txt with the time per stage and the top hot spots.
+
+torch is only imported by torch_profile, so profiling preprocessing does not
+load it.
+"""
+
+import cProfile
+import glob
+import io
+import os
+import pstats
+import sys
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import torch
+
+
+class SampledFunction:
+    """
+    Wraps a function and profiles every n-th call with cProfile.
+
+    Picklable, so it can be sent to worker processes. Every process adds its
+    samples to its own pstats file.
+    """
+
+    def __init__(self, func, path: str, every: int = 100):
+        """
+        Initialize the SampledFunction class.
+
+        Parameters
+        ----------
+        func: Callable
+            Function to profile. Must be picklable to be sent to workers.
+        path: str
+            Path prefix of the pstats files. The process id and .pstats are appended.
+        every: int
+            Every n-th call is profiled, starting with the first.
+        """
+        self.func = func
+        self.path = path
+        self.every = every
+        self.calls = 0
+        self.profile = None
+        self.owner = os.getpid()
+
+    def __getstate__(self) -> dict:
+        """Drops the profile of this process."""
+        return {**self.__dict__, "calls": 0, "profile": None}
+
+    def __call__(self, *args, **kwargs):
+        """
+        Calls the function and profiles the call if it is sampled.
+        """
+        if self.calls == 0 and os.getpid() != self.owner:
+            # Forked workers inherit the profiler of a profiled stage.
+            sys.setprofile(None)
+        sampled = self.calls % self.every == 0
+        self.calls += 1
+        # Only one profiler can be active, e.g. when workers=1 runs inside a profiled stage.
+        if not sampled or sys.getprofile() is not None:
+            return self.func(*args, **kwargs)
+
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+        try:
+            self.profile.enable()
+        except ValueError:
+            return self.func(*args, **kwargs)
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.profile.disable()
+            self.profile.dump_stats(f"{self.path}{os.getpid()}.pstats")
+
+
+class Profiler:
+    """
+    Collects timings and profiles of the stages of a run into a folder.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        skip: int = 10,
+        steps: int = 5,
+        every: int = 100,
+        top: int = 15,
+        rank: int = None,
+    ):
+        """
+        Initialize the Profiler class.
+
+        Parameters
+        ----------
+        folder: str
+            Folder the profiles and the summary are written to. Created if it does not exist.
+        skip: int
+            Number of training steps before the profiled window.
+        steps: int
+            Number of training steps in the profiled window.
+        every: int
+            Every n-th file is profiled in preprocessing.
+        top: int
+            Number of hot spots per stage in the summary.
+        rank: int
+            Rank of this process, appended to the file names of ranks other
+            than 0. Defaults to the rank of the job.
+        """
+        self.folder = folder
+        self.skip = skip
+        self.steps = steps
+        self.every = every
+        self.top = top
+        if rank is None:
+            from {{cookiecutter.package_name}}.launch import detect
+
+            rank = detect().rank
+        self.rank = rank
+        self.timings = {}
+        self.profiles = {}
+        self.tables = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, name: str, extension: str) -> str:
+        """
+        Parameters
+        ----------
+        name: str
+            Name of a stage.
+        extension: str
+            Extension of the file, e.g. "pstats".
+
+        Returns
+        -------
+        path: str
+            Path of the file of the stage for this rank.
+        """
+        suffix = f".rank{self.rank}" if self.rank else ""
+        return os.path.join(self.folder, f"{name}{suffix}.{extension}")
+
+    @contextmanager
+    def stage(self, name: str, cprofile: bool = True):
+        """
+        Times a stage and optionally profiles it with cProfile.
+
+        Parameters
+        ----------
+        name: str
+            Name of the stage.
+        cprofile: bool
+            If True, the stage is profiled with cProfile. Only profiles this
+            thread, use sample for work in worker processes.
+
+        Yields
+        ------
+        profiler: Profiler
+            The profiler.
+        """
+        profile = cProfile.Profile() if cprofile else None
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield self
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self.path(name, "pstats"))
+                self.profiles[name] = glob.escape(self.path(name, "pstats"))
+            self.timings[name] = (
+                self.timings.get(name, 0.0) + time.perf_counter() - start
+            )
+
+    def sample(self, name: str, func) -> SampledFunction:
+        """
+        Parameters
+        ----------
+        name: str
+            Name of the sampled work, e.g. "preprocess.transform".
+        func: Callable
+            Function called once per item.
+
+        Returns
+        -------
+        func: SampledFunction
+            func, profiling every n-th call per process.
+        """
+        prefix = self.path(name, "pid")
+        self.profiles[name] = glob.escape(prefix) + "*.pstats"
+        for stale in glob.glob(self.profiles[name]):
+            os.remove(stale)
+        return SampledFunction(func, prefix, self.every)
+
+    def torch_profile(self, name: str) -> "torch.profiler.profile":
+        """
+        torch.profiler for a window of steps. Call step() on it after every step.
+
+        Parameters
+        ----------
+        name: str
+            Name of the stage.
+
+        Returns
+        -------
+        profile: torch.profiler.profile
+            Profiler that records steps skip + 1 to skip + steps, after one warmup
+            step, and then writes a Chrome trace.
+        """
+        import torch
+
+        def ready(profile: "torch.profiler.profile") -> None:
+            """Writes the trace and keeps the hot spots of the window."""
+            profile.export_chrome_trace(self.path(name, "trace.json"))
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            self.tables[name] = profile.key_averages().table(
+                sort_by=f"self_{device}_time_total", row_limit=self.top
+            )
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        return torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                skip_first=self.skip, wait=0, warmup=1, active=self.steps, repeat=1
+            ),
+            on_trace_ready=ready,
+        )
+
+    def hot_spots(self, name: str) -> str:
+        """
+        Parameters
+        ----------
+        name: str
+            Name of a stage profiled with cProfile or sampled.
+
+        Returns
+        -------
+        table: str
+            The functions with the most time spent in themselves, over all
+            processes, or an empty string if there is no profile.
+        """
+        files = sorted(glob.glob(self.profiles.get(name, "")))
+        if not files:
+            return ""
+        stream = io.StringIO()
+        stats = pstats.Stats(*files, stream=stream)
+        stats.strip_dirs().sort_stats("tottime").print_stats(self.top)
+        return stream.getvalue()
+
+    def summary(self) -> str:
+        """
+        Writes summary.txt with the time per stage and the hot spots of every profile.
+
+        Returns
+        -------
+        summary: str
+            Content of the summary.
+        """
+        total = sum(self.timings.values()) or 1.0
+        lines = ["Time per stage", "==============", ""]
+        for name, seconds in self.timings.items():
+            lines.append(f"{name:<24} {seconds:>10.2f}s {seconds / total:>7.1%}")
+
+        for name in self.profiles:
+            table = self.hot_spots(name)
+            if table:
+                lines += ["", f"Hot spots of {name} (cProfile)", table.strip()]
+        for name, table in self.tables.items():
+            lines += ["", f"Hot spots of {name} (torch.profiler)", table.strip()]
+
+        summary = "\n".join(lines) + "\n"
+        with open(self.path("summary", "txt"), "w") as f:
+            f.write(summary)
+        return summary
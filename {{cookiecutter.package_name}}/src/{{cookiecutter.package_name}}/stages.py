@@ -0,0 +1,346 @@
+"""
+Stages
+======
+Make-style runner for the stages selected on the command line.
+
+Every stage declares the paths it reads and writes and the parameters its
+outputs depend on. After a stage finished, a fingerprint of its inputs and
+parameters is stored in a stamp file. A later run skips the stage while its
+outputs exist and the fingerprint matches, so a resubmitted job does not
+preprocess and split again.
+
+* Inputs are fingerprinted by the size and modification time of every file,
+  like make, and not by their content.
+* A stage depends on the earlier stages that write one of its inputs, or
+  that read or write one of its outputs. Stages without such a dependency
+  run at the same time.
+* A stage whose dependency ran is checked again afterwards. When an
+  incremental stage changed nothing, the stages after it are still skipped.
+* Distributed stages, e.g. train, and all stages with jobs=1 run on the
+  calling thread, so they can install signal handlers. Training needs them
+  to checkpoint and requeue when the job is preempted.
+"""
+
+import json
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, NamedTuple, Optional
+
+from {{cookiecutter.package_name}}.preprocess.indexer import walk
+from {{cookiecutter.package_name}}.preprocess.manifest import fingerprint
+
+
+class Stage(NamedTuple):
+    """
+    A step of the StageGraph.
+
+    run is called without arguments. It returns False if it stopped before
+    finishing, e.g. training stopped by a signal or the time limit, and the stage is then not
+    marked as up to date. A distributed stage runs in every process of a job
+    launched with srun or torchrun, the others only run in a single process.
+    """
+
+    name: str
+    run: Callable
+    inputs: tuple = ()
+    outputs: tuple = ()
+    params: Optional[dict] = None
+    force: bool = False
+    distributed: bool = False
+
+
+def path_fingerprint(path: str, workers: int = 1) -> str:
+    """
+    Parameters
+    ----------
+    path: str
+        Path to a file or folder.
+    workers: int
+        Number of threads listing folders, see preprocess.indexer.walk.
+
+    Returns
+    -------
+    fingerprint: str
+        Fingerprint of the size and modification time of the file, or of every
+        file in the folder. "missing" if the path does not exist.
+    """
+    if not os.path.exists(path):
+        return "missing"
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    entries = []
+    for _, _, files in walk(path, workers=workers):
+        for filename in files:
+            stat = os.stat(filename)
+            entries.append(
+                (os.path.relpath(filename, path), stat.st_size, stat.st_mtime_ns)
+            )
+    return fingerprint(sorted(entries))
+
+
+def overlaps(first: str, second: str) -> bool:
+    """
+    Parameters
+    ----------
+    first: str
+        A path.
+    second: str
+        Another path.
+
+    Returns
+    -------
+    overlaps: bool
+        True if the paths are the same or one contains the other.
+    """
+    first, second = os.path.abspath(first), os.path.abspath(second)
+    return (
+        first == second
+        or first.startswith(second + os.sep)
+        or second.startswith(first + os.sep)
+    )
+
+
+class StageGraph:
+    """
+    Runs stages in dependency order and skips the ones that are up to date.
+    """
+
+    def __init__(
+        self,
+        stages: list,
+        stamps: str,
+        jobs: int = None,
+        workers: int = 1,
+        main: bool = True,
+    ):
+        """
+        Initialize the StageGraph class.
+
+        Parameters
+        ----------
+        stages: list
+            Stages in the order they were given. A stage only depends on earlier stages.
+        stamps: str
+            Path to the JSON file with the fingerprints of finished stages.
+        jobs: int
+            Maximum number of stages running at the same time. Defaults to all.
+        workers: int
+            Number of threads listing folders when fingerprinting.
+        main: bool
+            Whether this process records the stamps. False on the other
+            processes of a job that run the same distributed stages.
+        """
+        names = [stage.name for stage in stages]
+        for name in names:
+            if names.count(name) > 1:
+                raise ValueError(f"Stage {name} is given more than once")
+        self.stages = {stage.name: stage for stage in stages}
+        self.stamps = stamps
+        self.jobs = jobs or max(len(stages), 1)
+        self.workers = workers
+        self.main = main
+        self.lock = threading.Lock()
+        self.dependencies = {
+            stage.name: [
+                earlier.name for earlier in stages[:i] if self._depends(stage, earlier)
+            ]
+            for i, stage in enumerate(stages)
+        }
+
+    @staticmethod
+    def _depends(stage: Stage, earlier: Stage) -> bool:
+        """True if stage reads or writes a path earlier writes, or writes a path earlier reads."""
+        return any(
+            overlaps(path, output)
+            for path in stage.inputs + stage.outputs
+            for output in earlier.outputs
+        ) or any(
+            overlaps(output, path)
+            for output in stage.outputs
+            for path in earlier.inputs
+        )
+
+    def load(self) -> dict:
+        """
+        Returns
+        -------
+        stamps: dict
+            Fingerprint of every finished stage by name.
+        """
+        if not os.path.exists(self.stamps):
+            return {}
+        with open(self.stamps) as f:
+            return json.load(f)
+
+    def record(self, name: str, stamp: str) -> None:
+        """
+        Stores the fingerprint of a finished stage. The file is replaced in one
+        step, so an interrupted job never leaves a broken stamp file.
+
+        Parameters
+        ----------
+        name: str
+            Name of the stage.
+        stamp: str
+            Fingerprint of the stage, see stamp.
+        """
+        with self.lock:
+            stamps = self.load()
+            stamps[name] = stamp
+            os.makedirs(os.path.dirname(self.stamps) or ".", exist_ok=True)
+            tmp = f"{self.stamps}.tmp{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump(stamps, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.stamps)
+
+    def stamp(self, stage: Stage) -> str:
+        """
+        Parameters
+        ----------
+        stage: Stage
+            A stage.
+
+        Returns
+        -------
+        stamp: str
+            Fingerprint of the inputs, outputs and parameters of the stage.
+        """
+        inputs = [(path, path_fingerprint(path, self.workers)) for path in stage.inputs]
+        return fingerprint(inputs, sorted(stage.outputs), stage.params or {})
+
+    def reason(self, stage: Stage, stamps: dict, stamp: str = None) -> Optional[str]:
+        """
+        Parameters
+        ----------
+        stage: Stage
+            A stage.
+        stamps: dict
+            Stamps of the finished stages, see load.
+        stamp: str
+            Current stamp of the stage, if it was computed already. Computed when needed otherwise.
+
+        Returns
+        -------
+        reason: str
+            Why the stage has to run, or None if it is up to date.
+        """
+        if stage.force:
+            return "forced"
+        if stage.name not in stamps:
+            return "never finished"
+        missing = [path for path in stage.outputs if not os.path.exists(path)]
+        if missing:
+            return f"{', '.join(missing)} missing"
+        if stamp is None:
+            stamp = self.stamp(stage)
+        if stamps[stage.name] != stamp:
+            return "inputs or parameters changed"
+        return None
+
+    def plan(self) -> list:
+        """
+        What run would do, without running anything.
+
+        Returns
+        -------
+        plan: list
+            Pairs of a stage name and the reason it runs, or None if it is skipped.
+            Stages after a stage that runs are assumed to run as well.
+        """
+        stamps = self.load()
+        running, plan = set(), []
+        for name, stage in self.stages.items():
+            after = [dep for dep in self.dependencies[name] if dep in running]
+            reason = (
+                f"after {', '.join(after)}" if after else self.reason(stage, stamps)
+            )
+            if reason is not None:
+                running.add(name)
+            plan.append((name, reason))
+        return plan
+
+    def describe(self) -> str:
+        """
+        Returns
+        -------
+        plan: str
+            One line per stage, whether it would run or be skipped and why.
+        """
+        lines = []
+        for name, reason in self.plan():
+            if reason is None:
+                lines.append(f"Would skip {name}: up to date")
+            else:
+                lines.append(f"Would run {name}: {reason}")
+        return "\n".join(lines)
+
+    def _execute(self, stage: Stage) -> bool:
+        """
+        Runs a stage unless it is up to date.
+
+        Returns
+        -------
+        ran: bool
+            True if the stage ran.
+        """
+        # Fingerprinted once, before running, so inputs changed while it runs are caught next time.
+        stamp = self.stamp(stage)
+        reason = self.reason(stage, self.load(), stamp)
+        if reason is None:
+            print(f"Skipping {stage.name}: up to date")
+            return False
+        print(f"Running {stage.name}: {reason}")
+        if stage.run() is not False and self.main:
+            self.record(stage.name, stamp)
+        return True
+
+    def run(self) -> list:
+        """
+        Runs the stages that are not up to date. A stage starts as soon as its
+        dependencies are done. After a failure no further stages start and the
+        error is raised once the running stages finished. Stages that run on
+        the calling thread start once no other stage is running.
+
+        Returns
+        -------
+        ran: list
+            Names of the stages that ran.
+        """
+        done, ran, error = set(), [], None
+        pending = {}
+        waiting = list(self.stages)
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while waiting or pending:
+                for name in list(waiting):
+                    if error is not None or len(pending) >= self.jobs:
+                        break
+                    if not all(dep in done for dep in self.dependencies[name]):
+                        continue
+                    stage = self.stages[name]
+                    if self.jobs > 1 and not stage.distributed:
+                        waiting.remove(name)
+                        pending[executor.submit(self._execute, stage)] = name
+                    elif not pending:
+                        waiting.remove(name)
+                        try:
+                            if self._execute(stage):
+                                ran.append(name)
+                            done.add(name)
+                        except Exception as exception:
+                            error = exception
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = pending.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        continue
+                    done.add(name)
+                    if future.result():
+                        ran.append(name)
+        if error is not None:
+            raise error
+        return ran
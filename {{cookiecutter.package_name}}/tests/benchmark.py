@@ -0,0 +1,155 @@
+"""
+Benchmark harness for tests marked with @pytest.mark.benchmark.
+
+Benchmarks only run with --benchmark. Every measurement is compared with the
+baseline of the same name and fails if it is slower than the baseline by more
+than the tolerance. Run with --benchmark-update to record the current numbers
+as baselines, e.g. after a deliberate change or on a new machine.
+"""
+
+import json
+import math
+import os
+import time
+import tracemalloc
+
+import pytest
+
+from {{cookiecutter.package_name}}.model.metrics import memory_stats
+
+BASELINES = os.path.join(os.path.dirname(os.path.realpath(__file__)), "benchmarks.json")
+
+
+class Benchmark:
+    """
+    Times functions, compares them with baselines and collects the results.
+    """
+
+    def __init__(self, path: str, tolerance: float = 0.5, update: bool = False):
+        """
+        Initialize the Benchmark class.
+
+        Parameters
+        ----------
+        path: str
+            JSON file of the baselines.
+        tolerance: float
+            Allowed slowdown relative to the baseline, e.g. 0.5 fails at 1.5 times the baseline.
+        update: bool
+            If True, nothing fails and the results are saved as baselines.
+        """
+        self.path = path
+        self.tolerance = tolerance
+        self.update = update
+        self.results = {}
+        self.baselines = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.baselines = json.load(f)
+
+    def __call__(
+        self,
+        name: str,
+        func,
+        items: int,
+        setup=None,
+        repeat: int = 5,
+        min_seconds: float = 0.2,
+    ) -> dict:
+        """
+        Times func and fails if it regressed.
+
+        Like timeit, func runs in repeat rounds of as many runs as fill
+        min_seconds, and the fastest round counts, so short stages and a busy
+        machine cause fewer false alarms. One more run measures peak memory
+        with tracemalloc, which slows down Python code and is therefore not timed.
+
+        Parameters
+        ----------
+        name: str
+            Name of the measurement, e.g. "split[1000]".
+        func: Callable
+            Function to time.
+        items: int
+            Number of items func processes, for the throughput.
+        setup: Callable
+            Called before every run, untimed. Returns the arguments of func.
+        repeat: int
+            Number of timed rounds.
+        min_seconds: float
+            Minimum duration of a round.
+
+        Returns
+        -------
+        result: dict
+            seconds, items_per_s, peak_mb, the peak memory allocated by
+            Python and numpy during a run, and rss_mb, the peak resident memory
+            of the process so far, which includes torch tensors.
+        """
+
+        def run() -> float:
+            """Runs func once and returns its duration."""
+            args = setup() if setup is not None else ()
+            start = time.perf_counter()
+            func(*args)
+            return time.perf_counter() - start
+
+        number = max(1, math.ceil(min_seconds / max(run(), 1e-9)))
+        seconds = min(sum(run() for _ in range(number)) / number for _ in range(repeat))
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        result = {
+            "seconds": round(seconds, 6),
+            "items_per_s": round(items / seconds, 2),
+            "peak_mb": round(peak / 2**20, 2),
+            "rss_mb": memory_stats()["rss_mb"],
+        }
+        self.results[name] = result
+
+        baseline = self.baselines.get(name)
+        if not self.update and baseline is not None:
+            limit = baseline["seconds"] * (1 + self.tolerance)
+            if seconds > limit:
+                pytest.fail(
+                    f"{name} took {seconds:.4f}s, slower than the baseline of "
+                    f"{baseline['seconds']:.4f}s by more than {self.tolerance:.0%}"
+                )
+        return result
+
+    def save(self) -> None:
+        """
+        Saves the results as baselines, keeping the baselines of benchmarks that did not run.
+        """
+        baselines = {**self.baselines, **self.results}
+        with open(self.path, "w") as f:
+            json.dump(dict(sorted(baselines.items())), f, indent=2)
+            f.write("\n")
+
+    def report(self) -> list:
+        """
+        Returns
+        -------
+        lines: list
+            Table of the results with the change relative to the baselines.
+        """
+        lines = [
+            f"{'benchmark':<32} {'seconds':>10} {'items/s':>12} "
+            f"{'peak MB':>9} {'RSS MB':>9} {'vs baseline':>12}"
+        ]
+        for name, result in self.results.items():
+            baseline = self.baselines.get(name)
+            change = (
+                f"{result['seconds'] / baseline['seconds'] - 1:+.0%}"
+                if baseline
+                else "new"
+            )
+            lines.append(
+                f"{name:<32} {result['seconds']:>10.4f} {result['items_per_s']:>12.1f} "
+                f"{result['peak_mb']:>9.2f} {result['rss_mb']:>9.1f} {change:>12}"
+            )
+        return lines
@@ -1,7 +1,102 @@
 import pytest
 import os
+import numpy as np
 from click.testing import CliRunner
 
+from {{cookiecutter.package_name}}.preprocess import DataStreamer, Loader
+
+from .benchmark import BASELINES, Benchmark
+
+BENCHMARK = pytest.StashKey[Benchmark]()
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("benchmark")
+    group.addoption("--benchmark", action="store_true", help="Run the benchmarks.")
+    group.addoption(
+        "--benchmark-update",
+        action="store_true",
+        help="Save the results of the benchmarks as baselines instead of comparing.",
+    )
+    group.addoption(
+        "--benchmark-tolerance",
+        type=float,
+        default=0.5,
+        help="Allowed slowdown relative to the baselines. Default 0.5.",
+    )
+    group.addoption(
+        "--benchmark-baselines", default=BASELINES, help="JSON file of the baselines."
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: run only with --benchmark")
+    config.stash[BENCHMARK] = Benchmark(
+        config.getoption("benchmark_baselines"),
+        tolerance=config.getoption("benchmark_tolerance"),
+        update=config.getoption("benchmark_update"),
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("benchmark") or config.getoption("benchmark_update"):
+        return
+    skip = pytest.mark.skip(reason="benchmarks run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    benchmark = config.stash.get(BENCHMARK, None)
+    if benchmark is None or not benchmark.results:
+        return
+    terminalreporter.section("benchmarks")
+    for line in benchmark.report():
+        terminalreporter.write_line(line)
+    if benchmark.update:
+        benchmark.save()
+        terminalreporter.write_line(f"Saved baselines to {benchmark.path}")
+
+
+@pytest.fixture
+def benchmark(request) -> Benchmark:
+    return request.config.stash[BENCHMARK]
+
+
+class TextLoader(Loader):
+    extension = "*.txt"
+
+    def __iter__(self):
+        for filename in self.data:
+            yield self.load(filename)
+
+    def load(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+
+class UpperStreamer(DataStreamer):
+    target_folder = "cleandata"
+    Loader = TextLoader
+
+    def preprocess(self, transforms=[], **kwargs):
+        return super().preprocess(transforms, **kwargs)
+
+    def transform(self, content, filename, transforms):
+        if "broken" in content:
+            raise ValueError(f"Cannot transform {filename}")
+        name = os.path.splitext(os.path.basename(filename))[0]
+        output = os.path.join(self.data_path, self.target_folder, name + ".csv")
+        with open(output, "w") as f:
+            f.write(content.upper())
+        return output
+
+
+class TokenStreamer(UpperStreamer):
+    def transform(self, content, filename, transforms):
+        return np.frombuffer(content.encode(), dtype=np.uint8)
+
 
 @pytest.fixture
 def runner():
@@ -16,3 +111,13 @@ def data_path() -> str:
 @pytest.fixture
 def model_path() -> str:
     return os.path.dirname(os.path.realpath(__file__)) + "/models/model.ml"
+
+
+@pytest.fixture
+def raw_data(tmp_path) -> str:
+    data = tmp_path / "data"
+    for i in range(20):
+        folder = data / "rawdata" / f"{i % 3}"
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / f"song_{i}.txt").write_text(f"song {i}")
+    return str(data)
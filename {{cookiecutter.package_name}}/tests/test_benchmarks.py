@@ -0,0 +1,87 @@
+import os
+import subprocess
+import sys
+
+import pytest
+import torch
+
+from {{cookiecutter.package_name}}.datasets import collate_padded
+from {{cookiecutter.package_name}}.model import Transformer
+from {{cookiecutter.package_name}}.model.train import train_epoch
+from {{cookiecutter.package_name}}.preprocess import split
+
+from .conftest import TextLoader, UpperStreamer
+
+pytestmark = pytest.mark.benchmark
+
+SIZES = [1000, 10000]
+
+
+@pytest.fixture(scope="module", params=SIZES)
+def synthetic_data(request, tmp_path_factory):
+    files = request.param
+    data = tmp_path_factory.mktemp(f"benchmark{files}") / "data"
+    for i in range(files):
+        folder = data / "rawdata" / f"{i % 10}" / f"{i % 7}"
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / f"song_{i}.txt").write_text(f"song {i} " * 64)
+    return str(data), files
+
+
+def test_loader_files(benchmark, synthetic_data):
+    data, files = synthetic_data
+    rawdata = os.path.join(data, "rawdata")
+    benchmark(f"loader_scan[{files}]", lambda: TextLoader(rawdata, cache=False), files)
+    TextLoader(rawdata)
+    benchmark(f"loader_index[{files}]", lambda: TextLoader(rawdata), files)
+
+
+def test_loader_stream(benchmark, synthetic_data):
+    data, files = synthetic_data
+    loader = TextLoader(os.path.join(data, "rawdata"), readahead=8)
+    benchmark(f"loader_stream[{files}]", lambda: list(loader.stream()), files)
+
+
+def test_preprocess(benchmark, synthetic_data):
+    data, files = synthetic_data
+    streamer = UpperStreamer(data)
+    benchmark(
+        f"preprocess[{files}]",
+        lambda: streamer.preprocess(incremental=False),
+        files,
+    )
+
+
+def test_split(benchmark, synthetic_data):
+    data, files = synthetic_data
+    UpperStreamer(data).preprocess()
+    benchmark(f"split[{files}]", lambda: split(data), files)
+
+
+@pytest.mark.parametrize("context", [64, 256])
+def test_train_step(benchmark, context):
+    torch.manual_seed(0)
+    model = Transformer(256, context=context, layers=2, heads=4, dim=64, dropout=0.0)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    scaler = torch.amp.GradScaler("cpu", enabled=False)
+    batch = collate_padded(list(torch.randint(256, (8, context))), max_length=context)
+    # One batch without accumulation is a single optimizer step. Every
+    # position but the last predicts a token.
+    benchmark(
+        f"train_step[{context}]",
+        lambda: train_epoch(model, optimizer, scaler, [batch]),
+        8 * (context - 1),
+    )
+
+
+@pytest.mark.parametrize("module", ["cli", "preprocess"])
+def test_import(benchmark, module):
+    # Includes the start of the interpreter, which is the same for every module.
+    command = [sys.executable, "-c", f"import {{cookiecutter.package_name}}.{module}"]
+    benchmark(
+        f"import_{module}",
+        lambda: subprocess.run(command, check=True),
+        1,
+        repeat=3,
+        min_seconds=0,
+    )
@@ -1,5 +1,8 @@
 import os
 import shutil
+import subprocess
+import sys
+
 import pytest
 
 from {{cookiecutter.package_name}} import __version__ as VERSION
@@ -18,7 +21,7 @@ def test_{{cookiecutter.package_name}}_preprocess(runner, data_path):
     with runner.isolated_filesystem():
         shutil.copytree(data_path, "data")
         shutil.copy(os.path.join(os.path.dirname(data_path), ".env"), ".env")
-        result = runner.invoke(cli, ["--preprocess"])
+        result = runner.invoke(cli, ["preprocess"])
         print(result.output)
         if not os.path.exists("data/cleandata"):
             raise Exception(f"data/cleandata does not exist. {result.exception}")
@@ -35,12 +38,45 @@ def test_{{cookiecutter.package_name}}_train(runner, data_path):
         result = runner.invoke(
             cli,
             [
-                "--preprocess",
-                "--train",
-                "--generate",
+                "preprocess",
+                "train",
+                "generate",
             ],
         )
         print(result.output)
         if not os.path.exists("models/model.pt"):
             raise Exception(f"models/model.pt does not exist. {result.exception}")
         assert not result.exception
+
+
+def test_{{cookiecutter.package_name}}_lazy_imports():
+    # A fresh interpreter, the tests have imported torch already.
+    code = (
+        "import sys, {{cookiecutter.package_name}}.cli; "
+        "print(sorted({'torch', 'pandas', 'altair', 'mido'} & set(sys.modules)))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
+def test_{{cookiecutter.package_name}}_commands(runner):
+    with runner.isolated_filesystem():
+        result = runner.invoke(cli, ["--seed", "1", "synthesize", "--files", "3"])
+        assert not result.exception, result.output
+        assert "Wrote 3 files" in result.output
+        # Another seed writes the files again, no seed continues the dataset.
+        result = runner.invoke(cli, ["--seed", "2", "synthesize", "--files", "3"])
+        assert "Wrote 3 files" in result.output
+        result = runner.invoke(cli, ["synthesize", "--files", "3"])
+        assert "Wrote 0 files" in result.output
+        result = runner.invoke(cli, ["synthesize", "--files", "3"])
+        assert "Skipping synthesize: up to date" in result.output
+        result = runner.invoke(cli, ["preprocess", "--pack", "missing"])
+        assert result.exit_code == 2
+        result = runner.invoke(
+            cli, ["synthesize", "--files", "3"], env={"WORLD_SIZE": "2", "RANK": "1"}
+        )
+        assert result.exit_code == 2
+        assert "synthesize cannot run in each of the 2 tasks" in result.output
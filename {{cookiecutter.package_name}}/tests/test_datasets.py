@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from {{cookiecutter.package_name}}.datasets import (
+    PackedDataset,
+    PaddingStats,
+    StreamingDataset,
+    Throughput,
+    TokenCounts,
+    Vocab,
+    build_vocab,
+    document_mask,
+    make_batches,
+    make_loader,
+)
+from {{cookiecutter.package_name}}.datasets.batching import packed_contexts
+from {{cookiecutter.package_name}}.preprocess import ShardWriter
+
+
+@pytest.fixture
+def shards(tmp_path) -> str:
+    folder = str(tmp_path / "shards")
+    with ShardWriter(folder, shard_tokens=64) as writer:
+        for i in range(23):
+            writer.write(np.full(i % 7 + 1, i), name=f"song_{i}.mid")
+    return folder
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_streaming_dataset_sharding(shards, num_workers):
+    seen = []
+    for rank in range(2):
+        dataset = StreamingDataset(shards, shuffle=True, rank=rank, world_size=2)
+        loader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
+        samples = [int(sample[0]) for sample in loader]
+        assert len(samples) == len(dataset)
+        seen.extend(samples)
+    assert sorted(seen) == list(range(23))
+
+
+def test_streaming_dataset_split_list(tmp_path):
+    filenames = []
+    for i in range(5):
+        filename = tmp_path / f"song_{i}.csv"
+        filename.write_text(",".join(str(i) for _ in range(i + 1)))
+        filenames.append(str(filename))
+    (tmp_path / "train.txt").write_text("\n".join(filenames))
+
+    dataset = StreamingDataset.from_data_path(str(tmp_path), "train")
+    batches = Throughput(make_loader(dataset, batch_size=2))
+    shapes = [tuple(batch.shape) for batch in batches]
+    assert shapes == [(2, 2), (2, 4), (1, 5)]
+    assert batches.samples == 5
+    assert batches.samples_per_second > 0
+
+
+def test_vocab_counts_prunes_and_caches(tmp_path):
+    filenames = []
+    for i in range(6):
+        filename = tmp_path / f"song_{i}.csv"
+        # Token 10 + i occurs i + 1 times, 99 once in every file.
+        filename.write_text(",".join(["99"] + [str(10 + i)] * (i + 1)))
+        filenames.append(str(filename))
+    (tmp_path / "train.txt").write_text("\n".join(filenames))
+
+    counts = TokenCounts.of([3, 1, 3]).merge(TokenCounts.of([1, 2]))
+    assert counts.tokens.tolist() == [1, 2, 3] and counts.counts.tolist() == [2, 1, 2]
+
+    vocab = build_vocab(str(tmp_path), min_freq=2, max_size=4, workers=2, chunksize=2)
+    assert vocab.tokens.tolist() == [14, 15, 99] and len(vocab) == 4
+    assert vocab.encode([99, 10, 15, -5]).tolist() == [3, 0, 2, 0]
+    assert vocab.decode([3, 0, 2]).tolist() == [99, -1, 15]
+
+    dataset = StreamingDataset.from_data_path(str(tmp_path), "train", vocab=vocab)
+    assert dataset[5].tolist() == [3] + [2] * 6
+
+    cached = tmp_path / "vocab.npz"
+    mtime = cached.stat().st_mtime_ns
+    assert build_vocab(str(tmp_path), min_freq=2, max_size=4).source == vocab.source
+    assert cached.stat().st_mtime_ns == mtime
+    assert len(build_vocab(str(tmp_path), min_freq=1)) == 8
+
+    (tmp_path / "song_0.csv").write_text("7,7,7")
+    assert 7 in build_vocab(str(tmp_path), min_freq=1).tokens
+    assert len(Vocab.load(str(cached))) == 8
+
+
+def test_packed_contexts(shards):
+    dataset = PackedDataset(StreamingDataset(shards), context=16)
+    contexts = list(dataset)
+    stats = PaddingStats()
+    for context in contexts:
+        stats.update(context)
+    assert stats.tokens == sum(i % 7 + 1 for i in range(23))
+    assert stats.slots == 16 * len(contexts)
+    assert stats.efficiency > 0.9
+
+    first = contexts[0]
+    assert first["tokens"][:4].tolist() == [0, 1, 1, 2]
+    assert first["documents"][:4].tolist() == [0, 1, 1, 2]
+    assert first["positions"][:4].tolist() == [0, 0, 1, 0]
+
+    mask = document_mask(first["documents"].unsqueeze(0))[0]
+    assert mask[2, 1] and not mask[1, 2] and not mask[3, 2]
+
+
+def test_packed_contexts_restart_positions():
+    sequences = [torch.arange(5), torch.arange(6), torch.arange(20)]
+    contexts = list(packed_contexts(sequences, context=8))
+    positions = [c["positions"].tolist() for c in contexts]
+    # Every piece of a split sequence starts at position 0.
+    assert positions[:2] == [[0, 1, 2, 3, 4, 0, 1, 2], [0, 1, 2, 0, 1, 2, 3, 4]]
+    assert positions[2:] == [[0, 1, 2, 3, 4, 5, 6, 7], [0, 1, 2, 3, 4, 5, 6, 0]]
+    assert contexts[1]["documents"].tolist() == [0, 0, 0, 1, 1, 1, 1, 1]
+    assert torch.equal(
+        torch.cat([c["tokens"] for c in contexts])[11:31], torch.arange(20)
+    )
+
+
+def test_bucketed_batches(shards):
+    padded, bucketed = PaddingStats(), PaddingStats()
+    for batch in make_batches(StreamingDataset(shards), "pad", batch_size=4):
+        padded.update(batch)
+    for batch in make_batches(
+        StreamingDataset(shards), "bucket", batch_size=4, context=4
+    ):
+        assert batch["tokens"].numel() <= 16
+        bucketed.update(batch)
+    assert bucketed.tokens == sum(min(i % 7 + 1, 4) for i in range(23))
+    assert bucketed.efficiency > padded.efficiency
@@ -0,0 +1,442 @@
+import functools
+import os
+import signal
+import socket
+
+import mido
+import numpy as np
+import pytest
+import torch
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from {{cookiecutter.package_name}}.datasets import collate_padded
+from {{cookiecutter.package_name}}.launch import detect, first_host
+from {{cookiecutter.package_name}}.model import (
+    Checkpointer,
+    DistributedContext,
+    Generator,
+    KVCache,
+    MetricsLogger,
+    ModelSettings,
+    Scheduler,
+    Transformer,
+    cleanup_distributed,
+    estimate_memory,
+    events_to_midi,
+    generate,
+    load_model,
+    optimized_model,
+    plot_metrics,
+    read_metrics,
+    setup_distributed,
+)
+from {{cookiecutter.package_name}}.model.checkpoint import to_cpu
+from {{cookiecutter.package_name}}.model.train import (
+    evaluate,
+    lm_loss,
+    restore_state,
+    train,
+    train_epoch,
+    training_state,
+)
+from {{cookiecutter.package_name}}.preprocess import ShardWriter, split_of
+
+from .conftest import TokenStreamer
+
+
+@pytest.fixture
+def batches():
+    torch.manual_seed(0)
+    sequences = [torch.arange(n) % 7 for n in (12, 16, 9, 14)]
+    return [collate_padded(sequences[:2]), collate_padded(sequences[2:])]
+
+
+def test_lm_loss_ignores_padding(batches):
+    logits = torch.zeros(2, 16, 7)
+    loss, tokens = lm_loss(logits, batches[0])
+    assert tokens == 11 + 15
+    assert loss.item() == pytest.approx(torch.log(torch.tensor(7.0)).item())
+
+
+@pytest.mark.parametrize("precision,accumulate", [("fp32", 1), ("bf16", 2)])
+def test_train_epoch(batches, precision, accumulate):
+    model = Transformer(7, context=16, layers=1, heads=2, dim=16, dropout=0.0)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    scaler = torch.amp.GradScaler("cpu", enabled=False)
+
+    before = evaluate(model, batches, precision)
+    for _ in range(10):
+        loss, tokens = train_epoch(
+            model, optimizer, scaler, batches, precision, accumulate
+        )
+    assert tokens == 11 + 15 + 8 + 13
+    assert evaluate(model, batches, precision) < before
+
+
+def test_kv_cache_matches_full_forward():
+    torch.manual_seed(0)
+    model = Transformer(11, context=16, layers=2, heads=2, dim=16, dropout=0.0).eval()
+    tokens = torch.randint(11, (3, 10))
+    full = model(tokens)
+
+    cache = KVCache(model, slots=4)
+    steps = [model(tokens[:, :6], cache=cache, rows=torch.tensor([2, 0, 3]))]
+    steps += [model(tokens[:, [i]], cache=cache, rows=[2, 0, 3]) for i in range(6, 10)]
+    assert torch.allclose(torch.cat(steps, dim=1), full, atol=1e-5)
+    assert cache.lengths.tolist() == [10, 0, 10, 10]
+    with pytest.raises(ValueError, match="context"):
+        model(torch.zeros((1, 7), dtype=torch.long), cache=cache, rows=[0])
+
+
+def test_sdpa_and_checkpointing_match_math_attention(batches):
+    torch.manual_seed(0)
+    kwargs = dict(context=16, layers=2, heads=2, dim=16, dropout=0.0)
+    model = Transformer(7, **kwargs)
+    saving = Transformer(7, **kwargs, attention="sdpa", checkpointing=True)
+    saving.load_state_dict(model.state_dict())
+
+    batch = batches[0]
+    for m in (model, saving):
+        logits = m(batch["tokens"], batch["documents"], batch["positions"])
+        lm_loss(logits, batch)[0].backward()
+    for p, q in zip(model.parameters(), saving.parameters()):
+        assert torch.allclose(p.grad, q.grad, atol=1e-5)
+
+    tokens = torch.randint(7, (2, 8))
+    cache = KVCache(saving.eval(), slots=2)
+    steps = [saving(tokens[:, :5], cache=cache)]
+    steps += [saving(tokens[:, [i]], cache=cache) for i in range(5, 8)]
+    assert torch.allclose(torch.cat(steps, dim=1), model.eval()(tokens), atol=1e-5)
+
+
+def test_model_settings_and_memory_estimate(monkeypatch):
+    monkeypatch.setenv("MS_LAYERS", "3")
+    settings = ModelSettings(context=64, heads=2, dim=32)
+    assert settings.layers == 3
+    model = Transformer(100, **settings.architecture())
+    estimate = estimate_memory(settings, vocab_size=100, batch_size=4)
+    assert estimate.parameters == sum(p.numel() for p in model.parameters())
+    assert estimate.total > estimate.activations > 0
+    assert "Total:" in estimate.describe()
+
+    def activations(**changes):
+        """Activation estimate of the settings with changes."""
+        return estimate_memory(settings.copy(update=changes), 100, 4).activations
+
+    assert activations(checkpointing=True) < activations()
+    assert activations(attention="sdpa") < activations()
+    # Quadratic in the context with math attention, linear with sdpa.
+    assert activations(context=128) > 2 * activations()
+    assert activations(context=128, attention="sdpa") == 2 * activations(
+        attention="sdpa"
+    )
+
+    with pytest.raises(ValueError):
+        ModelSettings(heads=3, dim=32)
+    with pytest.raises(ValueError):
+        ModelSettings(attention="flash")
+
+
+def test_load_model_uses_saved_settings(tmp_path, monkeypatch):
+    settings = ModelSettings(context=16, layers=1, heads=4, dim=16, dropout=0.0)
+    torch.manual_seed(0)
+    model = Transformer(7, **settings.architecture()).eval()
+    model_path = str(tmp_path / "model.pt")
+    torch.save(model.state_dict(), model_path)
+    settings.save(model_path)
+
+    monkeypatch.setenv("MS_HEADS", "8")
+    loaded = load_model(model_path, map_location="cpu").cpu()
+    assert loaded.blocks[0].attention.heads == 4
+    tokens = torch.randint(7, (2, 10))
+    assert torch.allclose(loaded(tokens), model(tokens), atol=1e-6)
+    with pytest.raises(ValueError, match="4 heads"):
+        load_model(model_path, heads=2)
+
+
+def test_generator_continuous_batching(tmp_path):
+    torch.manual_seed(0)
+    model = Transformer(11, context=16, layers=2, heads=2, dim=16, dropout=0.0)
+    torch.save(model.state_dict(), tmp_path / "model.pt")
+    model = load_model(str(tmp_path / "model.pt"), heads=2)
+    prompts = [(i, torch.randint(11, (2 + i,))) for i in range(5)]
+
+    alone = Generator(model, slots=1, max_new_tokens=6, temperature=0)
+    expected = dict(alone.run(prompts))
+    batched = Generator(model, slots=2, max_new_tokens=6, temperature=0)
+    results = dict(batched.run(prompts))
+
+    assert sorted(results) == list(range(5))
+    for i in range(5):
+        assert torch.equal(results[i], expected[i])
+    assert batched.tokens == 30 and batched.tokens_per_second > 0
+
+
+def test_events_to_midi():
+    # Velocity bin 31, C4 on, 0.5 s, C4 off, E4 on and left sounding.
+    midi = events_to_midi([387, 60, 305, 188, 64, 500])
+    notes = [(m.type, m.note, m.velocity) for m in midi.tracks[0] if not m.is_meta]
+    assert notes == [
+        ("note_on", 60, 127),
+        ("note_off", 60, 0),
+        ("note_on", 64, 127),
+        ("note_off", 64, 0),
+    ]
+    assert midi.length == pytest.approx(0.5)
+
+
+def test_generate_resumes(tmp_path):
+    data = tmp_path / "data"
+    (data / "cleandata").mkdir(parents=True)
+    for name in ("a", "b", "c"):
+        np.savetxt(
+            data / "cleandata" / f"{name}.csv",
+            np.arange(10)[None],
+            fmt="%d",
+            delimiter=",",
+        )
+    (data / "test.txt").write_text(
+        "".join(f"{data}/cleandata/{n}.csv\n" for n in "abc")
+    )
+    model = Transformer(388, context=32, layers=1, heads=2, dim=16)
+    torch.save(model.state_dict(), tmp_path / "model.pt")
+    out = tmp_path / "out"
+
+    args = (str(data), str(tmp_path / "model.pt"), str(out))
+    kwargs = dict(slots=2, max_new_tokens=8, heads=2, workers=2, queue_size=1)
+    assert generate(*args, max_gen=2, **kwargs) == 2
+    assert generate(*args, **kwargs) == 1
+    names = sorted(os.listdir(out))
+    assert names == ["000000_a.mid", "000001_b.mid", "000002_c.mid"]
+    mido.MidiFile(str(out / names[0]))
+
+
+def test_optimized_model(tmp_path, capsys):
+    data = tmp_path / "data"
+    (data / "cleandata").mkdir(parents=True)
+    np.savetxt(
+        data / "cleandata" / "a.csv", np.arange(20)[None] % 7, fmt="%d", delimiter=","
+    )
+    (data / "val.txt").write_text(f"{data}/cleandata/a.csv\n")
+    torch.manual_seed(0)
+    model_path = str(tmp_path / "model.pt")
+    torch.save(
+        Transformer(7, context=32, layers=1, heads=2, dim=16).state_dict(), model_path
+    )
+
+    model = optimized_model(model_path, threads=1, heads=2)
+    assert "without accuracy check" in capsys.readouterr().out
+    # The check skipped without data is not cached for a run with data.
+    model = optimized_model(model_path, str(data), threads=1, heads=2)
+    assert "Validation perplexity" in capsys.readouterr().out
+    assert isinstance(
+        model.blocks[0].attention.qkv, torch.ao.nn.quantized.dynamic.Linear
+    )
+    assert os.path.exists(tmp_path / "model.int8.pt")
+    assert (
+        len(list(Generator(model, max_new_tokens=4).run([(0, torch.arange(3))]))) == 1
+    )
+
+    model = optimized_model(model_path, str(data), threads=1, heads=2, tolerance=-1)
+    assert "Using cached int8 model" in capsys.readouterr().out
+    assert isinstance(model.blocks[0].attention.qkv, torch.nn.Linear)
+
+
+def test_train_finishes_only_with_its_budget(raw_data, tmp_path):
+    assign = functools.partial(split_of, train=0.5, val=0.25)
+    with ShardWriter(os.path.join(raw_data, "shards"), assign=assign) as sink:
+        TokenStreamer(raw_data).preprocess(sink=sink)
+    kwargs = dict(
+        settings=ModelSettings(context=16, layers=1, heads=2, dim=16),
+        logfile=str(tmp_path / "log.txt"),
+        batch_size=4,
+        max_steps=2,
+    )
+    model_path = str(tmp_path / "models" / "model.pt")
+
+    # Out of time before the budget is used up, so the stage is not done.
+    assert not train(raw_data, model_path, hours=0, **kwargs)
+    assert train(raw_data, model_path, **kwargs)
+    assert os.path.exists(model_path)
+
+
+def test_checkpointer_retention(tmp_path):
+    with Checkpointer(str(tmp_path), keep_last=2, keep_best=1) as checkpointer:
+        checkpointer.save({"step": 0}, 0, 3.0)
+        assert checkpointer.written == 1 and checkpointer.write_seconds > 0
+        for step, loss in enumerate([1.0, 2.0, 4.0, None], start=1):
+            checkpointer.save({"step": step}, step, loss)
+        checkpointer.wait()
+        kept = [c.step for c in checkpointer.checkpoints()]
+
+    assert kept == [4, 3, 1]
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_checkpointer_skips_unreadable(tmp_path):
+    checkpointer = Checkpointer(str(tmp_path))
+    assert checkpointer.load_latest() is None
+    checkpointer.save({"step": 1}, 1)
+    checkpointer.close()
+    (tmp_path / "checkpoint_step00000002_20260101T000000.pt").write_bytes(b"broken")
+
+    assert Checkpointer(str(tmp_path)).load_latest()["step"] == 1
+
+
+def test_resume_restores_training(batches):
+    model = Transformer(7, context=16, layers=1, heads=2, dim=16, dropout=0.5)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    scaler = torch.amp.GradScaler("cpu", enabled=False)
+    train_epoch(model, optimizer, scaler, batches)
+    state = to_cpu(training_state(model, optimizer, scaler, 1, 1, 2))
+
+    def resumed():
+        restore_state(to_cpu(state), model, optimizer, scaler)
+        train_epoch(model, optimizer, scaler, batches, skip=1)
+        return [p.detach().clone() for p in model.parameters()]
+
+    first, second = resumed(), resumed()
+    assert all(torch.equal(a, b) for a, b in zip(first, second))
+
+
+def test_scheduler_budgets():
+    scheduler = Scheduler(3600, max_steps=3, max_tokens=250).start(steps=1)
+    scheduler.step(100)
+    assert not scheduler.exhausted
+    scheduler.step(200)
+    assert scheduler.exhausted and scheduler.steps == 3
+
+    assert scheduler.fits(60)
+    scheduler.record(save=600)
+    assert not scheduler.fits(3000)
+    scheduler.close()
+
+
+def test_scheduler_stops_on_signal():
+    previous = signal.getsignal(signal.SIGUSR1)
+    scheduler = Scheduler(3600).start()
+    assert scheduler.fits()
+
+    os.kill(os.getpid(), signal.SIGUSR1)
+    assert scheduler.received == signal.SIGUSR1
+    assert not scheduler.fits()
+    assert not scheduler.requeue_job()
+
+    scheduler.close()
+    assert signal.getsignal(signal.SIGUSR1) is previous
+
+
+@pytest.mark.parametrize("name", ["log.txt", "log.jsonl"])
+def test_metrics_logger_buffers(tmp_path, name):
+    path = str(tmp_path / name)
+    logger = MetricsLogger(path, flush_records=3)
+    logger.log("step", step=1, train_loss=2.0)
+    logger.log("step", step=2, train_loss=1.5)
+    assert not os.path.exists(path)
+    logger.log("epoch", step=2, train_loss=1.6, val_loss=1.8)
+    assert os.path.exists(path)
+    logger.log("step", step=3, train_loss=1.2)
+    logger.close()
+
+    metrics = read_metrics(path)
+    assert list(metrics["step"]) == [1, 2, 2, 3]
+    assert list(read_metrics(path, kind="epoch")["val_loss"]) == [1.8]
+    assert plot_metrics(metrics).to_dict()["mark"]["type"] == "line"
+
+
+def test_metrics_logger_appends_to_old_log(tmp_path):
+    path = tmp_path / "log.csv"
+    path.write_text("epoch,train_loss,val_loss\n0,2.0,2.1\n")
+    logger = MetricsLogger(str(path), append=True, flush_records=1)
+    logger.log("epoch", epoch=1, step=4, train_loss=1.5, val_loss=1.7)
+    logger.close()
+
+    metrics = read_metrics(str(path))
+    assert list(metrics["kind"]) == ["epoch", "epoch"]
+    assert list(metrics["val_loss"]) == [2.1, 1.7]
+    assert list(read_metrics(str(path), kind="epoch")["epoch"]) == [0, 1]
+
+
+def test_metrics_per_rank(tmp_path):
+    path = str(tmp_path / "log.csv")
+    for rank in range(2):
+        with MetricsLogger(path, rank=rank, per_rank=True) as logger:
+            logger.log(step=1, train_loss=float(rank))
+    with MetricsLogger(path, rank=1) as logger:
+        logger.log(step=1, train_loss=5.0)
+
+    metrics = read_metrics(path)
+    assert sorted(metrics["rank"]) == [0, 1]
+    assert sorted(metrics["train_loss"]) == [0.0, 1.0]
+
+
+@pytest.mark.parametrize(
+    "nodelist,host",
+    [("node07", "node07"), ("node[03-05,9],gpu1", "node03"), ("a1,b2", "a1")],
+)
+def test_first_host(nodelist, host):
+    assert first_host(nodelist) == host
+
+
+def test_detect(monkeypatch):
+    for name in (
+        "SLURM_NTASKS",
+        "SLURM_STEP_ID",
+        "SLURM_STEP_NUM_TASKS",
+        "SLURM_PROCID",
+        "WORLD_SIZE",
+        "MASTER_ADDR",
+    ):
+        monkeypatch.delenv(name, raising=False)
+    assert detect() == DistributedContext()
+
+    monkeypatch.setenv("WORLD_SIZE", "4")
+    monkeypatch.setenv("RANK", "2")
+    assert detect().rank == 2 and detect().world_size == 4
+
+    monkeypatch.delenv("WORLD_SIZE")
+    # The batch script of a job with 8 tasks is a single process.
+    monkeypatch.setenv("SLURM_NTASKS", "8")
+    monkeypatch.setenv("SLURM_PROCID", "0")
+    assert detect() == DistributedContext()
+    monkeypatch.setenv("SLURM_STEP_ID", str(0xFFFFFFFB))
+    assert detect() == DistributedContext()
+
+    monkeypatch.setenv("SLURM_STEP_ID", "0")
+    monkeypatch.setenv("SLURM_STEP_NUM_TASKS", "8")
+    monkeypatch.setenv("SLURM_PROCID", "5")
+    monkeypatch.setenv("SLURM_LOCALID", "1")
+    monkeypatch.setenv("SLURM_JOB_NODELIST", "gpu[12-13]")
+    context = detect()
+    assert (context.rank, context.local_rank, context.world_size) == (5, 1, 8)
+    assert context.master_addr == "gpu12"
+
+
+def _train_rank(rank, port, results):
+    setup_distributed(DistributedContext(rank, rank, 2, "127.0.0.1", port))
+    torch.manual_seed(rank)
+    model = Transformer(7, context=16, layers=1, heads=2, dim=16, dropout=0.0)
+    model = DistributedDataParallel(model)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    scaler = torch.amp.GradScaler("cpu", enabled=False)
+
+    sequences = [torch.arange(n) % 7 for n in range(8 + rank, 16)]
+    pairs = zip(sequences[0::2], sequences[1::2])
+    batches = [collate_padded(list(pair)) for pair in pairs][: 4 - rank]
+    _, tokens = train_epoch(model, optimizer, scaler, batches, accumulate=2)
+    weights = torch.cat([p.detach().flatten() for p in model.parameters()])
+    results[rank] = (tokens, weights)
+    cleanup_distributed()
+
+
+def test_train_epoch_distributed():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    results = mp.Manager().dict()
+    mp.spawn(_train_rank, args=(port, results), nprocs=2)
+
+    # Both ranks take the same steps, rank 0 drops its surplus batch.
+    assert results[0][0] == results[1][0]
+    assert torch.equal(results[0][1], results[1][1])
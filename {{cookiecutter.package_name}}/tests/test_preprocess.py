@@ -0,0 +1,383 @@
+import collections
+import functools
+import itertools
+import json
+import os
+import shutil
+import threading
+import time
+
+import mido
+import numpy as np
+import pytest
+
+from {{cookiecutter.package_name}}.datasets import StreamingDataset
+from {{cookiecutter.package_name}}.preprocess import (
+    FileIndex,
+    Filter,
+    Loader,
+    Map,
+    Partition,
+    Pipeline,
+    ShardReader,
+    ShardWriter,
+    Transform,
+    assign_split,
+    get_pack,
+    merge_partitions,
+    parallel_map,
+    scan,
+    split,
+    split_of,
+    synthesize,
+)
+from {{cookiecutter.package_name}}.preprocess.manifest import file_hash
+
+from .conftest import TextLoader, TokenStreamer, UpperStreamer
+
+
+def _square(x):
+    if x == 3:
+        raise ValueError("three")
+    return x * x
+
+
+def test_parallel_map_ordered():
+    results = list(parallel_map(_square, range(10), workers=2, chunksize=3, window=2))
+    assert [r.index for r in results] == list(range(10))
+    assert [r.value for r in results if r.error is None] == [
+        x * x for x in range(10) if x != 3
+    ]
+    assert "three" in results[3].error
+
+
+def test_parallel_map_unordered():
+    results = parallel_map(_square, range(10), workers=2, chunksize=1, ordered=False)
+    assert sorted(r.index for r in results) == list(range(10))
+
+
+def test_preprocess_parallel(raw_data):
+    with open(os.path.join(raw_data, "rawdata", "0", "song_0.txt"), "w") as f:
+        f.write("broken")
+
+    failures = UpperStreamer(raw_data).preprocess(workers=2, chunksize=4)
+
+    assert [os.path.basename(f) for f, _ in failures] == ["song_0.txt"]
+    assert len(os.listdir(os.path.join(raw_data, "cleandata"))) == 19
+
+
+def test_preprocess_incremental(raw_data, capsys):
+    streamer = UpperStreamer(raw_data)
+    streamer.preprocess(workers=2, chunksize=4)
+    streamer.preprocess()
+    assert "Skipping 20 up to date files" in capsys.readouterr().out
+
+    rawdata = os.path.join(raw_data, "rawdata")
+    with open(streamer.manifest_path) as f:
+        entry = json.load(f)[os.path.join("rawdata", "0", "song_3.txt")]
+    assert entry["hash"] == file_hash(os.path.join(rawdata, "0", "song_3.txt"))
+    # Touched files are hashed again, but not transformed.
+    os.utime(os.path.join(rawdata, "0", "song_3.txt"), ns=(0, 0))
+    with open(os.path.join(rawdata, "1", "song_1.txt"), "w") as f:
+        f.write("changed")
+    with open(os.path.join(rawdata, "1", "song_new.txt"), "w") as f:
+        f.write("new")
+    os.remove(os.path.join(rawdata, "2", "song_2.txt"))
+
+    streamer.preprocess()
+    output = capsys.readouterr().out
+    assert "Removed outputs of 1 deleted files" in output
+    assert "Skipping 18 up to date files" in output
+
+    cleandata = os.path.join(raw_data, "cleandata")
+    assert not os.path.exists(os.path.join(cleandata, "song_2.csv"))
+    with open(os.path.join(cleandata, "song_1.csv")) as f:
+        assert f.read() == "CHANGED"
+
+    streamer.preprocess([str.strip])
+    assert "Skipping 0 up to date files" in capsys.readouterr().out
+
+
+def test_scan_parallel(raw_data):
+    rawdata = os.path.join(raw_data, "rawdata")
+    assert len(list(scan(rawdata, "*.txt"))) == 20
+    assert sorted(scan(rawdata, "*.txt", workers=4)) == sorted(scan(rawdata, "*.txt"))
+    assert list(scan(rawdata, "*.mid")) == []
+
+
+def test_file_index_cache(raw_data):
+    rawdata = os.path.join(raw_data, "rawdata")
+    index = FileIndex(rawdata, "*.txt")
+    assert len(index.files) == 20
+    assert os.path.exists(rawdata + ".index.json")
+    assert index.is_current(index.load())
+
+    with open(os.path.join(rawdata, "1", "song_new.txt"), "w") as f:
+        f.write("new")
+    assert not index.is_current(index.load())
+    assert len(index.files) == 21
+
+
+def test_split_position_without_test(raw_data):
+    UpperStreamer(raw_data).preprocess()
+    split(raw_data, train=0.8, val=0.2, test=0, method="position")
+
+    splits = {}
+    for name in ("train", "val", "test"):
+        with open(os.path.join(raw_data, f"{name}.txt")) as f:
+            splits[name] = f.read().splitlines()
+    assert splits["test"] == []
+    assert len(splits["train"]) == 16 and len(splits["val"]) == 4
+    assert not set(splits["train"]) & set(splits["val"])
+
+
+def test_split_hash(raw_data):
+    UpperStreamer(raw_data).preprocess()
+    split(raw_data, group=r"song_(\d)")
+
+    splits = {}
+    for name in ("train", "val", "test"):
+        with open(os.path.join(raw_data, f"{name}.txt")) as f:
+            for line in f.read().splitlines():
+                splits[os.path.basename(line)] = name
+    assert len(splits) == 20
+    assert splits["song_1.csv"] == splits["song_12.csv"] == splits["song_19.csv"]
+
+    with open(os.path.join(raw_data, "cleandata", "song_new.csv"), "w") as f:
+        f.write("NEW")
+    split(raw_data, group=r"song_(\d)")
+    with open(os.path.join(raw_data, "train.txt")) as f:
+        train = {os.path.basename(line) for line in f.read().splitlines()}
+    assert {k for k, v in splits.items() if v == "train"} <= train
+
+
+def test_assign_split():
+    assert assign_split("a/b.csv") == assign_split("a/b.csv")
+    counts = collections.Counter(assign_split(str(i)) for i in range(10000))
+    assert 7700 < counts["train"] < 8300
+    assert 800 < counts["val"] < 1200
+
+
+def test_shards_roundtrip(tmp_path):
+    sequences = [np.arange(n) for n in (5, 3, 9, 0, 4)]
+    with ShardWriter(str(tmp_path), shard_tokens=8) as writer:
+        for i, sequence in enumerate(sequences):
+            writer.write(sequence, name=f"seq_{i}")
+
+    reader = ShardReader(str(tmp_path))
+    assert len(reader) == 5
+    assert reader.names[2] == "seq_2"
+    assert list(reader.lengths) == [5, 3, 9, 0, 4]
+    assert list(reader.index["shard"]) == [0, 0, 1, 2, 2]
+    for sequence, stored in zip(sequences, [reader[i] for i in range(5)]):
+        np.testing.assert_array_equal(sequence, stored)
+
+
+def test_preprocess_into_shards(raw_data):
+    folder = os.path.join(raw_data, "shards")
+    # Songs in the same folder stay in the same split.
+    assign = functools.partial(split_of, group=r"^\d+", train=0.5, val=0.25)
+    with ShardWriter(folder, assign=assign) as sink:
+        TokenStreamer(raw_data).preprocess(workers=2, sink=sink)
+
+    reader = ShardReader(folder)
+    assert len(reader) == 20
+    i = reader.names.index(os.path.join("1", "song_4.txt"))
+    assert bytes(reader[i].astype(np.uint8)) == b"song 4"
+
+    expected = {name: assign(name) for name in reader.names}
+    for name in ("train", "val", "test"):
+        dataset = StreamingDataset.from_data_path(raw_data, name, rank=0, world_size=1)
+        assert {dataset.name(p) for p in range(len(dataset.items))} == {
+            n for n, s in expected.items() if s == name
+        }
+
+    # Shards written before splits were stored fall back to assign_split.
+    np.save(
+        os.path.join(folder, "index.npy"), reader.index[["shard", "offset", "length"]]
+    )
+    dataset = StreamingDataset(folder, split="val", rank=0, world_size=1)
+    assert {dataset.name(p) for p in range(len(dataset.items))} == {
+        n for n in reader.names if assign_split(n) == "val"
+    }
+
+
+def _read_splits(data):
+    splits = {}
+    for name in ("train", "val", "test"):
+        with open(os.path.join(data, f"{name}.txt")) as f:
+            splits.update((line, name) for line in f.read().splitlines())
+    return splits
+
+
+def test_partitioned_preprocess(raw_data, tmp_path, monkeypatch):
+    single = str(tmp_path / "single")
+    shutil.copytree(raw_data, single)
+    UpperStreamer(single).preprocess()
+    split(single)
+
+    with pytest.raises(FileNotFoundError):
+        merge_partitions(raw_data)
+    for task in range(3):
+        # Set by hand like in a task of sbatch --array=1-3.
+        monkeypatch.setenv("SLURM_ARRAY_TASK_ID", str(task + 1))
+        monkeypatch.setenv("SLURM_ARRAY_TASK_MIN", "1")
+        monkeypatch.setenv("SLURM_ARRAY_TASK_COUNT", "3")
+        partition = Partition.parse("slurm")
+        assert partition == (task, 3)
+        UpperStreamer(raw_data).preprocess(partition=partition)
+        split(raw_data, partition=partition)
+        if task == 1:
+            with pytest.raises(FileNotFoundError, match=r"\[2\] of 3"):
+                merge_partitions(raw_data)
+
+    assert merge_partitions(raw_data) == 3
+    merged = {
+        os.path.relpath(k, raw_data): v for k, v in _read_splits(raw_data).items()
+    }
+    assert merged == {
+        os.path.relpath(k, single): v for k, v in _read_splits(single).items()
+    }
+    with open(os.path.join(raw_data, "manifest.json")) as f:
+        assert len(json.load(f)) == 20
+
+    assert (
+        sum(Partition.parse(f"{i}/3").contains("0/song_0.txt") for i in range(3)) == 1
+    )
+    with pytest.raises(ValueError):
+        Partition.parse("3/3")
+
+
+def test_partitioned_shards(raw_data):
+    assign = functools.partial(split_of, group=r"^\d+")
+    for index in range(2):
+        partition = Partition(index, 2)
+        with pytest.raises(FileNotFoundError):
+            merge_partitions(raw_data)
+        with ShardWriter(partition.shards(raw_data), 8, assign=assign) as sink:
+            TokenStreamer(raw_data).preprocess(sink=sink, partition=partition)
+        with pytest.raises(ValueError, match="packed into shards"):
+            split(raw_data, partition=partition)
+    assert merge_partitions(raw_data) == 2
+    # Like a single run into shards, the merge writes no split lists or manifest.
+    assert not os.path.exists(os.path.join(raw_data, "train.txt"))
+    assert not os.path.exists(os.path.join(raw_data, "manifest.json"))
+
+    reader = ShardReader(os.path.join(raw_data, "shards"))
+    assert len(reader) == 20
+    train = StreamingDataset.from_data_path(raw_data, "train", rank=0, world_size=1)
+    assert {train.name(p) for p in range(len(train.items))} == {
+        name for name in reader.names if assign(name) == "train"
+    }
+    i = reader.names.index(os.path.join("1", "song_4.txt"))
+    assert bytes(reader[i].astype(np.uint8)) == b"song 4"
+
+
+def _is_even(x):
+    return x % 2 == 0
+
+
+def _scale(batch):
+    assert isinstance(batch, np.ndarray) and len(batch) <= 4
+    return batch * 10
+
+
+def test_pipeline_stages():
+    pipeline = Pipeline(Filter(_is_even), Map(_scale, batched=True), batch_size=4)
+    assert pipeline(range(20)) == [x * 10 for x in range(0, 20, 2)]
+
+    stream = pipeline.stream(itertools.count())
+    assert list(itertools.islice(stream, 3)) == [0, 20, 40]
+
+    with pytest.raises(TypeError):
+        Transform()
+
+
+def test_preprocess_pack():
+    assert isinstance(get_pack("standard"), Pipeline)
+    assert list(get_pack("standard").stream([1, 2])) == [1, 2]
+    with pytest.raises(ValueError):
+        get_pack("unknown")
+
+
+class SlowLoader(TextLoader):
+    lock = threading.Lock()
+    loading = 0
+    most = 0
+
+    def load(self, filename):
+        with self.lock:
+            SlowLoader.loading += 1
+            SlowLoader.most = max(SlowLoader.most, SlowLoader.loading)
+        time.sleep(0.01)
+        with self.lock:
+            SlowLoader.loading -= 1
+        return super().load(filename)
+
+
+def test_loader_readahead(raw_data):
+    rawdata = os.path.join(raw_data, "rawdata")
+    expected = list(TextLoader(rawdata))
+
+    SlowLoader.most = 0
+    assert list(SlowLoader(rawdata, readahead=8).stream()) == expected
+    assert SlowLoader.most > 1
+
+    class IterOnlyLoader(Loader):
+        extension = "*.txt"
+
+        def __iter__(self):
+            yield from TextLoader(self.folder)
+
+    # Loaders without load are streamed without read-ahead.
+    assert list(IterOnlyLoader(rawdata, readahead=8).stream()) == expected
+
+    SlowLoader.most = 0
+    loader = SlowLoader(rawdata, readahead=8, readahead_bytes=1)
+    assert list(loader.stream()) == expected
+    assert SlowLoader.most == 1
+
+
+def test_synthesize(tmp_path):
+    one, two = tmp_path / "one", tmp_path / "two"
+    assert (
+        synthesize(str(one), files=20, fanout=3, depth=2, notes=10, format="csv") == 20
+    )
+    assert (
+        synthesize(
+            str(two),
+            files=20,
+            fanout=3,
+            depth=2,
+            notes=10,
+            format="csv",
+            workers=2,
+            chunksize=4,
+        )
+        == 20
+    )
+
+    files = sorted(scan(str(one / "rawdata"), "*.csv"))
+    assert len(files) == 20
+    assert len({os.path.dirname(f) for f in files}) == 9
+    for f in files:
+        with open(f) as a, open(f.replace(str(one), str(two))) as b:
+            assert a.read() == b.read()
+
+    assert (
+        synthesize(str(one), files=25, fanout=3, depth=2, notes=10, format="csv") == 5
+    )
+    # Files of another seed are replaced.
+    assert (
+        synthesize(
+            str(one), files=25, fanout=3, depth=2, notes=10, format="csv", seed=1
+        )
+        == 25
+    )
+
+
+def test_synthesize_midi(tmp_path):
+    synthesize(str(tmp_path), files=2, depth=0, notes=50, sigma=0.0)
+    midi = mido.MidiFile(str(tmp_path / "rawdata" / "song_00000000.mid"))
+    assert sum(m.type == "note_on" for m in midi.tracks[0]) == 50
+    assert midi.length > 0
@@ -0,0 +1,38 @@
+import os
+
+import torch
+
+from {{cookiecutter.package_name}}.preprocess import parallel_map
+from {{cookiecutter.package_name}}.profiling import Profiler
+
+
+def square(x):
+    return sum(i * i for i in range(x))
+
+
+def test_profiler(tmp_path):
+    profiler = Profiler(str(tmp_path), skip=2, steps=2, every=3, rank=0)
+
+    with profiler.stage("preprocess"):
+        func = profiler.sample("preprocess.transform", square)
+        results = list(parallel_map(func, range(100, 110), workers=2, chunksize=2))
+    assert [r.value for r in results] == [square(x) for x in range(100, 110)]
+
+    with profiler.stage("train", cprofile=False):
+        trace = profiler.torch_profile("train")
+        trace.start()
+        for _ in range(6):
+            torch.randn(32, 32) @ torch.randn(32, 32)
+            trace.step()
+        trace.stop()
+
+    files = os.listdir(tmp_path)
+    assert "preprocess.pstats" in files
+    assert any(f.startswith("preprocess.transform.pid") for f in files)
+    assert "train.trace.json" in files
+    assert "train.pstats" not in files
+
+    summary = profiler.summary()
+    assert "Hot spots of preprocess.transform (cProfile)" in summary
+    assert "Hot spots of train (torch.profiler)" in summary
+    assert "summary.txt" in os.listdir(tmp_path)
@@ -0,0 +1,124 @@
+import os
+import signal
+import threading
+
+import pytest
+
+from {{cookiecutter.package_name}}.model.scheduler import Scheduler
+from {{cookiecutter.package_name}}.preprocess.indexer import walk as real_walk
+from {{cookiecutter.package_name}}.stages import Stage, StageGraph
+
+
+def make_stages(root, calls, fail=None):
+    raw, clean, lists = (os.path.join(root, name) for name in ("raw", "clean", "lists"))
+
+    def step(name, source, target):
+        def run():
+            calls.append(name)
+            if name == fail:
+                raise RuntimeError(name)
+            os.makedirs(target, exist_ok=True)
+            with open(os.path.join(target, "out.txt"), "w") as f:
+                f.write(str(sorted(os.listdir(source))))
+
+        return run
+
+    return [
+        Stage("clean", step("clean", raw, clean), (raw,), (clean,), {"pack": "a"}),
+        Stage("split", step("split", clean, lists), (clean,), (lists,)),
+    ]
+
+
+def test_stage_graph_skips_current_stages(tmp_path):
+    root, stamps = str(tmp_path), str(tmp_path / "stages.json")
+    os.makedirs(tmp_path / "raw")
+    (tmp_path / "raw" / "a.txt").write_text("a")
+    calls = []
+
+    graph = StageGraph(make_stages(root, calls), stamps)
+    assert graph.dependencies == {"clean": [], "split": ["clean"]}
+    assert graph.plan() == [("clean", "never finished"), ("split", "after clean")]
+    assert graph.run() == ["clean", "split"]
+    assert graph.plan() == [("clean", None), ("split", None)]
+    assert graph.run() == [] and calls == ["clean", "split"]
+
+    (tmp_path / "raw" / "b.txt").write_text("b")
+    assert graph.plan()[0] == ("clean", "inputs or parameters changed")
+    assert graph.run() == ["clean", "split"]
+
+    stages = make_stages(root, calls)
+    stages[0] = stages[0]._replace(params={"pack": "b"})
+    assert StageGraph(stages, stamps).plan()[0][1] == "inputs or parameters changed"
+
+    os.remove(tmp_path / "lists" / "out.txt")
+    os.rmdir(tmp_path / "lists")
+    assert StageGraph(make_stages(root, calls), stamps).run() == ["split"]
+
+
+def test_stage_graph_failures(tmp_path):
+    os.makedirs(tmp_path / "raw")
+    calls = []
+    graph = StageGraph(
+        make_stages(str(tmp_path), calls, fail="clean"), str(tmp_path / "s.json")
+    )
+    with pytest.raises(RuntimeError):
+        graph.run()
+    assert calls == ["clean"]
+    assert not os.path.exists(tmp_path / "s.json")
+
+    # A stage returning False, e.g. training stopped by a signal, runs again next time.
+    stopped = Stage("train", lambda: False, outputs=(str(tmp_path / "raw"),))
+    graph = StageGraph([stopped], str(tmp_path / "s.json"))
+    assert graph.run() == ["train"] and graph.run() == ["train"]
+
+    with pytest.raises(ValueError):
+        StageGraph([stopped, stopped], str(tmp_path / "s.json"))
+
+
+def test_stage_graph_runs_independent_stages_together(tmp_path):
+    barrier = threading.Barrier(2, timeout=10)
+    stages = [
+        Stage(name, barrier.wait, outputs=(str(tmp_path / name),))
+        for name in ("first", "second")
+    ]
+    graph = StageGraph(stages, str(tmp_path / "stages.json"))
+    assert graph.dependencies == {"first": [], "second": []}
+    # Both stages wait for each other, which only finishes if they run at the same time.
+    assert sorted(graph.run()) == ["first", "second"]
+
+
+def test_stage_graph_trains_on_the_main_thread(tmp_path):
+    installed = []
+
+    def train():
+        scheduler = Scheduler(3600).start()
+        installed.append(signal.getsignal(signal.SIGTERM) == scheduler._handle)
+        scheduler.close()
+
+    stages = [
+        Stage("clean", lambda: None, outputs=(str(tmp_path / "clean"),)),
+        Stage("train", train, (str(tmp_path / "clean"),), distributed=True),
+    ]
+    previous = signal.getsignal(signal.SIGTERM)
+    assert StageGraph(stages, str(tmp_path / "stages.json"), jobs=2).run() == [
+        "clean",
+        "train",
+    ]
+    assert installed == [True]
+    assert signal.getsignal(signal.SIGTERM) is previous
+
+
+def test_stage_graph_fingerprints_inputs_once(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / "raw")
+    graph = StageGraph(make_stages(str(tmp_path), []), str(tmp_path / "s.json"))
+    graph.run()
+    walked = []
+
+    def walk(path, **kwargs):
+        walked.append(os.path.basename(path))
+        return real_walk(path, **kwargs)
+
+    monkeypatch.setattr("{{cookiecutter.package_name}}.stages.walk", walk)
+    assert graph.run() == []
+    # One walk of the input folder of every stage.
+    assert walked == ["raw", "clean"]